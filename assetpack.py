@@ -0,0 +1,166 @@
+"""Packing the game's assets into one file, for frozen (PyInstaller) builds.
+
+Loading each asset from its own file means dozens of small file opens, which is slow from network shares and USB
+sticks, and only works if the game is started from the project folder. An asset pack is one file holding every asset
+the game uses, one after another in the order they are loaded at startup, so starting the game is one sequential read.
+
+AssetPack memory-maps a pack and hands out file-like views of the assets in it, which pygame can load from directly.
+Nothing is copied out of the memory map except the bytes pygame actually reads.
+
+The format (all numbers little endian):
+    header - "ASSETPK", format version, number of assets, offset of the index
+    data   - the bytes of each asset, one after another. Each asset starts on a multiple of ALIGNMENT bytes
+    index  - for each asset, its offset, its size, the length of its name and then the name itself (UTF-8). Names are
+             paths inside of the resources folder, with / between folders (like 'explosions/explosion3.ogg')
+
+Usage:
+    python assetpack.py                    packs the assets that flyinginspace uses into build/resources.pack
+    python assetpack.py --output PATH      packs them somewhere else
+"""
+import io
+import mmap
+import os
+import struct
+
+MAGIC = b'ASSETPK'
+VERSION = 1
+HEADER = struct.Struct('<7sBIQ')
+ENTRY = struct.Struct('<QQH')
+ALIGNMENT = 16
+DEFAULT_OUTPUT = os.path.join('build', 'resources.pack')
+
+
+def build_pack(names, output_path, directory):
+    """Packs the files called names (paths inside of directory, with / between folders) into an asset pack at
+    output_path, in the order they are given. Files that don't exist are left out with a warning. Returns the names
+    that were packed"""
+    folder = os.path.dirname(output_path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    index = []
+    with open(output_path, 'wb') as pack:
+        pack.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+        for name in names:
+            path = os.path.join(directory, *name.split('/'))
+            if not os.path.isfile(path):
+                print('Warning:', path, 'does not exist, so it was left out of the asset pack')
+                continue
+            pack.write(b'\0' * (-pack.tell() % ALIGNMENT))
+            offset = pack.tell()
+            with open(path, 'rb') as file:
+                data = file.read()
+            pack.write(data)
+            index.append((name, offset, len(data)))
+
+        index_offset = pack.tell()
+        for name, offset, size in index:
+            encoded_name = name.encode('utf-8')
+            pack.write(ENTRY.pack(offset, size, len(encoded_name)))
+            pack.write(encoded_name)
+        pack.seek(0)
+        pack.write(HEADER.pack(MAGIC, VERSION, len(index), index_offset))
+    return [name for name, _, _ in index]
+
+
+class PackedFile(io.RawIOBase):
+    """Class that reads one asset out of an AssetPack, the same as a file opened with open(path, 'rb'). Reading copies
+    the bytes that are read straight out of the memory map, and nothing else"""
+    def __init__(self, view, name):
+        super().__init__()
+        self._view = view
+        self._position = 0
+        self.name = name
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._view[self._position:self._position + len(buffer)]
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def readall(self):
+        data = self._view[self._position:].tobytes()
+        self._position = len(self._view)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError('Can not seek to before the start of ' + self.name)
+        self._position = offset
+        return offset
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
+class AssetPack:
+    """Class that memory-maps an asset pack, to open the assets in it without reading them all up front"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+
+        magic, version, count, index_offset = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError(path + ' is not an asset pack')
+        if version != VERSION:
+            raise ValueError(path + ' is asset pack version ' + str(version) + ', which this version of the game '
+                             'can not read')
+        # Name -> (offset, size) of every asset
+        self.assets = {}
+        position = index_offset
+        for _ in range(count):
+            offset, size, name_length = ENTRY.unpack_from(self._map, position)
+            position += ENTRY.size
+            name = self._view[position:position + name_length].tobytes().decode('utf-8')
+            position += name_length
+            self.assets[name] = (offset, size)
+
+    def __contains__(self, name):
+        return name in self.assets
+
+    def __len__(self):
+        return len(self.assets)
+
+    def view(self, name):
+        """Returns a memoryview of an asset's bytes, straight out of the memory map"""
+        offset, size = self.assets[name]
+        return self._view[offset:offset + size]
+
+    def open(self, name):
+        """Returns a PackedFile to read an asset from, which pygame can load from like a file"""
+        return PackedFile(self.view(name), name)
+
+    def close(self):
+        """Closes the memory map. Every view and PackedFile from this pack needs to be closed or released first"""
+        self._view.release()
+        self._map.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Pack the assets that flyinginspace uses into one file')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='where to save the pack (%s by default)'
+                                                                 % DEFAULT_OUTPUT)
+    arguments = parser.parse_args()
+
+    from assets import RESOURCE_DIRECTORY
+    from flyinginspace import RESOURCE_FILES
+    packed = build_pack(RESOURCE_FILES, arguments.output, RESOURCE_DIRECTORY)
+    print('Packed', len(packed), 'assets into', arguments.output, '(' + str(os.path.getsize(arguments.output)),
+          'bytes)')
@@ -0,0 +1,176 @@
+"""Asset loading for flyinginspace and bouncinginspace.
+
+Loading every sound one after another before the first frame makes the games slow to start. AssetManager loads them
+on background threads instead, so the window can open and the menu can be drawn while the rest is still loading.
+Anything that is needed before it has finished loading is waited for, and anything that was never preloaded is loaded
+right away the first time it is asked for.
+
+Images are converted to the display's pixel format once, the first time they are asked for after the window is open,
+since unconverted surfaces are much slower to blit.
+
+Each step of startup can be timed with "with assets.timed(step):", and mark(step) notes how long after startup
+something happened (like the first frame being shown). report() gives the breakdown, along with how long each
+background load took.
+
+Assets are found next to the game's code rather than in the working directory. If there is an asset pack there (see
+assetpack.py), as there is in frozen builds, assets are read out of it and only the ones that aren't packed are loaded
+from the resources folder.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import os
+import sys
+import threading
+import time
+
+import pygame
+
+from assetpack import AssetPack
+
+# Frozen builds unpack their data files into sys._MEIPASS
+BASE_DIRECTORY = getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__)))
+RESOURCE_DIRECTORY = os.path.join(BASE_DIRECTORY, 'resources')
+PACK_PATH = os.path.join(BASE_DIRECTORY, 'resources.pack')
+
+
+class AssetManager:
+    """Class that loads sounds and images from directory, in the background if they are preloaded.
+
+    Sounds are named by their path inside of directory without the extension (like 'explosions/explosion3'), and
+    images by their path with the extension (like 'marble.png'). If there is an asset pack at pack_path, assets are
+    loaded from it instead of from directory"""
+    def __init__(self, directory=RESOURCE_DIRECTORY, max_workers=4, clock=time.perf_counter, pack_path=PACK_PATH):
+        self.directory = directory
+        self.pack = AssetPack(pack_path) if pack_path is not None and os.path.isfile(pack_path) else None
+        self.max_workers = max_workers
+        self.clock = clock
+        self.start_time = clock()
+        # Startup step -> milliseconds it took, and step -> milliseconds after startup that it happened
+        self.timings = OrderedDict()
+        self.marks = OrderedDict()
+        # Asset -> milliseconds it took to load, filled in by the loading threads
+        self.load_times = OrderedDict()
+        # When the first preload started and the last load finished, to time the background loading as a whole
+        self._first_preload = None
+        self._last_load = None
+
+        self._lock = threading.Lock()
+        self._executor = None
+        # (kind, name) -> Future of an asset that is loading in the background
+        self._pending = {}
+        # (kind, name) -> the loaded asset
+        self._loaded = {}
+        # (name, alpha) -> image converted to the display format
+        self._converted = {}
+
+    @contextmanager
+    def timed(self, step):
+        """Times the code inside of the with block as a step of startup"""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.timings[step] = (self.clock() - start) * 1000
+
+    def mark(self, step):
+        """Notes how long after startup step happened. Only the first time is kept"""
+        if step not in self.marks:
+            self.marks[step] = (self.clock() - self.start_time) * 1000
+
+    @property
+    def loading(self):
+        """True while any preloaded asset is still loading"""
+        return any(not future.done() for future in self._pending.values())
+
+    def wait(self):
+        """Waits for every preloaded asset to finish loading"""
+        for future in list(self._pending.values()):
+            future.result()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    # ------------------------------------------ Loading ----------------------------------------------------------
+
+    def file(self, name):
+        """Returns what pygame should load the file called name (like 'Airstream.ttf') from: a file-like view of it in
+        the asset pack if it is packed, otherwise its path"""
+        if self.pack is not None and name in self.pack:
+            return self.pack.open(name)
+        return os.path.join(self.directory, *name.split('/'))
+
+    def _load(self, key):
+        """Loads one asset (on whatever thread this is called from) and records how long it took"""
+        kind, name = key
+        start = self.clock()
+        if kind == 'sound':
+            asset = pygame.mixer.Sound(self.file(name + '.ogg'))
+        else:
+            # File-like views don't have a file extension for pygame to tell the image's format from
+            asset = pygame.image.load(self.file(name), name)
+        end = self.clock()
+        with self._lock:
+            self.load_times[kind + ' ' + name] = (end - start) * 1000
+            self._last_load = end if self._last_load is None else max(self._last_load, end)
+        return asset
+
+    def _preload(self, keys):
+        for key in keys:
+            if key in self._loaded or key in self._pending:
+                continue
+            if self._first_preload is None:
+                self._first_preload = self.clock()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='assets')
+            self._pending[key] = self._executor.submit(self._load, key)
+
+    def _get(self, key):
+        if key not in self._loaded:
+            future = self._pending.pop(key, None)
+            self._loaded[key] = future.result() if future is not None else self._load(key)
+        return self._loaded[key]
+
+    def preload_sounds(self, names):
+        """Starts loading sounds in the background. The mixer needs to be running"""
+        self._preload(('sound', name) for name in names)
+
+    def preload_images(self, names):
+        """Starts loading images in the background"""
+        self._preload(('image', name) for name in names)
+
+    def sound(self, name):
+        """Returns the pygame Sound called name, waiting for it if it is still loading"""
+        return self._get(('sound', name))
+
+    def image(self, name, alpha=False):
+        """Returns the image called name, waiting for it if it is still loading. Once the window is open, the image is
+        converted to the display's pixel format (keeping its transparency if alpha is True), only the first time"""
+        if (name, alpha) in self._converted:
+            return self._converted[(name, alpha)]
+        image = self._get(('image', name))
+        if pygame.display.get_surface() is None:
+            # Nothing to convert to yet
+            return image
+        self._converted[(name, alpha)] = image.convert_alpha() if alpha else image.convert()
+        return self._converted[(name, alpha)]
+
+    def report(self):
+        """Returns the startup timing breakdown as a string"""
+        lines = ['Startup times (ms):']
+        lines += ['  %-20s %8.1f' % (step, duration) for step, duration in self.timings.items()]
+        lines += ['  %-20s %8.1f after start' % (step, at) for step, at in self.marks.items()]
+        with self._lock:
+            load_times = list(self.load_times.items())
+            last_load = self._last_load
+        if load_times:
+            if self._first_preload is not None and last_load is not None:
+                lines.append('  %-20s %8.1f from the first preload to the last asset' %
+                             ('background loading', max(last_load - self._first_preload, 0) * 1000))
+            lines.append('  %-20s %8.1f when added up, for %d assets' %
+                         ('asset loading', sum(duration for _, duration in load_times), len(load_times)))
+            slowest = sorted(load_times, key=lambda item: -item[1])[:3]
+            lines.append('  slowest: ' + ', '.join('%s %.1f' % item for item in slowest))
+        return '\n'.join(lines)
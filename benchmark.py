@@ -0,0 +1,260 @@
+"""Benchmarks for flyinginspace, bouncinginspace and pymunkarrows.
+
+Every scenario builds its world with the games' own code from a fixed seed, so two runs of the same scenario simulate
+exactly the same thing. Each one runs without a window for a fixed number of physics steps in its own process (so
+the scenarios can't slow each other down or share memory), and reports:
+    steps_per_sec - physics steps per second, including the game logic that runs every step
+    frame_ms_p50, frame_ms_p99 - median and 99th percentile time of one step, in milliseconds
+    peak_rss_mb - most memory the process used (not available on Windows)
+
+Usage:
+    python benchmark.py                             run every scenario and print the results
+    python benchmark.py --output baseline.json      also save the results as JSON
+    python benchmark.py --compare baseline.json     show how much each result changed since a saved run
+    python benchmark.py --only bouncing --steps 300 run just the scenarios with "bouncing" in their name
+    python benchmark.py --planets 200 --stars 3000  replace the flyinginspace scenarios with one of this size
+                                                    (--bodies and --arrows do the same for the other two)
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+import numpy as np
+
+# Every scenario: name -> (kind of scenario, settings for it). See SCENARIO_BUILDERS
+DEFAULT_SCENARIOS = OrderedDict([
+    ('flyinginspace-100-planets-1000-stars', ('flying', {'num_planets': 100, 'num_stars': 1000})),
+    ('flyinginspace-300-planets-5000-stars', ('flying', {'num_planets': 300, 'num_stars': 5000})),
+    ('flyinginspace-sectors-100-planets-1000-stars', ('flying', {'num_planets': 100, 'num_stars': 1000,
+                                                                 'sector_size': 512})),
+    ('bouncinginspace-gravity-100', ('bouncing', {'num_bodies': 100})),
+    ('bouncinginspace-gravity-500', ('bouncing', {'num_bodies': 500})),
+    # Below the crossover, so Barnes-Hut is expected to lose to the exact engine here (see
+    # bouncinginspace.use_barnes_hut)
+    ('bouncinginspace-barnes-hut-500', ('bouncing', {'num_bodies': 500, 'barnes_hut': True})),
+    ('pymunkarrows-volley-50', ('arrows', {'num_arrows': 50})),
+    ('pymunkarrows-volley-200', ('arrows', {'num_arrows': 200})),
+])
+METRICS = ['steps_per_sec', 'frame_ms_p50', 'frame_ms_p99', 'peak_rss_mb']
+# For these metrics, smaller numbers are better
+LOWER_IS_BETTER = {'frame_ms_p50', 'frame_ms_p99', 'peak_rss_mb'}
+
+
+# ------------------------------------------ Scenarios ---------------------------------------------------------------
+# Each of these builds a world and returns a function that runs one physics step of it, given the step number
+
+
+def flying_scenario(num_planets, num_stars, sector_size=None):
+    """flyinginspace flown by the autopilot. Fuel, ammunition and health are topped up every step, so the game
+    doesn't end partway through the benchmark. sector_size streams the world in sectors"""
+    import flyinginspace
+    flyinginspace.SOUNDS = flyinginspace.SoundBank(preload=False)
+    game = flyinginspace.Game(num_planets, num_stars, sector_size=sector_size)
+    game.start()
+
+    def step(tick):
+        game.rocket_fuel = game.ammunition = flyinginspace.player_health = 100
+        game.update(flyinginspace.autopilot(tick))
+        game.step()
+    return step
+
+
+def bouncing_scenario(num_bodies, barnes_hut=False):
+    """bouncinginspace with gravity turned on"""
+    import bouncinginspace
+    space, ball_body, planets = bouncinginspace.create_world(num_bodies)
+    grav_const = 200 / num_bodies
+    if barnes_hut:
+        gravity_engine = bouncinginspace.BarnesHutGravityEngine(planets, theta=bouncinginspace.barnes_hut_theta)
+    else:
+        gravity_engine = bouncinginspace.GravityEngine(planets)
+
+    def step(tick):
+        gravity_engine.step(grav_const)
+        space.step(1 / 60)
+    return step
+
+
+def arrows_scenario(num_arrows, arrows_per_step=4):
+    """pymunkarrows with a volley of arrows fired from the cannon, a few every step (arrows fired at the same time
+    are spread out in a fan, so they don't start on top of each other)"""
+    import pymunkarrows
+    from pymunk.vec2d import Vec2d
+    space, cannon_body, cannon_shape, flying_arrows = pymunkarrows.create_world()
+    # Aim and power of every arrow, picked ahead of time
+    volley = [(random.uniform(0.2, 0.6), random.uniform(600, 1500)) for _ in range(num_arrows)]
+
+    def step(tick):
+        for i, (angle, power) in enumerate(volley[tick * arrows_per_step:(tick + 1) * arrows_per_step]):
+            arrow_body, arrow_shape = pymunkarrows.create_arrow()
+            arrow_body.angle = angle + i * 0.25
+            arrow_body.position = cannon_body.position + Vec2d(cannon_shape.radius + 40, 0).rotated(arrow_body.angle)
+            space.add(arrow_shape)
+            pymunkarrows.fire_arrow(space, arrow_body, power, flying_arrows)
+        pymunkarrows.apply_arrow_drag(flying_arrows)
+        space.step(1 / 60)
+    return step
+
+
+SCENARIO_BUILDERS = {'flying': flying_scenario, 'bouncing': bouncing_scenario, 'arrows': arrows_scenario}
+
+
+# ------------------------------------------ Running ----------------------------------------------------------------
+
+
+def peak_memory_mb():
+    """Returns the most memory this process has used so far, in megabytes, or None if it can't be measured"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_scenario(kind, settings, steps, warmup, seed):
+    """Builds one scenario from seed and times "steps" steps of it, after "warmup" steps that aren't timed.
+    Returns a dictionary of results"""
+    random.seed(seed)
+    np.random.seed(seed)
+    step = SCENARIO_BUILDERS[kind](**settings)
+    for tick in range(warmup):
+        step(tick)
+
+    step_times = np.empty(steps)
+    clock = time.perf_counter
+    start = clock()
+    for i in range(steps):
+        step_start = clock()
+        step(warmup + i)
+        step_times[i] = clock() - step_start
+    elapsed = clock() - start
+
+    return OrderedDict([
+        ('kind', kind),
+        ('settings', settings),
+        ('steps', steps),
+        ('seconds', round(elapsed, 4)),
+        ('steps_per_sec', round(steps / elapsed, 1)),
+        ('frame_ms_p50', round(float(np.percentile(step_times, 50)) * 1000, 4)),
+        ('frame_ms_p99', round(float(np.percentile(step_times, 99)) * 1000, 4)),
+        ('peak_rss_mb', peak_memory_mb()),
+    ])
+
+
+def run_in_own_process(kind, settings, steps, warmup, seed):
+    """Runs a scenario in a brand new Python process, so nothing is left over from earlier scenarios"""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+        return executor.submit(run_scenario, kind, settings, steps, warmup, seed).result()
+
+
+def environment():
+    """Information about the computer and library versions, saved with the results since they affect the numbers"""
+    import pygame
+    import pymunk
+    return OrderedDict([
+        ('python', platform.python_version()),
+        ('platform', platform.platform()),
+        ('processor', platform.processor() or platform.machine()),
+        ('pygame', pygame.version.ver),
+        ('pymunk', pymunk.version),
+        ('numpy', np.__version__),
+    ])
+
+
+def compare(results, baseline):
+    """Prints how much each metric changed from the baseline, for scenarios that are in both"""
+    print()
+    print('Compared to baseline:')
+    for name, result in results['scenarios'].items():
+        if name not in baseline['scenarios']:
+            print('  ' + name + ': not in baseline')
+            continue
+        old = baseline['scenarios'][name]
+        changes = []
+        for metric in METRICS:
+            if result.get(metric) is None or not old.get(metric):
+                continue
+            change = (result[metric] - old[metric]) / old[metric] * 100
+            better = change < 0 if metric in LOWER_IS_BETTER else change > 0
+            changes.append('%s %+.1f%%%s' % (metric, change, '' if abs(change) < 5 else
+                                             (' (better)' if better else ' (worse)')))
+        print('  ' + name + ': ' + ', '.join(changes))
+    if baseline.get('steps') != results['steps'] or baseline.get('seed') != results['seed']:
+        print('  Note: the baseline was run with different steps or seed, so the numbers may not be comparable')
+
+
+def select_scenarios(arguments):
+    scenarios = OrderedDict(DEFAULT_SCENARIOS)
+    custom = OrderedDict()
+    if arguments.planets is not None or arguments.stars is not None:
+        settings = {'num_planets': arguments.planets or 100, 'num_stars': arguments.stars or 1000}
+        custom['flying'] = ('flyinginspace-%d-planets-%d-stars' % (settings['num_planets'], settings['num_stars']),
+                            settings)
+    if arguments.bodies is not None:
+        custom['bouncing'] = ('bouncinginspace-gravity-%d' % arguments.bodies, {'num_bodies': arguments.bodies})
+    if arguments.arrows is not None:
+        custom['arrows'] = ('pymunkarrows-volley-%d' % arguments.arrows, {'num_arrows': arguments.arrows})
+    for kind, (name, settings) in custom.items():
+        scenarios = OrderedDict((key, value) for key, value in scenarios.items() if value[0] != kind)
+        scenarios[name] = (kind, settings)
+
+    if arguments.only:
+        scenarios = OrderedDict((name, scenario) for name, scenario in scenarios.items() if arguments.only in name)
+    return scenarios
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run seeded, headless benchmarks of the games')
+    parser.add_argument('--steps', type=int, default=1200, help='timed physics steps per scenario')
+    parser.add_argument('--warmup', type=int, default=60, help='untimed steps before timing starts')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--only', help='only run scenarios whose name contains this')
+    parser.add_argument('--planets', type=int)
+    parser.add_argument('--stars', type=int)
+    parser.add_argument('--bodies', type=int)
+    parser.add_argument('--arrows', type=int)
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON file from an earlier --output to compare against')
+    arguments = parser.parse_args()
+
+    # The games load their resources relative to the project folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+    results = OrderedDict([
+        ('seed', arguments.seed),
+        ('steps', arguments.steps),
+        ('warmup', arguments.warmup),
+        ('environment', environment()),
+        ('scenarios', OrderedDict()),
+    ])
+    print('%-46s %10s %10s %10s %10s' % ('scenario', 'steps/sec', 'p50 ms', 'p99 ms', 'peak MB'))
+    for name, (kind, settings) in select_scenarios(arguments).items():
+        result = run_in_own_process(kind, settings, arguments.steps, arguments.warmup, arguments.seed)
+        results['scenarios'][name] = result
+        print('%-46s %10.1f %10.3f %10.3f %10s' % (name, result['steps_per_sec'], result['frame_ms_p50'],
+                                                   result['frame_ms_p99'], result['peak_rss_mb']))
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        print('Saved results to', arguments.output)
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,23 +10,45 @@ from pygame.locals import *
 
 import random
 import math
+import time
+
+import numpy as np
 
 import pymunk
 from pymunk.vec2d import Vec2d
 from pymunk import pygame_util
 
+from assets import AssetManager
+from gameloop import FixedTimestep, PhysicsThread
+from textcache import Hud, sys_font
+
 width, height = 700, 700
-marble_img:Surface = pygame.image.load('resources/marble.png')
+# Loads the images and sounds (the first time they are needed, or in the background once main() preloads them), and
+# times each step of startup
+ASSETS = AssetManager()
 
 # Collision types
 BALL = 0
 PLANET = 1
-click_sound = None
 
 # How many planets to create - for higher planet quantities the gravitational
 # constant will be set to a lower default value
 num_planets = 30
 
+# Barnes-Hut gravity approximates far away groups of planets as a single mass. It only pays off for large planet
+# quantities: with theta 0.5 it was measured slower than the exact GravityEngine below about 1000 planets (9.3 ms vs
+# 7.5 ms a step at 500) and faster above that (53 ms vs 128 ms at 2000). Its impulses are off by 1-2% on average, but
+# a planet whose pulls nearly cancel out can be off by much more (the worst planet was off by 17% at 1000 planets,
+# and by more than 100% at 2000). True or False picks the engine, None uses Barnes-Hut only for at least
+# BARNES_HUT_MIN_PLANETS planets. theta is the opening angle: 0 is exact, larger values are faster but less accurate
+use_barnes_hut = None
+BARNES_HUT_MIN_PLANETS = 1200
+barnes_hut_theta = 0.5
+
+# Run the physics on its own thread, so it can happen at the same time as drawing (see gameloop.PhysicsThread). Can
+# also be turned on with "python bouncinginspace.py --threaded"
+threaded_physics = False
+
 
 # Function for creating a "planet" it takes several arguments, and colors it a random shade of green
 def create_planet(space: pymunk.Space, radius_in, mass_in, position):
@@ -46,47 +68,210 @@ def create_planet(space: pymunk.Space, radius_in, mass_in, position):
 def run_gravity(body_1: pymunk.Body, body_2: pymunk.Body, g):
     """Function that can be called to apply gravitational impulses between two bodies.
     g is the gravitational constant"""
-    distance = 2 * math.sqrt((body_1.position[0] - body_2.position[0]) ** 2 + (body_1.position[1] - body_2.position[0]) ** 2)
+    distance = 2 * math.sqrt((body_1.position[0] - body_2.position[0]) ** 2 + (body_1.position[1] - body_2.position[1]) ** 2)
     force = body_1.mass * body_2.mass / (distance ** 2) * g
     impulse = Vec2d(force, 0)
     impulse = impulse.rotated((body_1.position - body_2.position).angle)
     if distance >= 5:
-        body_1.apply_impulse_at_world_point(impulse.rotated(math.pi), body_2.position)
+        body_1.apply_impulse_at_world_point(impulse.rotated(math.pi), body_1.position)
         body_2.apply_impulse_at_world_point(impulse, body_2.position)
 
 
+class GravityEngine:
+    """Class that applies gravity between every pair of bodies in one go. Instead of calling run_gravity for each pair,
+    the positions and masses of all the bodies are read into numpy arrays and the impulses are calculated with
+    broadcasting.
+
+    Distances are doubled like they are in run_gravity, so the same gravitational constant gives the same strength.
+    softening is a length that keeps the impulse finite when two bodies get very close, instead of the
+    "distance >= 5" cutoff in run_gravity"""
+    def __init__(self, bodies, softening=5):
+        self.bodies = list(bodies)
+        self.softening = softening
+        # Planet masses never change, so they only need read once
+        self.masses = np.array([body.mass for body in self.bodies], dtype=np.float64)
+
+    def read_positions(self):
+        """Returns an (n, 2) array of the current body positions"""
+        return np.array([tuple(body.position) for body in self.bodies], dtype=np.float64)
+
+    def impulses(self, g, positions=None):
+        """Returns an (n, 2) array of the gravitational impulse on each body. g is the gravitational constant"""
+        if positions is None:
+            positions = self.read_positions()
+        x, y = positions[:, 0], positions[:, 1]
+        # (dx[i, j], dy[i, j]) points from body i to body j
+        dx = 2 * (x[np.newaxis, :] - x[:, np.newaxis])
+        dy = 2 * (y[np.newaxis, :] - y[:, np.newaxis])
+        distance_squared = dx * dx + dy * dy + self.softening ** 2
+        strength = self.masses[np.newaxis, :] / (distance_squared * np.sqrt(distance_squared))
+        np.fill_diagonal(strength, 0)
+        acceleration = np.column_stack(((strength * dx).sum(axis=1), (strength * dy).sum(axis=1)))
+        return g * acceleration * self.masses[:, np.newaxis]
+
+    def step(self, g):
+        """Apply one frame of gravity to every body"""
+        for body, impulse in zip(self.bodies, self.impulses(g).tolist()):
+            body.apply_impulse_at_world_point(impulse, body.position)
+
+
+class QuadTree:
+    """Quadtree over a set of point masses, used for Barnes-Hut gravity. The tree is rebuilt from scratch every step.
+
+    Every body gets a Morton code (the bits of its x and y cell numbers interleaved), so after sorting the codes each
+    node of the tree is a run of bodies that share a code prefix. This lets each level of the tree be built with a few
+    numpy operations instead of inserting bodies one at a time.
+
+    Each level of the tree has its own arrays:
+        keys - code prefix of each node, in sorted order
+        mass, center_of_mass - total mass of each node and where its center of mass is
+        leaf - True for nodes that are not split any further
+    sizes[level] is the width of every node on that level"""
+    def __init__(self, positions, masses, max_depth=16):
+        self.max_depth = max_depth
+        count = len(positions)
+
+        # Fit a square around all of the bodies
+        origin = positions.min(axis=0)
+        width = max((positions.max(axis=0) - origin).max(), 1) * (1 + 1e-9)
+        cells = 2 ** max_depth
+        cell_x = np.clip(((positions[:, 0] - origin[0]) / width * cells).astype(np.int64), 0, cells - 1)
+        cell_y = np.clip(((positions[:, 1] - origin[1]) / width * cells).astype(np.int64), 0, cells - 1)
+        self.codes = np.zeros(count, dtype=np.int64)
+        for bit in range(max_depth):
+            self.codes |= ((cell_x >> bit) & 1) << (2 * bit)
+            self.codes |= ((cell_y >> bit) & 1) << (2 * bit + 1)
+
+        order = np.argsort(self.codes, kind='stable')
+        sorted_codes = self.codes[order]
+        sorted_masses = masses[order]
+        sorted_moments = positions[order] * sorted_masses[:, np.newaxis]
+
+        self.sizes = [width / 2 ** level for level in range(max_depth + 1)]
+        self.keys, self.mass, self.center_of_mass, self.leaf = [], [], [], []
+        # Only bodies that shared a node with another body on the level above need split any further
+        active = np.arange(count)
+        for level in range(max_depth + 1):
+            if len(active) == 0:
+                for node_list in (self.keys, self.mass, self.center_of_mass, self.leaf):
+                    node_list.append(np.zeros(0))
+                continue
+            level_codes = sorted_codes[active] >> (2 * (max_depth - level))
+            starts = np.concatenate(([0], np.flatnonzero(np.diff(level_codes)) + 1))
+            body_counts = np.diff(np.append(starts, len(active)))
+            node_mass = np.add.reduceat(sorted_masses[active], starts)
+            node_moment = np.add.reduceat(sorted_moments[active], starts, axis=0)
+
+            self.keys.append(level_codes[starts])
+            self.mass.append(node_mass)
+            self.center_of_mass.append(node_moment / node_mass[:, np.newaxis])
+            self.leaf.append((body_counts == 1) | (level == max_depth))
+            active = active[np.repeat(body_counts > 1, body_counts)]
+
+    def children(self, level, nodes):
+        """Returns the (first, last + 1) range of the children of "nodes" in the arrays for level + 1"""
+        child_keys = self.keys[level + 1]
+        first = np.searchsorted(child_keys, self.keys[level][nodes] * 4)
+        last = np.searchsorted(child_keys, self.keys[level][nodes] * 4 + 4)
+        return first, last
+
+
+class BarnesHutGravityEngine(GravityEngine):
+    """Gravity engine that uses a Barnes-Hut quadtree instead of looking at every pair of bodies. Any node of the tree
+    that looks small enough from a body (node width / distance < theta) is treated as one big mass at its center of
+    mass, which takes the work from O(n^2) down to O(n log n). Walking the tree costs more per body than the exact
+    sum does, so it is only faster for more than about 1000 bodies, and it is less accurate (see use_barnes_hut).
+
+    The tree walk is done for every body at once: each level keeps a list of (body, node) pairs, the pairs that are
+    accepted add their impulse, and the rest are replaced by the node's children on the next level."""
+    def __init__(self, bodies, softening=5, theta=0.5, max_depth=16):
+        super().__init__(bodies, softening)
+        self.theta = theta
+        self.max_depth = max_depth
+
+    def impulses(self, g, positions=None):
+        if positions is None:
+            positions = self.read_positions()
+        count = len(positions)
+        tree = QuadTree(positions, self.masses, self.max_depth)
+        acceleration_x = np.zeros(count)
+        acceleration_y = np.zeros(count)
+
+        body = np.arange(count)
+        node = np.zeros(count, dtype=np.int64)
+        for level in range(self.max_depth + 1):
+            if len(body) == 0:
+                break
+            offset = tree.center_of_mass[level][node] - positions[body]
+            distance = np.sqrt((offset ** 2).sum(axis=1))
+            # A body is never far enough away from a node that contains it
+            contains = (tree.codes[body] >> (2 * (self.max_depth - level))) == tree.keys[level][node]
+            accept = tree.leaf[level][node] | ((tree.sizes[level] < self.theta * distance) & ~contains)
+
+            # Same formula as GravityEngine, with the node's mass in place of a single body
+            separation = 2 * offset[accept]
+            distance_squared = (separation ** 2).sum(axis=1) + self.softening ** 2
+            strength = tree.mass[level][node[accept]] / (distance_squared * np.sqrt(distance_squared))
+            acceleration_x += np.bincount(body[accept], strength * separation[:, 0], minlength=count)
+            acceleration_y += np.bincount(body[accept], strength * separation[:, 1], minlength=count)
+
+            # Open up every node that was too close, and look at its children on the next level
+            body, node = body[~accept], node[~accept]
+            if len(body) == 0:
+                break
+            first, last = tree.children(level, node)
+            child_counts = last - first
+            body = np.repeat(body, child_counts)
+            run_starts = np.repeat(np.cumsum(child_counts) - child_counts, child_counts)
+            node = np.repeat(first, child_counts) + np.arange(len(body)) - run_starts
+
+        acceleration = np.column_stack((acceleration_x, acceleration_y))
+        return g * acceleration * self.masses[:, np.newaxis]
+
+    def compare_to_exact(self, g=1):
+        """Compares the Barnes-Hut impulses against the exact pairwise result for the current positions.
+        Returns a dictionary with the mean and max relative error of the impulses, and how long each method took
+        in milliseconds"""
+        positions = self.read_positions()
+        start = time.perf_counter()
+        exact = GravityEngine.impulses(self, g, positions)
+        exact_time = time.perf_counter() - start
+        start = time.perf_counter()
+        approximate = self.impulses(g, positions)
+        approximate_time = time.perf_counter() - start
+
+        exact_length = np.sqrt((exact ** 2).sum(axis=1))
+        error_length = np.sqrt(((approximate - exact) ** 2).sum(axis=1))
+        relative_error = error_length / np.maximum(exact_length, 1e-12)
+        return {'theta': self.theta,
+                'bodies': len(positions),
+                'mean_error': float(relative_error.mean()),
+                'max_error': float(relative_error.max()),
+                'exact_ms': exact_time * 1000,
+                'barnes_hut_ms': approximate_time * 1000}
+
+
 # Collision handler setup
 def planet_collision(arbiter, space, data):
     """Function to be called upon a collision between two planets. Should play a sound"""
     # TODO: Allow more sounds to play
     pass
     # pygame.mixer.Channel(0).stop()
-    # pygame.mixer.Channel(0).play(click_sound)
-
+    # pygame.mixer.Channel(0).play(ASSETS.sound('click'))
 
-# Game start
-def main():
-    # Start up the game
-    pygame.init()
-    screen: Surface = pygame.display.set_mode((width, height))
-    clock = pygame.time.Clock()
-    running = True
 
+def create_world(planet_count=num_planets, world_width=width, world_height=height):
+    """Creates the space with the ball, the planets and the walls around them. Returns the space, the ball's body and
+    the list of planet bodies"""
     space = pymunk.Space()
 
     # This gravity would be if we wanted to have every object move in one direction, not towards each other
     space.gravity = (0, 0)
 
-    # Allow pymunk to draw to pygame screen
-    draw_options = pygame_util.DrawOptions(screen)
-
-    # Sound to play when planets collide
-    global click_sound
-    click_sound = pygame.mixer.Sound('resources/click.ogg')
-
     # Initialize physical objects ---------------------------------------------------------------------------
 
-    # Ball
+    # Ball, as big as the marble image
+    marble_img: Surface = ASSETS.image('marble.png', alpha=True)
     ball_body = pymunk.Body(mass=1000, moment=pymunk.moment_for_circle(1000, 0, marble_img.get_width()/2))
     ball_shape = pymunk.Circle(ball_body, marble_img.get_width()/2)
     ball_shape.friction = 0.5
@@ -100,37 +285,123 @@ def main():
 
     # Planets
     planets = []
-    for i in range(num_planets):
+    for i in range(planet_count):
         size = random.randint(10, 15)
-        planet_body, planet_shape = create_planet(space, size, math.pi * size ** 2, (random.randint(15, screen.get_width() - 15), random.randint(15, screen.get_height() - 15)))
+        planet_body, planet_shape = create_planet(space, size, math.pi * size ** 2, (random.randint(15, world_width - 15), random.randint(15, world_height - 15)))
         space.add(planet_shape)
         space.add(planet_body)
         planets.append(planet_body)
 
+    # Walls
+    walls = [pymunk.Segment(space.static_body, (0, 0),                      (0, world_width), 2),
+             pymunk.Segment(space.static_body, (0, world_width),            (world_height, world_width), 2),
+             pymunk.Segment(space.static_body, (world_height, world_width), (world_height, 0), 2),
+             pymunk.Segment(space.static_body, (world_height, 0),           (0, 0), 2),
+             ]
+    for wall in walls:
+        wall.friction = 0.1
+        wall.elasticity = 0.999
+    space.add(walls)
+
+    ball_body.position = (300, 400)
+    return space, ball_body, planets
+
+
+def draw_bodies(screen: Surface, shapes, state, walls=()):
+    """Draws each circle shape at the x, y and angle in the same row of state, looking like space.debug_draw does.
+    Used when the physics runs on its own thread, since the bodies themselves can't be read while it steps"""
+    screen_height = screen.get_height()
+    for wall in walls:
+        start = (int(wall.a[0]), int(screen_height - wall.a[1]))
+        end = (int(wall.b[0]), int(screen_height - wall.b[1]))
+        pygame.draw.line(screen, color.THECOLORS['lightgray'], start, end, max(int(wall.radius * 2), 1))
+    for shape, (x, y, angle) in zip(shapes, state.tolist()):
+        center = (int(x), int(screen_height - y))
+        radius = int(shape.radius)
+        pygame.draw.circle(screen, shape.color, center, radius)
+        # Line from the middle to the edge, so the spin can be seen
+        edge = (int(x + math.cos(angle) * radius), int(screen_height - y - math.sin(angle) * radius))
+        pygame.draw.line(screen, color.THECOLORS['gray20'], center, edge)
+
+
+# Game start
+def main():
+    # Start up the game
+    with ASSETS.timed('pygame.init'):
+        pygame.init()
+    with ASSETS.timed('window'):
+        screen: Surface = pygame.display.set_mode((width, height))
+    clock = pygame.time.Clock()
+    running = True
+
+    # Sound to play when planets collide, loaded in the background
+    ASSETS.preload_sounds(['click'])
+    ASSETS.mark('preload started')
+
+    with ASSETS.timed('world'):
+        space, ball_body, planets = create_world(num_planets, screen.get_width(), screen.get_height())
+
+    # Allow pymunk to draw to pygame screen
+    draw_options = pygame_util.DrawOptions(screen)
+
     # Set gravitational constant for planets - more planets means lower starting constant
     grav_const = 200 / num_planets
     gravity_enabled = False
+    if use_barnes_hut or (use_barnes_hut is None and len(planets) >= BARNES_HUT_MIN_PLANETS):
+        gravity_engine = BarnesHutGravityEngine(planets, theta=barnes_hut_theta)
+    else:
+        gravity_engine = GravityEngine(planets)
 
     # Set up collision sounds between planets (see planet_collision)
     # handler = space.add_collision_handler(PLANET, PLANET)
     # handler.post_solve = planet_collision
 
-    # Walls
-    walls = [pymunk.Segment(space.static_body, (0, 0),                                    (0, screen.get_width()), 2),
-             pymunk.Segment(space.static_body, (0, screen.get_width()),                   (screen.get_height(), screen.get_width()), 2),
-             pymunk.Segment(space.static_body, (screen.get_height(), screen.get_width()), (screen.get_height(), 0), 2),
-             pymunk.Segment(space.static_body, (screen.get_height(), 0),                  (0, 0), 2),
-             ]
-    for wall in walls:
-        wall.friction = 0.1
-        wall.elasticity = 0.999
-    space.add(walls)
-
     music_started = True
-    pygame.mixer.music.load('resources/moon.ogg')
-    pygame.mixer.music.play(-1, 0.0)
+    with ASSETS.timed('music'):
+        pygame.mixer.music.load(ASSETS.file('moon.ogg'))
+        pygame.mixer.music.play(-1, 0.0)
 
-    ball_body.position = (300, 400)
+    def physics_step(dt):
+        if gravity_enabled:
+            gravity_engine.step(grav_const)
+        space.step(dt)
+
+    def fire_ball(mouse_position):
+        mouse_angle = (mouse_position - ball_body.position).angle
+        impulse = ball_body.mass * 1000 * Vec2d(1, 0)
+        impulse.rotate(mouse_angle)
+        ball_body.apply_impulse_at_world_point(impulse, ball_body.position)
+
+    def print_accuracy():
+        print("Barnes-Hut accuracy:", gravity_engine.compare_to_exact(grav_const))
+
+    # Physics runs 60 times a second no matter how fast the screen is drawn, either on this thread (physics) or on
+    # its own (physics_thread)
+    max_fps = 144
+    physics = physics_thread = None
+    if threaded_physics:
+        # Everything that touches the space goes through physics_thread.call from here on
+        bodies = [ball_body] + planets
+        shapes = [next(iter(body.shapes)) for body in bodies]
+        walls = list(space.static_body.shapes)
+        physics_thread = PhysicsThread(physics_step, bodies, 60)
+        physics_thread.start()
+    else:
+        physics = FixedTimestep(space, 60)
+
+    # Text on screen. Each line is only rendered again when it changes
+    with ASSETS.timed('fonts'):
+        font = sys_font("Arial", 13)
+    hud = Hud()
+    hud.add('click', font, color.THECOLORS["white"], "Click anywhere to fire the red ball towards the mouse", topleft=(5, 5))
+    hud.add('keys', font, color.THECOLORS["white"], "Press up or down to change the strength of gravity, space to enable/disable", topleft=(5, 20))
+    hud.add('strength_label', font, color.THECOLORS["white"], "Gravitational Strength:", topleft=(5, 40))
+    hud.add('strength', font, color.THECOLORS["yellow"], topleft=(115, 40))
+    hud.add('gravity_label', font, color.THECOLORS["white"], "Gravity:", topleft=(5, 55))
+    hud.add('gravity', font, color.THECOLORS["white"], topleft=(45, 55))
+
+    # Startup times are printed once the click sound has finished loading
+    startup_reported = False
 
     # Main game loop ----------------------------------------------------------------------------------------
     while running:
@@ -143,14 +414,14 @@ def main():
                 print(pygame.mouse.get_pos())
                 if not music_started:
                     # Background Music
-                    pygame.mixer.music.load('resources/moon.ogg')
+                    pygame.mixer.music.load(ASSETS.file('moon.ogg'))
                     pygame.mixer.music.play(-1, 0.0)
                     music_started = True
                 mouse_position = pymunk.pygame_util.from_pygame(Vec2d(pygame.mouse.get_pos()), screen)
-                mouse_angle = (mouse_position - ball_body.position).angle
-                impulse = ball_body.mass * 1000 * Vec2d(1, 0)
-                impulse.rotate(mouse_angle)
-                ball_body.apply_impulse_at_world_point(impulse, ball_body.position)
+                if physics_thread is None:
+                    fire_ball(mouse_position)
+                else:
+                    physics_thread.call(fire_ball, mouse_position)
 
             if event.type == KEYDOWN:
                 # If up or down is pressed, change the gravitational constant by a factor of 10
@@ -165,43 +436,55 @@ def main():
                 if event.key == K_SPACE:
                     gravity_enabled = not gravity_enabled
 
-        if gravity_enabled:
-            for i, planet_1 in enumerate(planets):
-                # run_gravity(planet_1, ball_body, grav_const)
-                for planet_2 in planets[i+1:]:
-                    run_gravity(planet_1, planet_2, grav_const)
+                # Print how far Barnes-Hut gravity is from the exact result with c
+                if event.key == K_c and isinstance(gravity_engine, BarnesHutGravityEngine):
+                    if physics_thread is None:
+                        print_accuracy()
+                    else:
+                        physics_thread.call(print_accuracy)
+
+        # Physics ---------------------------------------------------------------------------
+        # With threaded physics, the physics thread is already stepping the space on its own
+        if physics_thread is None:
+            for dt in physics.steps():
+                physics_step(dt)
 
         # Graphics ---------------------------------------------------------------------------
 
         # Clear Screen
         screen.fill(pygame.color.THECOLORS['black'])
 
-        # Use pygame interactivity to draw pymunk stuff
-        space.debug_draw(draw_options)
+        # Use pygame interactivity to draw pymunk stuff, in between the last two physics steps
+        if physics_thread is None:
+            with physics.interpolated():
+                space.debug_draw(draw_options)
+        else:
+            draw_bodies(screen, shapes, physics_thread.snapshot(), walls)
 
         # Draw the rest of the stuff
-        # screen.blit(pygame.transform.rotate(marble_img, ball_body.rotation_vector.angle_degrees), (ball_body.position[0] - ball_shape.radius, screen.get_height() - ball_body.position[1] - ball_shape.radius))
-        font = pygame.font.SysFont("Arial", 13)
+        # screen.blit(pygame.transform.rotate(ASSETS.image('marble.png', alpha=True), ball_body.rotation_vector.angle_degrees), (ball_body.position[0] - ball_shape.radius, screen.get_height() - ball_body.position[1] - ball_shape.radius))
         # pygame.draw.rect(screen, color.THECOLORS['gray'], Rect(0, 0, 260, 60), 0)
-        screen.blit(font.render("Click anywhere to fire the red ball towards the mouse", 1, color.THECOLORS["white"]), (5, 5))
-        screen.blit(font.render("Press up or down to change the strength of gravity, space to enable/disable", 1, color.THECOLORS["white"]), (5, 20))
-        screen.blit(font.render("Gravitational Strength:", 1, color.THECOLORS["white"]), (5, 40))
-        screen.blit(font.render(str(round(grav_const, 3)), 1, color.THECOLORS["yellow"]), (115, 40))
-
+        hud.set('strength', str(round(grav_const, 3)))
         gravity_color, gravity_text = (color.THECOLORS['green'], 'Enabled') if gravity_enabled else (color.THECOLORS['red'], 'Disabled')
-        screen.blit(font.render("Gravity:", 1, color.THECOLORS["white"]), (5, 55))
-        screen.blit(font.render(gravity_text, 1, gravity_color), (45, 55))
+        hud.set('gravity', gravity_text, gravity_color)
+        hud.draw(screen)
 
         # Update the screen
         pygame.display.flip()
+        ASSETS.mark('first frame')
+        if not startup_reported and not ASSETS.loading:
+            ASSETS.mark('assets loaded')
+            print(ASSETS.report())
+            startup_reported = True
 
-        # Update physics and pygame clock
-        fps = 60
-        dt = 1. / fps
-        space.step(dt)
+        # Update pygame clock
+        clock.tick(max_fps)
 
-        clock.tick(fps)
+    if physics_thread is not None:
+        physics_thread.stop()
 
 
 if __name__ == '__main__':
+    if '--threaded' in sys.argv:
+        threaded_physics = True
     sys.exit(main())
@@ -0,0 +1,35 @@
+"""Dirty rectangle tracking for flyinginspace.
+
+pygame.display.update() with no arguments sends the whole window to the screen. When only a small part of the screen
+changed (like a button being hovered over on the menu), it is much cheaper to pass just the changed areas, and if
+nothing changed at all, the update can be skipped completely.
+"""
+import pygame
+
+
+class DirtyRects:
+    """Class that collects the areas of the screen that were drawn on during a frame (see add), and sends only those to
+    the display in update_display. Call redraw_all when the whole screen was drawn"""
+    def __init__(self):
+        self.rects = []
+        # The first frame always needs the whole screen sent
+        self.full_update = True
+
+    def add(self, *rects):
+        """Mark areas of the screen as changed. Empty rects and None are ignored"""
+        self.rects.extend(rect for rect in rects if rect)
+
+    def redraw_all(self):
+        """Mark the whole screen as changed"""
+        self.full_update = True
+
+    def update_display(self):
+        """Sends the changed parts of the screen to the display. Returns False if nothing had changed"""
+        changed = self.full_update or bool(self.rects)
+        if self.full_update:
+            pygame.display.update()
+        elif self.rects:
+            pygame.display.update(self.rects)
+        self.rects = []
+        self.full_update = False
+        return changed
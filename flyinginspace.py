@@ -4,6 +4,10 @@
 
 
 import sys
+import os
+import time
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
 
 import pygame
 from pygame import Surface
@@ -12,10 +16,23 @@ from pygame.locals import *
 import random
 import math
 
+import numpy as np
+
 import pymunk
 from pymunk.vec2d import Vec2d
 from pymunk import pygame_util
 
+from gameloop import FixedTimestep
+from textcache import Hud, load_font
+from spritecache import CircleSpriteCache
+from dirtyrects import DirtyRects
+from spatialgrid import SpatialGrid
+from frameprofiler import FrameProfiler, ProfilerOverlay
+from recording import Recording
+from snapshot import Snapshot, SnapshotRing, BODY_DTYPE, PLANET_STATE_DTYPE, LASER_STATE_DTYPE, body_states
+from assets import AssetManager, RESOURCE_DIRECTORY
+from sectors import SectorCache, PLANET_DTYPE, generate_sector, sector_of, sector_bounds, sectors_overlapping
+
 '''
 This program uses two sets of coordinates:
     - Pygame coordinates - Set of coordinates related to the window of the game. Origin is ALWAYS at the top left of the
@@ -77,7 +94,15 @@ WIN_WIDTH = 700
 WIN_HEIGHT = 600
 ACTIVE_ZONE_WIDTH = WIN_WIDTH
 FPS = 60
+# The physics always runs at FPS steps per second, but the screen can be drawn faster than that (see gameloop.py)
+MAX_RENDER_FPS = 144
+# Frame rate limit for the menu and game over screens, which barely change
+IDLE_FPS = 30
+NUM_STARS = 1000
 SPACE = pymunk.Space()
+# Where numpy's random numbers come from. This is numpy's own global generator, except inside of a WorldState, which
+# has a RandomState of its own (swapping a generator object in and out is much quicker than copying its state)
+NUMPY_RANDOM = np.random
 
 # Collision types
 PLANET = 0
@@ -86,20 +111,69 @@ LASER  = 2
 
 camera_x, camera_y = 0, WIN_HEIGHT
 
-DISPLAY_SURF: pygame.Surface = pygame.display.set_mode((WIN_WIDTH, WIN_HEIGHT))
+# The window is only opened by main(), so the game can also run without one (see run_headless)
+DISPLAY_SURF: pygame.Surface = None
 
 # Game modes
 MENU = 0
 PLAY = 1
 GAME_OVER = 2
 
-crash_sound = pygame.mixer.Sound
+# Sound effects, loaded in main() once the mixer is running (see SoundBank)
+SOUNDS = None
+# Loads the sound effects in the background and times each step of startup. main() prints the times once everything
+# has loaded
+ASSETS = AssetManager()
+EXPLOSION_SOUNDS = ['explosions/explosion' + str(i) for i in range(1, 6)]
+SOUND_EFFECTS = ['rocket_boost', 'laser', 'click_button', 'out_of_gas', 'crash', 'out_of_ammo', 'times_up'] + \
+                EXPLOSION_SOUNDS
+MUSIC_FILE = 'punch-deck-feel-the-pulse.mp3'
+FONT_FILE = 'Airstream.ttf'
+# Every file in the resources folder that the game uses, in the order they are loaded at startup. These are what
+# go in the asset pack of frozen builds (see assetpack.py)
+RESOURCE_FILES = [MUSIC_FILE] + [name + '.ogg' for name in SOUND_EFFECTS] + [FONT_FILE]
+
+# Planets and other circles are drawn from pre-rendered sprites
+SPRITES = CircleSpriteCache()
+
+# Times each phase of every frame. F3 shows the times on screen, F4 and F5 save them as CSV and JSON
+PROFILER = FrameProfiler()
+TRACE_CSV_PATH = 'frame_trace.csv'
+TRACE_JSON_PATH = 'frame_trace.json'
+
+# Snapshots of the world are captured while playing (every tick, or less often if capturing takes long, see
+# SnapshotRing), and holding backspace goes back through the last REWIND_SECONDS of them one tick at a time. F6 saves
+# the game to SAVE_GAME_PATH and F9 loads it again (see snapshot.py)
+REWIND_SECONDS = 5
+SAVE_GAME_PATH = 'savegame.snap'
 
 circle_shapes = []
 lasers = []
 planets = []
 planet_shapes = []
 
+# Spatial indexes of where the planets and flying lasers are, so drawing and recycling only need to look at the ones
+# near the edges of the camera or active zone (see spatialgrid.py)
+PLANET_GRID = SpatialGrid()
+LASER_GRID = SpatialGrid()
+# How far outside of the camera the grids are searched when drawing. Planets are up to 60 pixels in radius, lasers are
+# 20 pixels long, and both can be drawn a little ahead of where the grid last saw them (see gameloop.py)
+PLANET_DRAW_MARGIN = 80
+LASER_DRAW_MARGIN = 40
+
+# With sectors turned on (python flyinginspace.py --sectors), the world is split into SECTOR_SIZE x SECTOR_SIZE sectors
+# that are generated from the world seed and streamed in and out of SPACE around the camera, instead of planets and
+# stars respawning at random (see SectorWorld). SECTORS is the SectorWorld of the current game, or None
+SECTOR_SIZE = 512
+# How many unloaded sectors keep their planets where the player left them
+SECTOR_CACHE_SIZE = 256
+# Sectors stay loaded until they are this far outside of the active zone, so flying back and forth over a sector's
+# edge doesn't load and unload it over and over
+SECTOR_UNLOAD_MARGIN = 256
+# No planets are generated this close to where the player starts
+SECTOR_START_CLEAR_RADIUS = 200
+SECTORS = None
+
 score = 0
 
 global player_health
@@ -127,15 +201,27 @@ def draw_objects(objects):
         sprite.draw()
 
 
+def draw_planets(planet_list):
+    """Draws all of the planets at once, using the sprite cache"""
+    circles = []
+    for planet in planet_list:
+        planet._convert_coordinates()
+        circles.append((planet.radius, planet.color, planet.pg_location))
+    SPRITES.draw(DISPLAY_SURF, circles)
+
+
 def draw_pymunk_circles(shapes: [pymunk.Shape]):
     """Draws circular pymunk bodies so they appear in the correct location"""
     for shape in shapes:
         shape.pg_center = pygame_coordinates(*shape.body.position)
-        pygame.draw.circle(DISPLAY_SURF, shape.color, shape.pg_center, int(shape.radius))
+    SPRITES.draw(DISPLAY_SURF, [(shape.radius, shape.color, shape.pg_center) for shape in shapes])
+    for shape in shapes:
         # This line points what direction the shape's body is facing. It's kinda janky, not sure why it works
         # the way it does.
-        pygame.draw.line(DISPLAY_SURF, color.THECOLORS['black'],
-                         shape.pg_center, shape.pg_center + Vec2d(shape.radius, 0).rotated(shape.body.angle), 2)
+        pg_x, pg_y = shape.pg_center
+        angle = shape.body.angle
+        pygame.draw.line(DISPLAY_SURF, color.THECOLORS['black'], shape.pg_center,
+                         (pg_x + shape.radius * math.cos(angle), pg_y + shape.radius * math.sin(angle)), 2)
 
 
 def draw_lasers(laser_list: [pymunk.Shape]):
@@ -145,6 +231,68 @@ def draw_lasers(laser_list: [pymunk.Shape]):
         pygame.draw.line(DISPLAY_SURF, laser.color, laser.tip_coords, laser.back_coords, 3)
 
 
+def reset_world():
+    """Creates a fresh pymunk space and empties out the lists of objects in it, so a new game starts from scratch"""
+    global SPACE, circle_shapes, lasers, planets, planet_shapes, score, player_health, camera_x, camera_y
+    global PLANET_GRID, LASER_GRID, SECTORS
+    SPACE = pymunk.Space()
+    circle_shapes = []
+    lasers = []
+    planets = []
+    planet_shapes = []
+    PLANET_GRID = SpatialGrid()
+    LASER_GRID = SpatialGrid()
+    SECTORS = None
+    score = 0
+    player_health = 100
+    camera_x, camera_y = 0, WIN_HEIGHT
+
+
+# Module globals that make up one game's world (see WorldState)
+WORLD_GLOBALS = ['SPACE', 'circle_shapes', 'lasers', 'planets', 'planet_shapes', 'PLANET_GRID', 'LASER_GRID', 'SECTORS',
+                 'score', 'player_health', 'camera_x', 'camera_y', 'NUMPY_RANDOM']
+
+
+class WorldState:
+    """Class that holds its own copy of the world's module globals (WORLD_GLOBALS), so more than one game can exist in
+    the same process. Inside "with world.active():" the module globals are this world's, so a Game can be created and
+    played in it, and afterwards they go back to what they were before.
+
+    The random number generators (random's state, and NUMPY_RANDOM) are swapped in and out too, so a world's randomness
+    only depends on its own seed and controls, no matter how many other worlds are played in between"""
+    def __init__(self, seed=None):
+        global NUMPY_RANDOM
+        outside = WorldState._capture()
+        reset_world()
+        NUMPY_RANDOM = np.random.RandomState()
+        if seed is not None:
+            seed_random(seed)
+        self.values = WorldState._capture()
+        WorldState._install(outside)
+
+    @staticmethod
+    def _capture():
+        module_globals = globals()
+        values = {name: module_globals[name] for name in WORLD_GLOBALS}
+        values['random'] = random.getstate()
+        return values
+
+    @staticmethod
+    def _install(values):
+        random.setstate(values['random'])
+        globals().update((name, values[name]) for name in WORLD_GLOBALS)
+
+    @contextmanager
+    def active(self):
+        outside = WorldState._capture()
+        WorldState._install(self.values)
+        try:
+            yield self
+        finally:
+            self.values = WorldState._capture()
+            WorldState._install(outside)
+
+
 def terminate():
     """Ends the program"""
     pygame.quit()
@@ -170,6 +318,17 @@ def is_in_camera_zone(subject=None, coords=None):
     return None
 
 
+def camera_bounds():
+    """Returns the (left, bottom, right, top) edges of the camera's view in world coordinates"""
+    return camera_x, camera_y - WIN_HEIGHT, camera_x + WIN_WIDTH, camera_y
+
+
+def active_zone_bounds():
+    """Returns the (left, bottom, right, top) edges of the active zone in world coordinates"""
+    return (camera_x - ACTIVE_ZONE_WIDTH, camera_y - WIN_HEIGHT - ACTIVE_ZONE_WIDTH,
+            camera_x + WIN_WIDTH + ACTIVE_ZONE_WIDTH, camera_y + ACTIVE_ZONE_WIDTH)
+
+
 def random_position_in_active_zone():
     """Returns a random (x, y) world position within the active zone"""
     x_pos = random.randint(camera_x - ACTIVE_ZONE_WIDTH, camera_x + WIN_WIDTH + ACTIVE_ZONE_WIDTH)
@@ -177,18 +336,91 @@ def random_position_in_active_zone():
     return x_pos, y_pos
 
 
-def random_position_out_of_view():
-    """Returns a random (x, y) position that is within the active zone, but not in view of the camera"""
-    # Keeps generating random points until it finds one not in the active zone
-    inside_camera_view = True
-    x_pos, y_pos = 0, 0
-    while inside_camera_view:
-        x_pos, y_pos = random_position_in_active_zone()
-        inside_camera_view = is_in_camera_zone(coords=(x_pos, y_pos))
-
+def random_position_out_of_view(radius=0, avoid=None):
+    """Returns a random (x, y) position that is within the active zone, but not in view of the camera.
+    See random_positions_out_of_view for radius and avoid"""
+    x_pos, y_pos = random_positions_out_of_view(1, radius, avoid)[0]
     return x_pos, y_pos
 
 
+def random_positions_in_active_zone(count):
+    """Returns an array of "count" random (x, y) world positions within the active zone"""
+    x_pos = NUMPY_RANDOM.randint(camera_x - ACTIVE_ZONE_WIDTH, camera_x + WIN_WIDTH + ACTIVE_ZONE_WIDTH + 1, count)
+    y_pos = NUMPY_RANDOM.randint(camera_y - WIN_HEIGHT - ACTIVE_ZONE_WIDTH, camera_y + ACTIVE_ZONE_WIDTH + 1, count)
+    return np.column_stack((x_pos, y_pos)).astype(np.float64)
+
+
+def out_of_view_regions():
+    """The part of the active zone that the camera can't see is a ring around the camera. This returns it as four
+    rectangles that don't overlap (left, right, above and below the camera), as an array of
+    [x_min, x_max, y_min, y_max] rows in world coordinates. The limits are inclusive, and every whole-number point
+    inside of them is out of view (see is_in_camera_zone)"""
+    zone_left, zone_bottom = camera_x - ACTIVE_ZONE_WIDTH, camera_y - WIN_HEIGHT - ACTIVE_ZONE_WIDTH
+    zone_right, zone_top = camera_x + WIN_WIDTH + ACTIVE_ZONE_WIDTH, camera_y + ACTIVE_ZONE_WIDTH
+    return np.array([[zone_left,            camera_x - 1,             zone_bottom,             zone_top],
+                     [camera_x + WIN_WIDTH, zone_right,               zone_bottom,             zone_top],
+                     [camera_x,             camera_x + WIN_WIDTH - 1, camera_y + 1,            zone_top],
+                     [camera_x,             camera_x + WIN_WIDTH - 1, zone_bottom,             camera_y - WIN_HEIGHT]],
+                    dtype=np.int64)
+
+
+def _sample_out_of_view(count):
+    """Returns an array of "count" positions spread evenly over the part of the active zone that is out of view.
+    Each point first picks one of the out_of_view_regions (bigger regions are picked more often), and then a
+    point inside of it, so no points ever need to be thrown away and tried again"""
+    regions = out_of_view_regions()
+    x_min, x_max, y_min, y_max = regions.T
+    areas = (np.maximum(x_max - x_min + 1, 0) * np.maximum(y_max - y_min + 1, 0)).astype(np.float64)
+    if areas.sum() == 0:
+        raise ValueError('There is no room in the active zone outside of the camera view')
+    which = np.searchsorted(np.cumsum(areas), NUMPY_RANDOM.random_sample(count) * areas.sum(), side='right')
+    x_pos = NUMPY_RANDOM.randint(x_min[which], x_max[which] + 1)
+    y_pos = NUMPY_RANDOM.randint(y_min[which], y_max[which] + 1)
+    return np.column_stack((x_pos, y_pos)).astype(np.float64)
+
+
+def random_positions_out_of_view(count, radius=0, avoid=None, attempts=16):
+    """Returns an array of "count" random (x, y) positions that are within the active zone, but not in view of the
+    camera.
+
+    To keep circles (like planets) from spawning on top of each other, give radius (the radius of each new circle,
+    either one number or an array) and/or avoid (a (k, 3) array of (x, y, radius) circles that are already there).
+    Each position then gets "attempts" tries to find a spot that overlaps nothing. If none of them do, the spot with
+    the most room is used anyway, so the time this takes is always the same"""
+    radii = np.broadcast_to(np.asarray(radius, dtype=np.float64), (count,))
+    if avoid is None and not radii.any():
+        return _sample_out_of_view(count)
+
+    # Circles that new ones need to stay away from, including the new ones that have already been placed
+    avoid = np.empty((0, 3)) if avoid is None else np.asarray(avoid, dtype=np.float64).reshape(-1, 3)
+    circles = np.empty((len(avoid) + count, 3))
+    circles[:len(avoid)] = avoid
+    num_circles = len(avoid)
+
+    positions = np.empty((count, 2))
+    candidates = _sample_out_of_view(count * attempts).reshape(count, attempts, 2)
+    for i in range(count):
+        choice = 0
+        if num_circles:
+            placed = circles[:num_circles]
+            # How much room each try has between it and the closest circle (negative if they overlap)
+            room = (np.hypot(candidates[i, :, 0, None] - placed[:, 0], candidates[i, :, 1, None] - placed[:, 1]) -
+                    placed[:, 2] - radii[i]).min(axis=1)
+            fits = np.flatnonzero(room >= 0)
+            choice = fits[0] if len(fits) else room.argmax()
+        positions[i] = candidates[i, choice]
+        circles[num_circles] = positions[i, 0], positions[i, 1], radii[i]
+        num_circles += 1
+    return positions
+
+
+def planet_circles(exclude=None):
+    """Returns a (k, 3) array of (x, y, radius) for every planet except "exclude", to keep new planets from spawning
+    on top of them (see random_positions_out_of_view)"""
+    return np.array([(*planet.body.position, planet.radius)
+                     for planet in planets if planet is not exclude], dtype=np.float64).reshape(-1, 3)
+
+
 def screen_center():
     """Returns the centermost point of the camera in world coordinates"""
     x_pos = camera_x + WIN_WIDTH/2
@@ -232,17 +464,197 @@ def create_player_ammunition(player: pymunk.Shape, ammunition_color=color.THECOL
     """Function that creates a new ammunition blast using the angle and position of the shape creating it (player)
     Returns the ammunition body and shape
 
-    The body is the head of the laser, and the shape is just a circle with radius 2"""
+    The body is the head of the laser, and the shape is just a circle with radius 2. If player is None, the laser is
+    left where it is, to be aimed later"""
     ammunition_body = pymunk.Body(mass=.1, moment=pymunk.moment_for_circle(.1, 0, 2))
     ammunition_shape = pymunk.Circle(ammunition_body, 2)
+    if player is not None:
+        aim_player_ammunition(ammunition_body, player)
+    ammunition_shape.collision_type = LASER
+
+    ammunition_shape.color = ammunition_color
+    return ammunition_body, ammunition_shape
+
+
+def aim_player_ammunition(ammunition_body: pymunk.Body, player: pymunk.Shape):
+    """Places an ammunition body in front of the player and sends it flying the way the player is pointing"""
     player_position = player.body.position
     ammunition_body.velocity = Vec2d(1000, 0).rotated(-player.body.angle) + player.body.velocity
     ammunition_body.angle = -player.body.angle
     ammunition_body.position = Vec2d(20, 0).rotated(-player.body.angle) + player_position
-    ammunition_shape.collision_type = LASER
 
-    ammunition_shape.color = ammunition_color
-    return ammunition_body, ammunition_shape
+
+class LaserPool:
+    """Class that keeps a fixed number of lasers, so lasers don't pile up in SPACE forever. Lasers that are flying are
+    in SPACE and in the "active" list (oldest first), and the rest wait in the pool to be fired again.
+
+    A laser is put back into the pool when it hits a planet, when it has been flying for longer than time_to_live
+    seconds, or when it leaves the active zone. If every laser is already flying, the oldest one is reused.
+
+    Flying lasers are also kept in LASER_GRID, which is used to draw only the lasers in view"""
+    def __init__(self, size=20, time_to_live=1.5):
+        self.time_to_live = time_to_live
+        self.active = []
+        self.free = []
+        for i in range(size):
+            laser_body, laser_shape = create_player_ammunition(None)
+            self.free.append(laser_shape)
+
+    def fire(self, player: pymunk.Shape, tick):
+        """Fires a laser from the player. tick is the current physics tick, used for the laser's time to live"""
+        if not self.free:
+            self.retire(self.active[0])
+        laser_shape = self.free.pop()
+        aim_player_ammunition(laser_shape.body, player)
+        laser_shape.fired_tick = tick
+        self.active.append(laser_shape)
+        SPACE.add(laser_shape.body, laser_shape)
+        LASER_GRID.insert(laser_shape, *laser_shape.body.position)
+        return laser_shape
+
+    def retire(self, laser_shape):
+        """Takes a laser out of SPACE and puts it back in the pool. Returns False if it was already in the pool"""
+        if laser_shape not in self.active:
+            return False
+        self.active.remove(laser_shape)
+        SPACE.remove(laser_shape, laser_shape.body)
+        LASER_GRID.remove(laser_shape)
+        self.free.append(laser_shape)
+        return True
+
+    def update(self, tick):
+        """Retires any lasers that have run out of time or left the active zone"""
+        for laser_shape in self.active:
+            LASER_GRID.move(laser_shape, *laser_shape.body.position)
+
+        # The active list is oldest first, so only lasers at the front of it can have run out of time
+        oldest_tick = tick - self.time_to_live * FPS
+        while self.active and self.active[0].fired_tick <= oldest_tick:
+            self.retire(self.active[0])
+
+        # Only lasers in grid cells that poke out of the active zone could be outside of it
+        for laser_shape in LASER_GRID.outside(*active_zone_bounds()):
+            pg_x, pg_y = pygame_coordinates(*laser_shape.body.position)
+            if not (-ACTIVE_ZONE_WIDTH <= pg_x < WIN_WIDTH + ACTIVE_ZONE_WIDTH and
+                    -ACTIVE_ZONE_WIDTH <= pg_y < WIN_HEIGHT + ACTIVE_ZONE_WIDTH):
+                self.retire(laser_shape)
+
+    def capture(self):
+        """Returns the flying lasers as an array of LASER_STATE_DTYPE rows, oldest first (see snapshot.py)"""
+        return np.array([(*state, laser.fired_tick) for state, laser in
+                         zip(body_states(laser.body for laser in self.active), self.active)], dtype=LASER_STATE_DTYPE)
+
+    def restore(self, rows):
+        """Opposite of capture: puts every laser back in the pool, then fires the ones in rows where they were"""
+        while self.active:
+            self.retire(self.active[-1])
+        for x_pos, y_pos, x_velocity, y_velocity, angle, angular_velocity, fired_tick in rows.tolist():
+            laser_shape = self.free.pop()
+            laser_shape.body.position = x_pos, y_pos
+            laser_shape.body.velocity = x_velocity, y_velocity
+            laser_shape.body.angle = angle
+            laser_shape.body.angular_velocity = angular_velocity
+            laser_shape.fired_tick = fired_tick
+            self.active.append(laser_shape)
+            SPACE.add(laser_shape.body, laser_shape)
+            LASER_GRID.insert(laser_shape, x_pos, y_pos)
+
+
+class SoundBank:
+    """Class that keeps every sound effect in memory, so sounds never need loaded from disk in the middle of the game
+    (for example inside a collision callback during SPACE.step()). Sounds are named by their path inside the
+    resources folder without the extension, such as 'laser' or 'explosions/explosion3'.
+
+    Sound effects play on a fixed pool of mixer channels. If every channel in the pool is busy, the sound that has been
+    playing the longest is cut off to make room for the new one. The first reserved_channels channels are not part of
+    the pool, so they can be used directly (like the rocket boost channel).
+
+    preload can be True to decode every sound in the resources folder at startup, a list of names to decode just those,
+    or False to load each sound the first time it is played. If assets (an AssetManager) is given, the sounds in
+    preload are decoded on its background threads instead of before this returns, and a sound that is played before it
+    has finished loading is waited for. If the mixer isn't running, nothing is loaded and playing a sound does nothing"""
+    def __init__(self, directory=RESOURCE_DIRECTORY, num_channels=16, reserved_channels=1, preload=True, assets=None):
+        self.directory = directory
+        self.assets = assets
+        self.sounds = {}
+        self.channels = []
+        self.enabled = pygame.mixer.get_init() is not None
+        if not self.enabled:
+            return
+
+        pygame.mixer.set_num_channels(num_channels)
+        pygame.mixer.set_reserved(reserved_channels)
+        self.channels = [pygame.mixer.Channel(i) for i in range(reserved_channels, num_channels)]
+        # Which play() call last used each channel, to find the oldest sound when stealing a channel
+        self._channel_play_order = [0] * len(self.channels)
+        self._play_count = 0
+
+        if preload is True:
+            self.load_all()
+        elif preload and assets is not None:
+            assets.preload_sounds(preload)
+        elif preload:
+            for name in preload:
+                self.get(name)
+
+    def sound_names(self):
+        """Returns the name of every .ogg file in the resources folder"""
+        names = []
+        for folder, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                if file_name.endswith('.ogg'):
+                    path = os.path.relpath(os.path.join(folder, file_name), self.directory)
+                    names.append(os.path.splitext(path)[0].replace(os.sep, '/'))
+        return names
+
+    def load_all(self):
+        """Decode every .ogg file in the resources folder (in the background if there is an AssetManager)"""
+        if self.assets is not None:
+            self.assets.preload_sounds(self.sound_names())
+            return
+        for name in self.sound_names():
+            self.get(name)
+
+    def get(self, name):
+        """Returns the pygame Sound called name, loading it the first time it is asked for"""
+        if not self.enabled:
+            return None
+        if name not in self.sounds:
+            if self.assets is not None:
+                self.sounds[name] = self.assets.sound(name)
+            else:
+                self.sounds[name] = pygame.mixer.Sound(os.path.join(self.directory, name + '.ogg'))
+        return self.sounds[name]
+
+    def play(self, name, loops=0):
+        """Plays a sound on a channel from the pool and returns the channel"""
+        if not self.enabled:
+            return None
+        sound = self.get(name)
+        index = self._free_channel()
+        self._play_count += 1
+        self._channel_play_order[index] = self._play_count
+        channel = self.channels[index]
+        channel.play(sound, loops)
+        return channel
+
+    def stop_music(self):
+        if self.enabled:
+            pygame.mixer.music.stop()
+
+    def play_random(self, names):
+        """Plays one of the sounds in names, picked at random"""
+        return self.play(random.choice(names))
+
+    def _free_channel(self):
+        for i, channel in enumerate(self.channels):
+            if not channel.get_busy():
+                return i
+        # Every channel is busy, so steal the one that started playing first
+        oldest = min(range(len(self.channels)), key=self._channel_play_order.__getitem__)
+        self.channels[oldest].stop()
+        return oldest
+
 
 # ------------------------------ Collision Types ---------------------------------
 
@@ -250,37 +662,34 @@ def create_player_ammunition(player: pymunk.Shape, ammunition_color=color.THECOL
 def player_planet_collision(arbiter, space, data):
     global player_health
     damage: Vec2d = arbiter.total_impulse.get_length() / 1000
-    random_sound_path = 'resources/explosions/explosion' + str(random.randint(1, 5)) + '.ogg'
-    explosion_sound = pygame.mixer.Sound(random_sound_path)
-    explosion_sound.stop()
-    explosion_sound.play()
+    SOUNDS.play_random(EXPLOSION_SOUNDS)
     player_health -= damage
     return True
 
 
+def respawn_planet(space, planet, radius):
+    """Post step callback that respawns a planet that was destroyed. In a world of sectors, destroyed planets are gone
+    for good instead"""
+    if SECTORS is not None:
+        SECTORS.remove_planet(planet)
+    else:
+        planet.respawn(radius)
+
+
 def laser_planet_collision(arbiter, space, data):
     global score
-    global lasers, planets
     laser_shape = arbiter.shapes[0]
     planet_shape = arbiter.shapes[1]
-    if planet_shape not in planet_shapes:
-        planet_shapes.remove(planet_shape)
-    planets.remove(planet_shape.object)
-    lasers.remove(laser_shape)
-    space.remove(laser_shape, laser_shape.body)
-    space.remove(planet_shape, planet_shape.body)
-
-    score += planet_shape.radius
-    print(score)
-
-    random_sound_path = 'resources/explosions/explosion' + str(random.randint(1, 5)) + '.ogg'
-    explosion_sound = pygame.mixer.Sound(random_sound_path)
-    explosion_sound.stop()
-    explosion_sound.play()
-
-    new_planet = Planet(50)
-    planet_shapes.append(new_planet.shape)
-    planets.append(new_planet)
+    # Ignore the hit if this laser already hit a different planet during this step
+    if not data['laser_pool'].retire(laser_shape):
+        return False
+
+    # Bodies can't be moved in the middle of a physics step, so the planet respawns once the step is done.
+    # Using the planet as the key means it can only be destroyed once per step, even if two lasers hit it
+    if space.add_post_step_callback(respawn_planet, planet_shape.object, 50):
+        score += planet_shape.radius
+
+        SOUNDS.play_random(EXPLOSION_SOUNDS)
     return True
 
 
@@ -289,7 +698,9 @@ class Planet:
     Class that holds the information about a given planet.
     Location is an (x, y) coordinate of the center in world coordinates
 
-    This class is a work in progress, it doesn't do anything remarkable yet
+    Planets are never removed from SPACE. When a planet is destroyed or leaves the active zone, it is respawned
+    somewhere else with the same body and shape (see respawn), so the planets list is a fixed pool of planets.
+    Every planet is also kept in PLANET_GRID at its current location.
 
     pg_XXX variables are the planet's position in pygame coordinates
     """
@@ -300,7 +711,7 @@ class Planet:
 
         self.location = location
         if self.location is None:
-            self.location = random_position_out_of_view()
+            self.location = random_position_out_of_view(self.radius, planet_circles())
         self.x_pos, self.y_pos = self.location
 
         self.width, self.height = (self.radius * 2, self.radius * 2)
@@ -317,30 +728,60 @@ class Planet:
         self.shape.object = self
         SPACE.add(self.body)
         SPACE.add(self.shape)
+        PLANET_GRID.insert(self, *self.location)
 
-        self.update_pg_coords()
+        self._convert_coordinates()
 
     def __str__(self):
         return 'radius: ' + str(self.radius)
 
     def draw(self):
         # Update the coordinates, then draw
-        self.update_pg_coords()
-        pygame.draw.circle(DISPLAY_SURF, self.color, self.pg_location, self.radius)
+        self._convert_coordinates()
+        pg_x, pg_y = self.pg_location
+        DISPLAY_SURF.blit(SPRITES.get(self.radius, self.color), (pg_x - self.radius, pg_y - self.radius))
 
     def update_pg_coords(self):
+        """Update pygame coordinates to match the current world coordinates, and respawn the planet if it has left the
+        active zone"""
+        self._convert_coordinates()
+        if not is_in_active_zone(self):
+            self.respawn(random.randint(30, 60))
+
+    def _convert_coordinates(self):
         self.location = self.body.position
         self.pg_location = pygame_coordinates(*self.location)
-        self.pg_x, self.pg_y = pygame_coordinates(self.x_pos, self.y_pos)
+        self.x_pos, self.y_pos = self.location
+        self.pg_x, self.pg_y = self.pg_location
         self.pg_left, self.pg_top = pygame_coordinates((self.x_pos - self.radius), (self.y_pos + self.radius))
-        if not is_in_active_zone(self):
-            planet_shapes.remove(self.shape)
-            planets.remove(self)
-            SPACE.remove(self.shape, self.body)
-            new_planet = Planet(random.randint(30, 60))
-            planet_shapes.append(new_planet.shape)
-            planets.append(new_planet)
-            del(self)
+
+    def respawn(self, radius, mass=1000, location=None, object_color=None):
+        """Turns this planet into a brand new one somewhere out of view, reusing its pymunk body and shape.
+        Should not be called during a physics step (use SPACE.add_post_step_callback)"""
+        self.radius = radius
+        self.mass = mass
+        self.width, self.height = (self.radius * 2, self.radius * 2)
+
+        self.location = location
+        if self.location is None:
+            self.location = random_position_out_of_view(self.radius, planet_circles(exclude=self))
+        self.x_pos, self.y_pos = self.location
+
+        self.color = object_color
+        if self.color is None:
+            self.color = random.choice(list(pygame.color.THECOLORS.values()))
+        self.shape.color = self.color
+
+        self.shape.unsafe_set_radius(self.radius)
+        self.body.mass = self.mass
+        self.body.moment = pymunk.moment_for_circle(self.mass, 0, self.radius)
+        self.body.position = self.location
+        self.body.velocity = Vec2d(random.randint(0, 20), 0).rotated(random.random() * 6.2)
+        self.body.angular_velocity = 0
+        SPACE.reindex_shapes_for_body(self.body)
+        PLANET_GRID.move(self, *self.location)
+
+        self._convert_coordinates()
 
     def create_planet(space: pymunk.Space, radius_in, mass_in, position, color=None):
         """Function for creating a "planet". it takes several arguments, and colors it a random shade of green.
@@ -360,330 +801,940 @@ class Planet:
         return planet_body, planet_shape
 
 
-class Star:
-    """Class about the stars (dots in the background). Stars operate in a way such that whenever one goes out of the
-    active area, a new one will be spawned off screen. The total number of stars stays constant.
+class StarField:
+    """Class that holds all of the stars (dots in the background) at once. The positions, sizes and colors of every
+    star are kept in numpy arrays, so the whole field can be moved to pygame coordinates and checked against the active
+    zone in a handful of array operations.
 
-    pg_XXX variables are pygame coordinates
-    """
-    _stars = []
-    DOT = 0
-    CROSS = 1
+    Whenever a star goes out of the active area it is respawned off screen in the same slot, so the total number of
+    stars stays constant.
 
-    def __init__(self, location=None, size=0, type=DOT, color=color.THECOLORS['white'], on_screen=False):
-        self.location = location
-        if self.location is None:
-            if not on_screen:
-                self.location = random_position_out_of_view()
-            else:
-                self.location = random_position_in_active_zone()
-
-        self.x_pos, self.y_pos = self.location
+    positions - (count, 2) array of world coordinates
+    sizes - radius of each star
+    color_index - index of each star's color in palette
+    pg_XXX arrays are pygame coordinates
+    recycle - whether stars that leave the active zone are respawned. A world of sectors turns this off and places the
+              stars itself (see set_stars)
+    """
+    def __init__(self, count, size=0, colors=None, on_screen=False):
+        self.count = count
         self.size = int(size)
-        self.width, self.height = (self.size * 2, self.size * 2)
-        self.type = type
-        self.color = color
-        self.update_pg_coords()
-        # Whenever the star is created, add itself to the list of stars
-        Star._stars.append(self)
+        self.recycle = True
+        if colors is None:
+            colors = [color.THECOLORS['white']]
 
-    # Essentially, this says that two stars will be considered the same if they have the same location
-    def __eq__(self, other):
-        return self.location == other.location
+        if on_screen:
+            self.positions = random_positions_in_active_zone(count)
+        else:
+            self.positions = random_positions_out_of_view(count)
+        self.sizes = np.full(count, int(size), dtype=np.int64)
 
-    def draw(self):
-        """Draw self on DISPLAY_SURF"""
+        # Every star's color is an index into the palette, so colors only need mapped to the display format once
+        self.palette = np.array([tuple(star_color) for star_color in colors], dtype=np.uint8)
+        self.color_index = NUMPY_RANDOM.randint(0, len(self.palette), count)
+        self._mapped_palette = None
+        self._mapped_surface = None
+
+        self.pg_x = np.zeros(count, dtype=np.int64)
+        self.pg_y = np.zeros(count, dtype=np.int64)
         self.update_pg_coords()
-        pygame.draw.circle(DISPLAY_SURF, self.color, self.pg_location, self.size)
+
+    def __len__(self):
+        return self.count
 
     def update_pg_coords(self):
-        """Update pygame coordinates to match the current world coordinates"""
-        self.pg_location = pygame_coordinates(*self.location)
-        self.pg_left, self.pg_top = pygame_coordinates((self.x_pos - self.size), (self.y_pos + self.size))
-        if not is_in_active_zone(self):
-            if self in Star._stars:
-                Star(size=self.size, type=self.type, color=self.color)
-                Star._stars.remove(self)
+        """Update pygame coordinates to match the current world coordinates, and respawn any stars that have left the
+        active zone"""
+        self._convert_coordinates()
+        if not self.recycle:
+            return
+        outside = ~self.in_active_zone()
+        if outside.any():
+            self.respawn(np.flatnonzero(outside))
+
+    def set_stars(self, positions, color_index):
+        """Replaces every star with the ones given. positions is an (n, 2) array of world coordinates and color_index
+        is the index of each star's color in the palette"""
+        self.count = len(positions)
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(-1, 2)
+        self.color_index = np.asarray(color_index, dtype=np.int64)
+        self.sizes = np.full(self.count, self.size, dtype=np.int64)
+        self.pg_x = np.zeros(self.count, dtype=np.int64)
+        self.pg_y = np.zeros(self.count, dtype=np.int64)
+        self._convert_coordinates()
+
+    def _convert_coordinates(self, indices=slice(None)):
+        """Vectorized version of pygame_coordinates for the stars at the given indices"""
+        self.pg_x[indices] = (self.positions[indices, 0] - camera_x).astype(np.int64)
+        self.pg_y[indices] = (camera_y - self.positions[indices, 1]).astype(np.int64)
+
+    def in_active_zone(self):
+        """Returns a boolean array that is True for each star at least partially within the active zone. This is the
+        same check as is_in_active_zone, done for every star at once"""
+        left = (self.positions[:, 0] - self.sizes - camera_x).astype(np.int64)
+        top = (camera_y - (self.positions[:, 1] + self.sizes)).astype(np.int64)
+        width = self.sizes * 2
+        return ((left < WIN_WIDTH + ACTIVE_ZONE_WIDTH) & (left + width > -ACTIVE_ZONE_WIDTH) &
+                (top < WIN_HEIGHT + ACTIVE_ZONE_WIDTH) & (top + width > -ACTIVE_ZONE_WIDTH))
+
+    def respawn(self, indices):
+        """Moves the stars in "indices" to new random positions off screen, reusing their slots"""
+        self.positions[indices] = random_positions_out_of_view(len(indices))
+        self._convert_coordinates(indices)
+
+    def draw(self, surface=None):
+        """Draw every star that is in view of the camera onto surface (DISPLAY_SURF by default)"""
+        if surface is None:
+            surface = DISPLAY_SURF
+        # The camera may have moved since update_pg_coords (for example while drawing between physics ticks)
+        self._convert_coordinates()
+        visible = (self.pg_x >= 0) & (self.pg_x < WIN_WIDTH) & (self.pg_y >= 0) & (self.pg_y < WIN_HEIGHT)
+
+        # Stars with size 0 are a single pixel, so they can all be written into the surface in one go
+        dots = np.flatnonzero(visible & (self.sizes == 0))
+        self._draw_dots(surface, dots)
+
+        for i in np.flatnonzero(visible & (self.sizes > 0)):
+            pygame.draw.circle(surface, tuple(self.palette[self.color_index[i]]),
+                               (int(self.pg_x[i]), int(self.pg_y[i])), int(self.sizes[i]))
+
+    def _draw_dots(self, surface, dots):
+        if surface is not self._mapped_surface:
+            self._mapped_palette = np.array([surface.map_rgb(tuple(star_color)) for star_color in self.palette])
+            self._mapped_surface = surface
+        try:
+            pixels = pygame.surfarray.pixels2d(surface)
+        except ValueError:
+            # Some pixel formats (24 bit) can't be referenced as a 2d array, so fall back to one pixel at a time
+            for i in dots:
+                surface.set_at((int(self.pg_x[i]), int(self.pg_y[i])), tuple(self.palette[self.color_index[i]]))
+            return
+        pixels[self.pg_x[dots], self.pg_y[dots]] = self._mapped_palette[self.color_index[dots]]
+        # Release the surface lock
+        del pixels
+
+
+class SectorWorld:
+    """Class that streams an endless world in and out of SPACE one sector at a time (see sectors.py).
+
+    The planets and stars of every sector are generated from the world seed. A sector is loaded as soon as it overlaps
+    the active zone, and unloaded once it is more than SECTOR_UNLOAD_MARGIN outside of it, with its planets saved in
+    the cache so they are still there when the player comes back. Planets are never respawned at random: a destroyed
+    planet is gone for good, and a planet that drifts out of the loaded sectors is saved into the sector it drifted
+    into. Since only the sectors around the camera are ever in SPACE, the number of bodies (and the cost of a physics
+    step) stays about the same no matter how far the player flies.
+
+    Planets that are unloaded keep their Planet objects in free_planets, to be reused by the next sector that loads.
+    Each planet in SPACE knows where it is in planets and planet_shapes (its index), so taking it out is just moving the
+    last planet into its place, instead of searching both lists for it. planets_per_sector and stars_per_sector are averages (see generate_sector)"""
+    def __init__(self, world_seed, planets_per_sector, stars_per_sector, star_field: StarField,
+                 sector_size=SECTOR_SIZE, cache_size=SECTOR_CACHE_SIZE):
+        self.world_seed = world_seed
+        self.planets_per_sector = planets_per_sector
+        self.stars_per_sector = stars_per_sector
+        self.star_field = star_field
+        self.sector_size = sector_size
+        self.cache = SectorCache(cache_size)
+        self.planet_palette = [tuple(planet_color) for planet_color in pygame.color.THECOLORS.values()]
+        # sector -> (star positions, star colors) of every loaded sector
+        self.loaded = {}
+        self.free_planets = []
+
+        star_field.recycle = False
+        star_field.set_stars(np.empty((0, 2)), np.empty(0, dtype=np.int64))
+
+    def generate(self, sector):
+        """Returns what a sector starts out with (see generate_sector)"""
+        return generate_sector(self.world_seed, sector, self.sector_size, self.planets_per_sector,
+                               self.stars_per_sector, self.planet_palette, len(self.star_field.palette),
+                               keep_clear=(0, 0, SECTOR_START_CLEAR_RADIUS))
+
+    def update(self):
+        """Loads the sectors that overlap the active zone, and unloads the ones that are far enough outside of it.
+        Should be called after PLANET_GRID is updated, and not during a physics step. Returns True if any sector was
+        loaded or unloaded"""
+        left, bottom, right, top = active_zone_bounds()
+        margin = SECTOR_UNLOAD_MARGIN
+        keep = sectors_overlapping(left - margin, bottom - margin, right + margin, top + margin, self.sector_size)
+        leaving = sorted(sector for sector in self.loaded if sector not in keep)
+        for sector in leaving:
+            self.unload(sector)
+
+        # Only planets in grid cells that poke out of the active zone can have drifted out of the loaded sectors
+        strays = {}
+        for planet in PLANET_GRID.outside(left, bottom, right, top):
+            sector = sector_of(*planet.body.position, self.sector_size)
+            if sector not in self.loaded:
+                strays.setdefault(sector, []).append(planet)
+        for sector in sorted(strays):
+            saved = self.cache.take(sector)
+            if saved is None:
+                saved = self.generate(sector).planets
+            self.cache.store(sector, np.concatenate((saved, self.save_planets(strays[sector]))))
+            for planet in strays[sector]:
+                self.remove_planet(planet)
+
+        arriving = sorted(sectors_overlapping(left, bottom, right, top, self.sector_size) - self.loaded.keys())
+        for sector in arriving:
+            self.load(sector)
+
+        if leaving or arriving:
+            self.update_stars()
+        return bool(leaving or arriving)
+
+    def load(self, sector):
+        """Puts a sector's planets into SPACE, as they were left if the sector is in the cache"""
+        contents = self.generate(sector)
+        saved = self.cache.take(sector)
+        for row in contents.planets if saved is None else saved:
+            self.add_planet(row)
+        self.loaded[sector] = (contents.star_positions, contents.star_colors)
+
+    def unload(self, sector):
+        """Saves the planets in a sector to the cache and takes them out of SPACE"""
+        sector_planets = [planet for planet in PLANET_GRID.query(*sector_bounds(sector, self.sector_size))
+                          if sector_of(*planet.body.position, self.sector_size) == sector]
+        self.cache.store(sector, self.save_planets(sector_planets))
+        for planet in sector_planets:
+            self.remove_planet(planet)
+        del self.loaded[sector]
+
+    def save_planets(self, planet_list):
+        """Returns an array of PLANET_DTYPE rows for the planets. Rows are sorted by position, so the order the planets
+        were found in (which depends on where they are in memory) doesn't change the game"""
+        rows = np.array([(*planet.body.position, *planet.body.velocity, planet.body.angle,
+                          planet.body.angular_velocity, planet.radius, tuple(planet.color))
+                         for planet in planet_list], dtype=PLANET_DTYPE)
+        return np.sort(rows, order=['x', 'y'])
+
+    def add_planet(self, row):
+        """Puts a planet into SPACE from a PLANET_DTYPE row"""
+        x_pos, y_pos, x_velocity, y_velocity, angle, angular_velocity, radius, planet_color = row.tolist()
+        planet_color = tuple(planet_color.tolist())
+        if self.free_planets:
+            planet = self.free_planets.pop()
+            SPACE.add(planet.body, planet.shape)
+            planet.respawn(radius, location=(x_pos, y_pos), object_color=planet_color)
+        else:
+            planet = Planet(radius=radius, location=(x_pos, y_pos), object_color=planet_color)
+        planet.body.velocity = x_velocity, y_velocity
+        planet.body.angle = angle
+        planet.body.angular_velocity = angular_velocity
+        planet.index = len(planets)
+        planets.append(planet)
+        planet_shapes.append(planet.shape)
+        return planet
+
+    def remove_planet(self, planet):
+        """Takes a planet out of SPACE and keeps it to be reused. Does nothing if it was already taken out"""
+        if planet not in PLANET_GRID:
+            return
+        SPACE.remove(planet.body, planet.shape)
+        PLANET_GRID.remove(planet)
+        # The last planet takes this one's place, so the order of planets changes
+        last_planet = planets.pop()
+        last_shape = planet_shapes.pop()
+        if last_planet is not planet:
+            planets[planet.index] = last_planet
+            planet_shapes[planet.index] = last_shape
+            last_planet.index = planet.index
+        self.free_planets.append(planet)
+
+    def restore(self, world_seed, loaded_sectors, sector_cache, planet_rows):
+        """Puts the sectors back the way they were in a snapshot: which sectors are loaded, what the cache holds, and
+        the planets (PLANET_STATE_DTYPE rows) that are in SPACE. The star field is left for the caller to restore"""
+        if world_seed != self.world_seed:
+            # A different world, so none of the loaded sectors' stars can be reused
+            self.world_seed = world_seed
+            self.loaded = {}
+        while planets:
+            self.remove_planet(planets[-1])
+        self.cache.sectors = OrderedDict(sector_cache)
+
+        loaded = {}
+        for sector in loaded_sectors:
+            if sector not in self.loaded:
+                contents = self.generate(sector)
+                self.loaded[sector] = (contents.star_positions, contents.star_colors)
+            loaded[sector] = self.loaded[sector]
+        self.loaded = loaded
+
+        # Planets in a world of sectors all have the mass add_planet gives them
+        for row in planet_rows[list(PLANET_DTYPE.names)]:
+            self.add_planet(row)
+
+    def update_stars(self):
+        """Gives the star field the stars of every loaded sector"""
+        loaded = [self.loaded[sector] for sector in sorted(self.loaded)]
+        if not loaded:
+            self.star_field.set_stars(np.empty((0, 2)), np.empty(0, dtype=np.int64))
+            return
+        self.star_field.set_stars(np.concatenate([positions for positions, _ in loaded]),
+                                  np.concatenate([star_colors for _, star_colors in loaded]))
 
 
 # The Game itself #################################################################################################
-def main():
+# Controls for one tick of the game. thrust, left and right are True while those keys are held, and fire is how many
+# times the fire key was pressed during the tick
+Controls = namedtuple('Controls', ['thrust', 'left', 'right', 'fire'])
+NO_CONTROLS = Controls(False, False, False, 0)
+
+
+class Game:
+    """Class that holds one session of the game: the player, the camera body, the star field, and the player's fuel,
+    ammunition and game mode. The objects in the world (SPACE, planets, lasers, score and player_health) are kept in
+    the module globals, and are reset whenever a new Game is created.
+
+    Game only takes care of the game logic. Drawing and the keyboard are handled by main(), which means the same game
+    can also be run without a window (see run_headless)
+
+    If sector_size is given, the world is streamed in sectors of that size (see SectorWorld), and num_planets and
+    num_stars are how many there are on average in an area the size of the active zone"""
+    GAME_LENGTH = 60
+
+    def __init__(self, num_planets=100, num_stars=NUM_STARS, game_length=None, sector_size=None):
+        global player_health, lasers, SECTORS
+        reset_world()
+        self.game_length = Game.GAME_LENGTH if game_length is None else game_length
+        self.num_planets = num_planets
+        self.num_stars = num_stars
+        self.sector_size = sector_size
+
+        # Create player body (space ship thing)
+        self.player_body = pymunk.Body(mass=100, moment=pymunk.moment_for_circle(100, 0, 10))
+        self.player_shape = pymunk.Circle(self.player_body, 15)
+        self.player_shape.friction = 0.5
+        self.player_shape.elasticity = 0.9
+        self.player_shape.color = color.THECOLORS['coral']
+        self.player_shape.collision_type = PLAYER
+        circle_shapes.append(self.player_shape)
+
+        # Create camera center body. This invisible body moves around to follow the player, and the camera is
+        # constantly centered on it
+        self.camera_body = pymunk.Body(mass=.00000001, moment=pymunk.moment_for_circle(1, 0, 3))
+
+        # Add bodies to space
+        SPACE.add(self.player_shape)
+        SPACE.add(self.player_body)
+        SPACE.add(self.camera_body)
+        self.player_body.position = (0, 0)
+        self.camera_body.position = (0, 0)
+
+        if sector_size is None:
+            # All of the planets' positions are picked at once, so that none of them start out overlapping
+            radii = [random.randint(30, 60) for i in range(num_planets)]
+            locations = random_positions_out_of_view(num_planets, radii)
+            for i in range(num_planets):
+                planets.append(Planet(radius=radii[i], mass=1000 - 1 * i, location=tuple(locations[i])))
+                planet_shapes.append(planets[i].shape)
+
+            # Generate the stars. The star field will respawn any stars that exit the active zone
+            self.star_field = StarField(num_stars, size=0, colors=list(color.THECOLORS.values()), on_screen=True)
+        else:
+            # The planets and stars come from the sectors around the player, keeping the same density as above
+            self.star_field = StarField(0, size=0, colors=list(color.THECOLORS.values()), on_screen=True)
+            left, bottom, right, top = active_zone_bounds()
+            sectors_per_zone = (right - left) * (top - bottom) / sector_size ** 2
+            SECTORS = SectorWorld(random.getrandbits(64), num_planets / sectors_per_zone, num_stars / sectors_per_zone,
+                                  self.star_field, sector_size)
+            center_camera_on(self.camera_body)
+            SECTORS.update()
+
+        # Collision handling stuff
+        player_planet_handler = SPACE.add_collision_handler(PLAYER, PLANET)
+        player_planet_handler.post_solve = player_planet_collision
+        laser_planet_handler  = SPACE.add_collision_handler(LASER, PLANET)
+        laser_planet_handler.begin = laser_planet_collision
+
+        # Lasers are all made ahead of time, and "lasers" is the list of the ones that are flying
+        self.laser_pool = LaserPool()
+        lasers = self.laser_pool.active
+        laser_planet_handler.data['laser_pool'] = self.laser_pool
+
+        if not fun_mode:
+            self.laser_sound_name = 'laser'
+        else:
+            self.laser_sound_name = 'fun_laser'
+
+        # Initialize player values for fuel, health, etc.
+        self.rocket_fuel = 100
+        player_health = 100
+        self.ammunition = 100
+        self.game_over_string = ''
+        self.boosting = False
+
+        # The game starts at the menu. ticks counts the physics steps since the game was started
+        self.game_mode = MENU
+        self.ticks = 0
+
+    @property
+    def time_remaining(self):
+        time_elapsed = round(self.ticks / FPS)
+        return self.game_length - time_elapsed
+
+    def start(self):
+        """Leave the menu and start playing"""
+        self.game_mode = PLAY
+        self.ticks = 0
+
+    def fire(self):
+        """Fire a laser from the front of the player's ship"""
+        if self.game_mode == PLAY and self.ammunition > 0:
+            SOUNDS.play(self.laser_sound_name)
+            self.laser_pool.fire(self.player_shape, self.ticks)
+            self.ammunition -= 1
+
+    def game_over(self, reason, sound_name):
+        self.game_mode = GAME_OVER
+        self.game_over_string = reason
+        self.boosting = False
+        SOUNDS.stop_music()
+        SOUNDS.play(sound_name)
+
+    def update(self, controls: Controls):
+        """Everything that happens during one tick of PLAY mode, except for the physics step itself (see step)"""
+        global player_health
+        for _ in range(controls.fire):
+            self.fire()
+
+        # React to held keys
+        self.boosting = controls.thrust and self.rocket_fuel > 0
+        if self.boosting:
+            # Provide forward force in direction the player is pointing
+            self.player_body.apply_impulse_at_local_point(Vec2d(800, 0).rotated(-2 * self.player_body.angle))
+            self.rocket_fuel -= .25
+
+        if controls.left:
+            self.player_body.angle -= .13
+        if controls.right:
+            self.player_body.angle += .13
+
+        # Check for game overs
+        if self.rocket_fuel <= 0:
+            self.rocket_fuel = 0
+            self.game_over('Out of fuel!', 'out_of_gas')
+
+        if player_health <= 0:
+            player_health = 0
+            self.game_over('Your ship wrecked!', 'crash')
+
+        if self.ammunition <= 0:
+            self.ammunition = 0
+            self.game_over('Out of ammunition!', 'out_of_ammo')
+
+        if self.time_remaining <= 0:
+            self.game_over("Time's up!", 'times_up')
+
+        self.player_body.angular_velocity = 0
+
+        # Move the camera body and center the camera on it
+        self.camera_body.velocity = self.player_body.velocity * .8 + \
+                                    (self.player_body.position - self.camera_body.position) * 2
+        center_camera_on(self.camera_body)
+
+        # Check for lasers, planets and stars going outside. Only the planets in grid cells that poke out of the active
+        # zone need to be checked. In a world of sectors, the sectors take care of the planets and stars instead
+        with PROFILER.phase('recycle'):
+            self.laser_pool.update(self.ticks)
+            for planet in planets:
+                PLANET_GRID.move(planet, *planet.body.position)
+            if SECTORS is not None:
+                SECTORS.update()
+            else:
+                # Planets that left respawn using random numbers, so they are done in order of position. The order
+                # PLANET_GRID finds them in depends on how the grid got that way, which restoring a snapshot changes
+                for planet in sorted(PLANET_GRID.outside(*active_zone_bounds()),
+                                     key=lambda planet: tuple(planet.body.position)):
+                    planet.update_pg_coords()
+        with PROFILER.phase('stars'):
+            self.star_field.update_pg_coords()
+
+    def step(self):
+        """Physics tick"""
+        dt = 1. / FPS
+        with PROFILER.phase('physics'):
+            SPACE.step(dt)
+        self.ticks += 1
+
+    def capture(self):
+        """Returns a Snapshot of the whole world (see snapshot.py). Should not be called during a physics step"""
+        bodies = np.array(body_states((self.player_body, self.camera_body)), dtype=BODY_DTYPE)
+        planet_rows = np.array([(*state, planet.mass, planet.radius, tuple(planet.color)) for state, planet in
+                                zip(body_states(planet.body for planet in planets), planets)],
+                               dtype=PLANET_STATE_DTYPE)
+        if SECTORS is not None:
+            # Cached sectors are never changed in place, so the cache's arrays can be shared with the snapshot
+            world_seed, loaded_sectors, sector_cache = \
+                SECTORS.world_seed, sorted(SECTORS.loaded), OrderedDict(SECTORS.cache.sectors)
+        else:
+            world_seed, loaded_sectors, sector_cache = 0, [], OrderedDict()
+        return Snapshot(self.num_planets, self.num_stars, self.game_length, self.sector_size, world_seed, self.ticks,
+                        self.game_mode, self.boosting, score, player_health, self.rocket_fuel, self.ammunition,
+                        camera_x, camera_y, self.game_over_string, bodies, planet_rows, self.laser_pool.capture(),
+                        self.star_field.positions.copy(), self.star_field.color_index.copy(), random.getstate(),
+                        NUMPY_RANDOM.get_state(), loaded_sectors, sector_cache)
+
+    def restore(self, snapshot: Snapshot):
+        """Puts the whole world back the way it was when snapshot was captured. The snapshot needs to come from a game
+        with the same number of planets and stars and the same sector size (see game_from_snapshot). Should not be
+        called during a physics step"""
+        global score, player_health, camera_x, camera_y
+        if (snapshot.num_planets, snapshot.num_stars, snapshot.sector_size) != \
+                (self.num_planets, self.num_stars, self.sector_size):
+            raise ValueError('Snapshot is from a game with different settings')
+        self.game_length = snapshot.game_length
+        self.ticks = snapshot.ticks
+        self.game_mode = snapshot.game_mode
+        self.boosting = snapshot.boosting
+        self.rocket_fuel = snapshot.rocket_fuel
+        self.ammunition = snapshot.ammunition
+        self.game_over_string = snapshot.game_over_string
+        score = snapshot.score
+        player_health = snapshot.player_health
+        camera_x, camera_y = snapshot.camera_x, snapshot.camera_y
+
+        for body, row in zip((self.player_body, self.camera_body), snapshot.bodies.tolist()):
+            x_pos, y_pos, x_velocity, y_velocity, angle, angular_velocity = row
+            body.position = x_pos, y_pos
+            body.velocity = x_velocity, y_velocity
+            body.angle = angle
+            body.angular_velocity = angular_velocity
+            SPACE.reindex_shapes_for_body(body)
+
+        if SECTORS is not None:
+            SECTORS.restore(snapshot.world_seed, snapshot.loaded_sectors, snapshot.sector_cache, snapshot.planets)
+        else:
+            # Without sectors, the planets are a fixed pool (see Planet)
+            for planet, row in zip(planets, snapshot.planets.tolist()):
+                x_pos, y_pos, x_velocity, y_velocity, angle, angular_velocity, mass, radius, planet_color = row
+                planet.respawn(radius, mass, (x_pos, y_pos), tuple(planet_color.tolist()))
+                planet.body.velocity = x_velocity, y_velocity
+                planet.body.angle = angle
+                planet.body.angular_velocity = angular_velocity
+        self.laser_pool.restore(snapshot.lasers)
+        # The star field moves its stars in place, so it gets its own copy
+        self.star_field.set_stars(np.array(snapshot.star_positions), snapshot.star_colors)
+
+        # Planets respawning above used up random numbers, so the generators are put back last
+        random.setstate(snapshot.python_random)
+        NUMPY_RANDOM.set_state(snapshot.numpy_random)
+
+
+def game_from_snapshot(snapshot: Snapshot, game=None):
+    """Returns a Game in the state saved in snapshot. game is restored if it has the same settings as the game the
+    snapshot came from, otherwise a new Game is made (which resets the world)"""
+    if game is None or (game.num_planets, game.num_stars, game.sector_size) != \
+            (snapshot.num_planets, snapshot.num_stars, snapshot.sector_size):
+        game = Game(snapshot.num_planets, snapshot.num_stars, snapshot.game_length, snapshot.sector_size)
+    game.restore(snapshot)
+    return game
+
+
+def seed_random(seed):
+    """Seeds both of the random number generators the game uses (random and numpy), so that the same seed always
+    builds the same world"""
+    random.seed(seed)
+    NUMPY_RANDOM.seed(seed)
+
+
+def autopilot(tick):
+    """Scripted controls that fly around in circles and fire every half second. Used when running headless"""
+    return Controls(thrust=tick % 120 < 40, left=tick % 240 < 30, right=False, fire=int(tick % 30 == 0))
+
+
+def replay_controls(recording: Recording):
+    """Returns a controls function (like autopilot) that plays back a recording. Ticks after the end of the recording
+    get NO_CONTROLS"""
+    def controls(tick):
+        recorded = recording.controls_at(tick)
+        return NO_CONTROLS if recorded is None else Controls(*recorded)
+    return controls
+
+
+def run_headless(ticks, controls=autopilot, num_planets=100, num_stars=NUM_STARS, seed=None, recording=None,
+                 game_length=None, sector_size=None):
+    """Runs the game without a window, sound or frame rate limit, as fast as the CPU allows.
+    controls is a function that takes the tick number and returns the Controls for that tick.
+    If seed is given, the world is built from that seed (see seed_random). If recording is given, the controls of
+    every tick are recorded into it. sector_size streams the world in sectors (see Game).
+    Stops after "ticks" physics steps, or when the game is over. Returns the Game"""
+    global SOUNDS
+    # No mixer is running, so this sound bank won't load or play anything
+    SOUNDS = SoundBank(preload=False)
+    if seed is not None:
+        seed_random(seed)
+
+    game = Game(num_planets, num_stars, game_length, sector_size)
+    game.start()
+    # Every tick is one frame for the profiler
+    while game.game_mode == PLAY and game.ticks < ticks:
+        PROFILER.begin_frame()
+        tick_controls = controls(game.ticks)
+        if recording is not None:
+            recording.record(tick_controls)
+        with PROFILER.phase('update'):
+            game.update(tick_controls)
+        game.step()
+        count_entities(game)
+        PROFILER.end_frame()
+    if recording is not None:
+        recording.finish(score, game.game_over_string)
+    return game
+
+
+def count_entities(game):
+    """Records how many of each kind of object there are for the current profiler frame"""
+    PROFILER.count('stars', len(game.star_field))
+    PROFILER.count('planets', len(planets))
+    if SECTORS is not None:
+        PROFILER.count('sectors', len(SECTORS.loaded))
+    PROFILER.count('lasers', len(lasers))
+    PROFILER.count('shapes', len(SPACE.shapes))
+
+
+def main(seed=None, record_path=None, replay_path=None, sector_size=None):
+    """Plays the game in a window. The world is built from seed (a random one if it isn't given), and streamed in
+    sectors if sector_size is given (see Game).
+    If record_path is given, the controls are recorded and saved there when the game ends. If replay_path is given,
+    the recording saved there is played back in real time instead of reading the keyboard, and the outcome is checked
+    against the recorded one (see recording.py)"""
     # Some global variables used by many functions
-    global DISPLAY_SURF, FPS_CLOCK, camera_x, camera_y, crash_sound, player_health, circle_shapes, lasers, planets, planet_shapes
+    global DISPLAY_SURF, FPS_CLOCK, SOUNDS, player_health
 
     # Start up pygame settings
-    pygame.mixer.pre_init(44100, -16, 1, 512)
-    pygame.init()
-    pygame.display.set_caption('Space Game')
+    with ASSETS.timed('pygame.init'):
+        pygame.mixer.pre_init(44100, -16, 1, 512)
+        pygame.init()
+    with ASSETS.timed('window'):
+        DISPLAY_SURF = pygame.display.set_mode((WIN_WIDTH, WIN_HEIGHT))
+        pygame.display.set_caption('Space Game')
     FPS_CLOCK = pygame.time.Clock()
 
-    # Set up pymunk physics
-    circle_shapes = []
-    lasers = []
-
-    # Create player body (space ship thing)
-    player_body = pymunk.Body(mass=100, moment=pymunk.moment_for_circle(100, 0, 10))
-    player_shape = pymunk.Circle(player_body, 15)
-    player_shape.friction = 0.5
-    player_shape.elasticity = 0.9
-    player_shape.color = color.THECOLORS['coral']
-    player_shape.collision_type = PLAYER
-    circle_shapes.append(player_shape)
-
-    # Create camera center body. This invisible body moves around to follow the player, and the camera is constantly
-    # centered on it
-    camera_body = pymunk.Body(mass=.00000001, moment=pymunk.moment_for_circle(1, 0, 3))
-
-    # Add bodies to space
-    SPACE.add(player_shape)
-    SPACE.add(player_body)
-    SPACE.add(camera_body)
-    player_body.position = (0, 0)
-    camera_body.position = (0, 0)
-
-    for i in range(100):
-        planets.append(Planet(radius=random.randint(30, 60), mass=1000 - 1 * i))
-        planet_shapes.append(planets[i].shape)
-
-    # Generate 1000 stars. These will be automatically added to the Star._stars list, and will replace themselves with
-    # new stars if they exit the active zone
-    for i in range(1000):
-        pass
-        Star(color=random.choice(list(color.THECOLORS.values())), size=0, on_screen=True)
-
-    # Collision handling stuff
-    player_planet_handler = SPACE.add_collision_handler(PLAYER, PLANET)
-    player_planet_handler.post_solve = player_planet_collision
-    laser_planet_handler  = SPACE.add_collision_handler(LASER, PLANET)
-    laser_planet_handler.begin = laser_planet_collision
-
     # ------------------------------------- Sound --------------------------------------------------------
-    # Play Music
-    pygame.mixer.init(22100, -16, 2, 64)
-    pygame.mixer.music.load('resources/punch-deck-feel-the-pulse.mp3')
-    pygame.mixer.music.play(-1, 0.0)
-
-    # Load sound effects
-    crash_sound = pygame.mixer.Sound('resources/click.ogg')
-    rocket_boost_sound = pygame.mixer.Sound('resources/rocket_boost.ogg')
-    if not fun_mode:
-        laser_sound = pygame.mixer.Sound('resources/laser.ogg')
-    else:
-        laser_sound = pygame.mixer.Sound('resources/fun_laser.ogg')
-
-    # Create sound channels
+    # Play Music. It is streamed from the file as it plays, so only the start of it is loaded here
+    with ASSETS.timed('music'):
+        pygame.mixer.init(22100, -16, 2, 64)
+        pygame.mixer.music.load(ASSETS.file(MUSIC_FILE))
+        pygame.mixer.music.play(-1, 0.0)
+
+    # Sound effects are loaded in the background while the menu is up. The rocket boost is first, since it is needed
+    # as soon as the game starts
+    SOUNDS = SoundBank(preload=SOUND_EFFECTS, assets=ASSETS)
+    ASSETS.mark('preload started')
     rocket_boost_channel: pygame.mixer.Channel = pygame.mixer.Channel(0)
-    rocket_boost_channel.play(rocket_boost_sound, -1)                      # Play a sound but pause it, to be unpaused
-    rocket_boost_channel.pause()                                           # When the rocket is boosting
-
-    # Initialize player values for fuel, health, etc.
-    rocket_fuel = 100
-    player_health = 100
-    ammunition = 100
-    game_over_string = ''
 
-    # Set the starting game mode, the menu
-    game_mode = MENU
-    title_font = pygame.font.Font('resources/Airstream.ttf', 64)
-    button_font = pygame.font.Font('resources/Airstream.ttf', 24)
+    def start_rocket_boost():
+        """Plays the rocket boost sound but pauses it, to be unpaused when the rocket is boosting"""
+        rocket_boost_channel.play(SOUNDS.get('rocket_boost'), -1)
+        rocket_boost_channel.pause()
+
+    # Set up the world, starting at the menu. Recordings are replayed in the same world they were recorded in
+    replay = Recording.load(replay_path) if replay_path is not None else None
+    if replay is not None:
+        seed = replay.seed
+        print('Replaying', replay_path, '(' + str(len(replay)), 'ticks, seed', str(seed) + ')')
+    elif seed is None:
+        seed = random.randrange(2 ** 32)
+    seed_random(seed)
+    with ASSETS.timed('world'):
+        if replay is not None:
+            game = Game(replay.num_planets, replay.num_stars, replay.game_length, replay.sector_size)
+        else:
+            game = Game(sector_size=sector_size)
+    recording = Recording(seed, game.num_planets, game.num_stars, game.game_length, sector_size=game.sector_size) \
+        if record_path is not None else None
+    controls_for_tick = replay_controls(replay) if replay is not None else None
+    star_field = game.star_field
+    with ASSETS.timed('fonts'):
+        title_font = load_font(ASSETS.file(FONT_FILE), 64)
+        button_font = load_font(ASSETS.file(FONT_FILE), 24)
 
     start_button_rect = pygame.rect.Rect(WIN_WIDTH / 2 - 60, WIN_HEIGHT * (2 / 3), 120, 50)
 
-    start_time = 0
+    # Text for each screen. Text is only rendered again when its value changes
+    menu_hud = Hud()
+    menu_hud.add('start', button_font, color.THECOLORS['black'], 'START', center=start_button_rect.center)
+    menu_hud.add('instructions_one', button_font, color.THECOLORS['orange'], 'Fly with arrow keys, fire with spacebar.',
+                 center=(WIN_WIDTH/2, WIN_HEIGHT * 1/2))
+    menu_hud.add('instructions_two', button_font, color.THECOLORS['orange'],
+                 "Don't crash, and don't let fuel, time, or ammo run out!", center=(WIN_WIDTH / 2, WIN_HEIGHT * 1/2 + 35))
+    menu_hud.add('title', title_font, color.THECOLORS['white'], 'Space Game', center=(WIN_WIDTH/2, WIN_HEIGHT/3))
+
+    play_hud = Hud()
+    play_hud.add('timer', button_font, color.THECOLORS['white'], center=(WIN_WIDTH/2, WIN_HEIGHT/12))
+    play_hud.add('score', button_font, color.THECOLORS['gray'], center=(WIN_WIDTH/2, WIN_HEIGHT/12 + 25))
+
+    game_over_hud = Hud()
+    game_over_hud.add('title', title_font, color.THECOLORS['white'], 'Game Over!', center=(WIN_WIDTH / 2, WIN_HEIGHT / 3))
+    game_over_hud.add('score', title_font, color.THECOLORS['gray'], center=(WIN_WIDTH/2, WIN_HEIGHT/2))
+    game_over_hud.add('details', button_font, color.THECOLORS['white'], center=(WIN_WIDTH/2, WIN_HEIGHT * 2/3))
+
+    # Physics runs at a fixed rate, separately from how often the screen is drawn
+    physics = FixedTimestep(SPACE, FPS)
+    # The last REWIND_SECONDS of snapshots, newest last. Rewinding would throw a recording or replay out of sync with
+    # the controls, so it is only possible in a normal game
+    rewind_buffer = SnapshotRing(REWIND_SECONDS * FPS)
+    can_rewind = recording is None and replay is None
+    # The tick that rewinding has gone back to, or None when not rewinding
+    rewind_tick = None
+    profiler_overlay = ProfilerOverlay(PROFILER, topright=(WIN_WIDTH, 0))
+    # Fire presses are saved up until the next physics tick
+    fire_presses = 0
+
+    # Only the parts of the screen that changed are sent to the display. drawn_screen is the game mode that the
+    # screen was last fully drawn for, so the menu and game over screens are only drawn once
+    dirty_rects = DirtyRects()
+    drawn_screen = None
+    start_button_hovered = None
+
+    def end_session():
+        """Saves the recording, or checks the replay, once the game is over (or is quit partway through)"""
+        nonlocal recording, replay
+        if recording is not None:
+            recording.finish(score, game.game_over_string)
+            print('Saved recording to', recording.save(record_path))
+            recording = None
+        if replay is not None:
+            differences = replay.check(score, game.game_over_string)
+            print('Replay matched the recording' if not differences else 'Replay did not match: ' +
+                  ', '.join(differences))
+            replay = None
+
+    # A replay skips the menu
+    if replay is not None:
+        start_rocket_boost()
+        game.start()
+    # Startup times are printed once the sound effects have finished loading
+    startup_reported = False
 
     # ------------------------------------ Game Loop ---------------------------------------------------
     while True:
+        PROFILER.begin_frame()
 
         # Deal with events
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                terminate()
-
-            if event.type == pygame.KEYDOWN:
-                if event.key == pygame.K_ESCAPE:
+        with PROFILER.phase('events'):
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    end_session()
                     terminate()
-                if event.key == pygame.K_UP and game_mode == PLAY and rocket_fuel > 0:
-                    rocket_boost_channel.unpause()
-                if event.key == pygame.K_SPACE:
-                    if game_mode == PLAY and ammunition > 0:
-                        laser_sound.stop()
-                        laser_sound.play()
-                        laser_body, laser_shape = create_player_ammunition(player_shape)
-                        lasers.append(laser_shape)
-                        SPACE.add(laser_body, laser_shape)
-                        ammunition -= 1
-
-            player_body.angular_velocity = 0
-
-            if event.type == pygame.KEYUP:
-                if event.key == pygame.K_UP and game_mode == PLAY:
-                    rocket_boost_channel.pause()
-
-            if event.type == pygame.MOUSEBUTTONDOWN:
-                if game_mode==MENU and start_button_rect.collidepoint(*pygame.mouse.get_pos()):
-                    start_game_sound = pygame.mixer.Sound('resources/click_button.ogg')
-                    start_game_sound.play()
-                    game_mode = PLAY
-                    start_time = pygame.time.get_ticks()
-
-        if game_mode == MENU:
-            # Draw background
-            DISPLAY_SURF.fill(color.Color(7, 0, 15, 255))
-            draw_objects(Star._stars)
-
-            # Draw the menu button
+
+                if event.type == pygame.KEYDOWN:
+                    if event.key == pygame.K_ESCAPE:
+                        end_session()
+                        terminate()
+                    if event.key == pygame.K_SPACE and game.game_mode == PLAY:
+                        fire_presses += 1
+                    if event.key == pygame.K_F3:
+                        profiler_overlay.toggle()
+                        # The menu and game over screens need drawn again to get rid of the overlay
+                        drawn_screen = None
+                    if event.key == pygame.K_F4:
+                        print('Saved frame trace to', PROFILER.export(TRACE_CSV_PATH))
+                    if event.key == pygame.K_F5:
+                        print('Saved frame trace to', PROFILER.export(TRACE_JSON_PATH))
+                    if event.key == pygame.K_F6 and game.game_mode == PLAY:
+                        print('Saved game to', game.capture().save(SAVE_GAME_PATH))
+                    if event.key == pygame.K_F9 and game.game_mode == PLAY and can_rewind:
+                        if os.path.exists(SAVE_GAME_PATH):
+                            game = game_from_snapshot(Snapshot.load(SAVE_GAME_PATH), game)
+                            # A save game with other settings is loaded into a brand new world
+                            star_field = game.star_field
+                            physics = FixedTimestep(SPACE, FPS)
+                            rewind_buffer.clear()
+                            rewind_tick = None
+                            print('Loaded game from', SAVE_GAME_PATH)
+                        else:
+                            print('There is no saved game at', SAVE_GAME_PATH)
+
+                if event.type == pygame.MOUSEBUTTONDOWN:
+                    if game.game_mode == MENU and start_button_rect.collidepoint(*pygame.mouse.get_pos()):
+                        SOUNDS.play('click_button')
+                        start_rocket_boost()
+                        game.start()
+                        physics.reset()
+
+        if profiler_overlay.update() and game.game_mode != PLAY:
+            # Draw the screen again under the new numbers
+            drawn_screen = None
+
+        if game.game_mode == MENU:
+            if drawn_screen != MENU:
+                # Draw background, along with the button, instruction and title text
+                DISPLAY_SURF.fill(color.Color(7, 0, 15, 255))
+                star_field.draw()
+                menu_hud.draw(DISPLAY_SURF)
+                dirty_rects.redraw_all()
+                drawn_screen = MENU
+                start_button_hovered = None
+
+            # Draw the menu button, but only when the mouse moves on or off of it
             mouse_pos = pygame.mouse.get_pos()
-            start_button_color = color.Color(0, 180, 255, 255) if start_button_rect.collidepoint(*mouse_pos) \
-                                                               else color.Color(0, 100, 150, 255)
-            pygame.draw.rect(DISPLAY_SURF, start_button_color, start_button_rect)
-            pygame.draw.rect(DISPLAY_SURF, color.Color(160, 160, 160, 255), start_button_rect, 2)
-
-            button_text = button_font.render('START', True, color.THECOLORS['black'])
-            button_text_rect = button_text.get_rect()
-            button_text_rect.center = start_button_rect.center
-            DISPLAY_SURF.blit(button_text, button_text_rect)
-
-            instructions_one_text = button_font.render('Fly with arrow keys, fire with spacebar.', True, color.THECOLORS['orange'])
-            instructions_one_rect = instructions_one_text.get_rect()
-            instructions_one_rect.center = (WIN_WIDTH/2, WIN_HEIGHT * 1/2)
-            DISPLAY_SURF.blit(instructions_one_text, instructions_one_rect)
-
-            instructions_two_text = button_font.render("Don't crash, and don't let fuel, time, or ammo run out!", True,
-                                                       color.THECOLORS['orange'])
-            instructions_two_rect = instructions_two_text.get_rect()
-            instructions_two_rect.center = (WIN_WIDTH / 2, WIN_HEIGHT * 1/2 + 35)
-            DISPLAY_SURF.blit(instructions_two_text, instructions_two_rect)
-
-            # Draw the title text
-            title_text = title_font.render('Space Game', True, color.THECOLORS['white'])
-            title_text_rect = title_text.get_rect()
-            title_text_rect.center = (WIN_WIDTH/2, WIN_HEIGHT/3)
-            DISPLAY_SURF.blit(title_text, title_text_rect)
-
-        if game_mode == PLAY:
+            if start_button_rect.collidepoint(*mouse_pos) != start_button_hovered:
+                start_button_hovered = start_button_rect.collidepoint(*mouse_pos)
+                start_button_color = color.Color(0, 180, 255, 255) if start_button_hovered \
+                                                                   else color.Color(0, 100, 150, 255)
+                pygame.draw.rect(DISPLAY_SURF, start_button_color, start_button_rect)
+                pygame.draw.rect(DISPLAY_SURF, color.Color(160, 160, 160, 255), start_button_rect, 2)
+                menu_hud['start'].draw(DISPLAY_SURF)
+                dirty_rects.add(start_button_rect)
+
+        if game.game_mode == PLAY:
             '''This stuff is only to be run if the game is in "play" mode'''
-            time_elapsed = round((pygame.time.get_ticks() - start_time)/1000)
-            time_remaining = 60 - time_elapsed
-
-            # React to held keys
             keys = pygame.key.get_pressed()
-            if keys[K_UP]:
-                # Provide forward force in direction the player is pointing
-                if rocket_fuel > 0:
-                    player_body.apply_impulse_at_local_point(Vec2d(800, 0).rotated(-2 * player_body.angle))
-                    rocket_fuel -= .25
-
-            if keys[K_LEFT]:
-                player_body.angle -= .13
-            if keys[K_RIGHT]:
-                player_body.angle += .13
-
-            # Check for game overs
-            if rocket_fuel <= 0:
-                rocket_fuel = 0
+            rewinding = can_rewind and keys[K_BACKSPACE]
+            for dt in physics.steps():
+                if rewinding:
+                    # Step back one tick instead of forward, for as long as there are snapshots left. When snapshots
+                    # are several ticks apart, each one stays on screen for that many ticks
+                    rewind_tick = (game.ticks if rewind_tick is None else rewind_tick) - 1
+                    snapshot = rewind_buffer.rewind(rewind_tick)
+                    if snapshot is not None and snapshot.ticks != game.ticks:
+                        with PROFILER.phase('rewind'):
+                            game.restore(snapshot)
+                    fire_presses = 0
+                    continue
+                rewind_tick = None
+                if can_rewind:
+                    with PROFILER.phase('snapshot'):
+                        rewind_buffer.update(game.ticks, game.capture)
+                if controls_for_tick is not None:
+                    controls = controls_for_tick(game.ticks)
+                else:
+                    controls = Controls(thrust=bool(keys[K_UP]), left=bool(keys[K_LEFT]), right=bool(keys[K_RIGHT]),
+                                        fire=fire_presses)
+                if recording is not None:
+                    recording.record(controls)
+                with PROFILER.phase('update'):
+                    game.update(controls)
+                fire_presses = 0
+                # Physics tick
+                game.step()
+                if game.game_mode != PLAY:
+                    end_session()
+                    break
+                if replay is not None and game.ticks >= len(replay):
+                    # The recorded game was quit before it was over, so the replay stops where it did
+                    end_session()
+                    game.game_mode = GAME_OVER
+                    break
+            if game.boosting:
+                rocket_boost_channel.unpause()
+            else:
                 rocket_boost_channel.pause()
-                game_mode = GAME_OVER
-                game_over_string = 'Out of fuel!'
-                pygame.mixer.music.stop()
-                game_over_sound = pygame.mixer.Sound('resources/out_of_gas.ogg')
-                game_over_sound.play()
-
-            if player_health <= 0:
-                player_health = 0
-                game_mode = GAME_OVER
-                game_over_string = 'Your ship wrecked!'
-                pygame.mixer.music.stop()
-                game_over_sound = pygame.mixer.Sound('resources/crash.ogg')
-                game_over_sound.play()
-
-            if ammunition <= 0:
-                ammunition = 0
-                game_mode = GAME_OVER
-                game_over_string = 'Out of ammunition!'
-                pygame.mixer.music.stop()
-                game_over_sound = pygame.mixer.Sound('resources/out_of_ammo.ogg')
-                game_over_sound.play()
-
-            if time_remaining <= 0:
-                game_mode = GAME_OVER
-                game_over_string = "Time's up!"
-                pygame.mixer.music.stop()
-                game_over_sound = pygame.mixer.Sound('resources/times_up.ogg')
-                game_over_sound.play()
-
-            player_body.angular_velocity = 0
-
-            # Move the camera body and center the camera on it
-            camera_body.velocity = player_body.velocity * .8 + (player_body.position - camera_body.position) * 2
-            center_camera_on(camera_body)
-
-            # Check for stars going outside
-            for star in Star._stars:
-                star.update_pg_coords()
-
-            # Draw stuff
-            DISPLAY_SURF.fill(color.Color(7, 0, 15, 255))
-            draw_objects(Star._stars)
-            draw_objects(planets)
-            draw_lasers(lasers)
-            draw_pymunk_circles(circle_shapes)
-
-            draw_fuel(rocket_fuel)
-            draw_health(player_health)
-            draw_ammo(ammunition)
-
-
-            # Draw timer/score box
-            box_rectangle = Rect(0, 0, 200, 60)
-            box_rectangle.center = (WIN_WIDTH/2, WIN_HEIGHT/10)
-            pygame.draw.rect(DISPLAY_SURF, color.THECOLORS['black'], box_rectangle)
-            pygame.draw.rect(DISPLAY_SURF, color.THECOLORS['white'], box_rectangle, 2)
-            # Draw timer
-            timer_text = button_font.render(str(time_remaining), True, color.THECOLORS['white'])
-            timer_text_rect = timer_text.get_rect()
-            timer_text_rect.center = (WIN_WIDTH/2, WIN_HEIGHT/12)
-            DISPLAY_SURF.blit(timer_text, timer_text_rect)
-
-            # Draw score
-            score_text = button_font.render(str(score), True, color.THECOLORS['gray'])
-            score_text_rect = score_text.get_rect()
-            score_text_rect.center = (WIN_WIDTH/2, WIN_HEIGHT/12 + 25)
-            DISPLAY_SURF.blit(score_text, score_text_rect)
-
-            # Physics tick
-            dt = 1. / FPS
-            SPACE.step(dt)
-
-        if game_mode == GAME_OVER:
-            rocket_boost_sound.stop()
-            # Display background
-            DISPLAY_SURF.fill(color.Color(7, 0, 15, 255))
-            draw_objects(Star._stars)
-
-            # Large "GAME OVER" text
-            game_over_text = title_font.render('Game Over!', True, color.THECOLORS['white'])
-            game_over_text_rect = game_over_text.get_rect()
-            game_over_text_rect.center = (WIN_WIDTH / 2, WIN_HEIGHT / 3)
-            DISPLAY_SURF.blit(game_over_text, game_over_text_rect)
-
-            # Score
-            score_text = title_font.render(str(score), True, color.THECOLORS['gray'])
-            score_text_rect = score_text.get_rect()
-            score_text_rect.center = (WIN_WIDTH/2, WIN_HEIGHT/2)
-            DISPLAY_SURF.blit(score_text, score_text_rect)
-
-            # Details on how the player lost
-            loss_details_text = button_font.render(game_over_string, True, color.THECOLORS['white'])
-            loss_details_text_rect = loss_details_text.get_rect()
-            loss_details_text_rect.center = (WIN_WIDTH/2, WIN_HEIGHT * 2/3)
-            DISPLAY_SURF.blit(loss_details_text, loss_details_text_rect)
-
 
+            # Draw stuff, with everything moved to where it is between the last two physics ticks
+            with PROFILER.phase('draw'), physics.interpolated():
+                center_camera_on(game.camera_body)
+                DISPLAY_SURF.fill(color.Color(7, 0, 15, 255))
+                star_field.draw()
+                # Only the planets and lasers in grid cells under the camera are drawn
+                draw_planets(PLANET_GRID.query(*camera_bounds(), margin=PLANET_DRAW_MARGIN))
+                draw_lasers(LASER_GRID.query(*camera_bounds(), margin=LASER_DRAW_MARGIN))
+                draw_pymunk_circles(circle_shapes)
+
+            # The world moves every frame, so the whole screen is sent to the display, HUD included
+            drawn_screen = PLAY
+            dirty_rects.redraw_all()
+
+            with PROFILER.phase('hud'):
+                draw_fuel(game.rocket_fuel)
+                draw_health(player_health)
+                draw_ammo(game.ammunition)
+
+                # Draw timer/score box
+                box_rectangle = Rect(0, 0, 200, 60)
+                box_rectangle.center = (WIN_WIDTH/2, WIN_HEIGHT/10)
+                pygame.draw.rect(DISPLAY_SURF, color.THECOLORS['black'], box_rectangle)
+                pygame.draw.rect(DISPLAY_SURF, color.THECOLORS['white'], box_rectangle, 2)
+                # Draw timer and score
+                play_hud.set('timer', str(game.time_remaining))
+                play_hud.set('score', str(score))
+                play_hud.draw(DISPLAY_SURF)
+
+        if game.game_mode == GAME_OVER:
+            rocket_boost_channel.stop()
+            if drawn_screen != GAME_OVER:
+                # Display background
+                DISPLAY_SURF.fill(color.Color(7, 0, 15, 255))
+                star_field.draw()
+
+                # Large "GAME OVER" text, the score, and details on how the player lost
+                game_over_hud.set('score', str(score))
+                game_over_hud.set('details', game.game_over_string)
+                game_over_hud.draw(DISPLAY_SURF)
+                dirty_rects.redraw_all()
+                drawn_screen = GAME_OVER
+
+        with PROFILER.phase('hud'):
+            dirty_rects.add(profiler_overlay.draw(DISPLAY_SURF))
 
         # Update display
-        pygame.display.update()
-        FPS_CLOCK.tick(FPS)
+        with PROFILER.phase('display'):
+            SPRITES.end_frame()
+            dirty_rects.update_display()
+        ASSETS.mark('first frame')
+        if not startup_reported and not ASSETS.loading:
+            ASSETS.mark('assets loaded')
+            print(ASSETS.report())
+            startup_reported = True
+        count_entities(game)
+        with PROFILER.phase('wait'):
+            FPS_CLOCK.tick(MAX_RENDER_FPS if game.game_mode == PLAY else IDLE_FPS)
+        PROFILER.end_frame()
+
+
+def headless_main(ticks, trace_path=None, seed=None, record_path=None, replay_path=None, sector_size=None):
+    """Runs the game headless (see run_headless) and prints how fast it went, and the average time of each phase of a
+    tick. If trace_path is given, the per-tick times are saved there as CSV (or JSON if it ends in .json).
+
+    The autopilot flies the ship, unless replay_path is given. Then the recording saved there is played back as fast
+    as possible and its outcome is checked. If record_path is given, the autopilot's game is recorded there"""
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    replay = Recording.load(replay_path) if replay_path is not None else None
+    recording = Recording(seed, 100, NUM_STARS, Game.GAME_LENGTH, sector_size=sector_size) if record_path is not None \
+        else None
+
+    start = time.perf_counter()
+    if replay is not None:
+        game = run_headless(len(replay), replay_controls(replay), replay.num_planets, replay.num_stars, replay.seed,
+                            game_length=replay.game_length, sector_size=replay.sector_size)
+    else:
+        game = run_headless(ticks, seed=seed, recording=recording, sector_size=sector_size)
+    elapsed = time.perf_counter() - start
+    print('Ticks:', game.ticks, ' Seconds:', round(elapsed, 3), ' Ticks per second:', round(game.ticks / elapsed, 1))
+    print('Score:', score, ' Game over:', game.game_over_string or 'no')
+    total, phases, counts = PROFILER.averages(game.ticks)
+    print('Average ms per tick:', round(total, 3), ' ' +
+          '  '.join(name + ': ' + str(round(phase_time, 3)) for name, phase_time in phases.items()))
+    if trace_path is not None:
+        print('Saved frame trace to', PROFILER.export(trace_path))
+    if recording is not None:
+        print('Saved recording to', recording.save(record_path))
+    if replay is not None:
+        differences = replay.check(score, game.game_over_string)
+        print('Replay matched the recording' if not differences else 'Replay did not match: ' + ', '.join(differences))
+        return not differences
+    return True
 
 
 if __name__ == '__main__':
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description='Space Game')
+    parser.add_argument('--headless', type=int, nargs='?', const=3600, metavar='TICKS',
+                        help='run without a window or sound, as fast as possible (3600 ticks by default)')
+    parser.add_argument('--trace', help='with --headless, save the time of each tick to this CSV or JSON file')
+    parser.add_argument('--seed', type=int, help='build the world from this seed')
+    parser.add_argument('--record', metavar='PATH', help='record the controls of the game to this file')
+    parser.add_argument('--replay', metavar='PATH', help='play back a recording, and check that it ends the same way')
+    parser.add_argument('--sectors', type=int, nargs='?', const=SECTOR_SIZE, metavar='SIZE',
+                        help='stream an endless world in sectors generated from the seed (%d wide by default)'
+                             % SECTOR_SIZE)
+    arguments = parser.parse_args()
+
+    if arguments.headless is not None:
+        matched = headless_main(arguments.headless, arguments.trace, arguments.seed, arguments.record, arguments.replay,
+                                arguments.sectors)
+        sys.exit(0 if matched else 1)
+    else:
+        main(arguments.seed, arguments.record, arguments.replay, arguments.sectors)
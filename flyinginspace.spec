@@ -1,12 +1,23 @@
 # -*- mode: python ; coding: utf-8 -*-
+import os
+import sys
 
 block_cipher = None
 
+# Pack the assets the game uses into one file (see assetpack.py). Only that file is bundled, so nothing else in the
+# resources folder (like the LMMS projects, presets and .bak files under resources/explosions) ends up in the build
+sys.path.insert(0, SPECPATH)
+from assetpack import build_pack, DEFAULT_OUTPUT
+from assets import RESOURCE_DIRECTORY
+from flyinginspace import RESOURCE_FILES
+pack_path = os.path.join(SPECPATH, DEFAULT_OUTPUT)
+build_pack(RESOURCE_FILES, pack_path, RESOURCE_DIRECTORY)
+
 
 a = Analysis(['flyinginspace.py'],
              pathex=['C:\\Users\\caleb\\PycharmProjects\\learningPython\\pythonclass\\project'],
              binaries=[],
-             datas=[],
+             datas=[(pack_path, '.')],
              hiddenimports=[],
              hookspath=[],
              runtime_hooks=[],
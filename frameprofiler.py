@@ -0,0 +1,192 @@
+"""Per-frame profiler for flyinginspace.
+
+Each part of a frame (handling events, game logic, physics, drawing, ...) is timed inside a "with profiler.phase(name)"
+block. Phases can be inside of other phases, and a phase's time doesn't include the phases inside of it, so the phase
+times of a frame add up to the whole frame. Numbers that aren't times (like how many planets there are) are recorded
+with count.
+
+The last max_frames frames are kept, and can be saved as a CSV or JSON trace with one row per frame, or shown on the
+screen with ProfilerOverlay.
+
+Usage:
+    profiler = FrameProfiler()
+    while running:
+        profiler.begin_frame()
+        with profiler.phase('events'):
+            ...
+        profiler.count('planets', len(planets))
+        profiler.end_frame()
+"""
+import csv
+import json
+import time
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+
+import pygame
+
+from textcache import TextCache, Hud, sys_font
+
+
+class FrameProfiler:
+    """Class that times the phases of each frame. Times are stored in milliseconds"""
+    def __init__(self, max_frames=3600, clock=time.perf_counter):
+        self.clock = clock
+        self.frames = deque(maxlen=max_frames)
+        # Every phase and count name that has been seen, in the order they were first seen (the trace's columns)
+        self.phase_names = []
+        self.count_names = []
+        self.frame_number = 0
+
+        self._frame = None
+        self._frame_start = None
+        # Phases that are currently running, as [name, start time, time spent in phases inside of it]
+        self._stack = []
+
+    def begin_frame(self):
+        self._frame = {'phases': {}, 'counts': {}}
+        self._frame_start = self.clock()
+
+    @contextmanager
+    def phase(self, name):
+        """Times the code inside of the with block as part of phase "name" of the current frame. If the same phase
+        runs more than once in a frame (like one physics step after another), the times are added together"""
+        if self._frame is None:
+            # Not inside of a frame, so there is nothing to add the time to
+            yield
+            return
+        entry = [name, self.clock(), 0.]
+        self._stack.append(entry)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = self.clock() - entry[1]
+            if self._stack:
+                self._stack[-1][2] += elapsed
+            if name not in self._frame['phases']:
+                self._frame['phases'][name] = 0.
+                if name not in self.phase_names:
+                    self.phase_names.append(name)
+            self._frame['phases'][name] += (elapsed - entry[2]) * 1000
+
+    def count(self, name, value):
+        """Records a number for the current frame, like how many objects there are"""
+        if self._frame is None:
+            return
+        if name not in self.count_names:
+            self.count_names.append(name)
+        self._frame['counts'][name] = value
+
+    def end_frame(self):
+        """Finishes the current frame and stores it. Returns the frame's record"""
+        if self._frame is None:
+            return None
+        self._frame['frame'] = self.frame_number
+        self._frame['total'] = (self.clock() - self._frame_start) * 1000
+        self.frames.append(self._frame)
+        self.frame_number += 1
+        frame, self._frame = self._frame, None
+        return frame
+
+    def averages(self, num_frames=60):
+        """Returns (average frame time, {phase: average time}, {count: latest value}) over the last num_frames
+        frames"""
+        recent = list(self.frames)[-num_frames:]
+        if not recent:
+            return 0., {}, {}
+        total = sum(frame['total'] for frame in recent) / len(recent)
+        phases = OrderedDict((name, sum(frame['phases'].get(name, 0.) for frame in recent) / len(recent))
+                             for name in self.phase_names)
+        counts = OrderedDict((name, recent[-1]['counts'][name])
+                             for name in self.count_names if name in recent[-1]['counts'])
+        return total, phases, counts
+
+    def rows(self):
+        """Returns one flat dictionary per stored frame: frame number, total time, each phase's time (in ms) and
+        each count. Phases that didn't happen in a frame are 0"""
+        rows = []
+        for frame in self.frames:
+            row = OrderedDict([('frame', frame['frame']), ('total_ms', round(frame['total'], 4))])
+            for name in self.phase_names:
+                row[name + '_ms'] = round(frame['phases'].get(name, 0.), 4)
+            for name in self.count_names:
+                row[name] = frame['counts'].get(name, '')
+            rows.append(row)
+        return rows
+
+    def export(self, path):
+        """Saves the stored frames to path, as JSON if it ends in .json and as CSV otherwise"""
+        rows = self.rows()
+        if path.endswith('.json'):
+            with open(path, 'w') as trace_file:
+                json.dump({'phases': self.phase_names, 'counts': self.count_names, 'frames': rows}, trace_file)
+        else:
+            with open(path, 'w', newline='') as trace_file:
+                columns = ['frame', 'total_ms'] + [name + '_ms' for name in self.phase_names] + self.count_names
+                writer = csv.DictWriter(trace_file, columns)
+                writer.writeheader()
+                writer.writerows(rows)
+        return path
+
+
+class ProfilerOverlay:
+    """Class that shows a profiler's average phase times and counts in a box in the corner of the screen. The numbers
+    are only updated every refresh_frames frames, so they are readable, and so the text isn't rendered every frame"""
+    LINE_HEIGHT = 16
+
+    def __init__(self, profiler: FrameProfiler, refresh_frames=30, topright=(0, 0)):
+        self.profiler = profiler
+        self.refresh_frames = refresh_frames
+        self.topright = topright
+        self.visible = False
+        # The numbers change all the time, so they get their own small cache instead of filling up the shared one
+        self.cache = TextCache(max_size=64)
+        self.font = sys_font('Courier New', 14)
+        self.hud = Hud(self.cache)
+        self.rect = None
+        self._last_refresh = None
+
+    def toggle(self):
+        self.visible = not self.visible
+        self._last_refresh = None
+        return self.visible
+
+    def lines(self):
+        total, phases, counts = self.profiler.averages(self.refresh_frames)
+        fps = 1000 / total if total else 0
+        lines = ['frame   %6.2f ms %5.0f fps' % (total, fps)]
+        lines += ['%-7s %6.2f ms' % (name[:7], phase_time) for name, phase_time in phases.items()]
+        lines += ['%-7s %6d' % (name[:7], value) for name, value in counts.items()]
+        return lines
+
+    def update(self):
+        """Refreshes the numbers if it is time to. Returns True if they changed, meaning the overlay needs drawn
+        again"""
+        if not self.visible:
+            return False
+        frame_number = self.profiler.frame_number
+        if self._last_refresh is not None and frame_number - self._last_refresh < self.refresh_frames:
+            return False
+        self._last_refresh = frame_number
+
+        lines = self.lines()
+        right, top = self.topright
+        changed = False
+        for i, line in enumerate(lines):
+            name = 'line' + str(i)
+            if name not in self.hud.items:
+                self.hud.add(name, self.font, (255, 255, 255), topright=(right - 5, top + 5 + i * self.LINE_HEIGHT))
+            changed = self.hud.set(name, line) or changed
+        width = max(item.rect.width for item in self.hud.items.values()) + 10
+        self.rect = pygame.Rect(0, 0, width, len(self.hud.items) * self.LINE_HEIGHT + 10)
+        self.rect.topright = self.topright
+        return changed
+
+    def draw(self, surface: pygame.Surface):
+        """Draws the overlay if it is visible. Returns the area that was drawn on, or None"""
+        if not self.visible or self.rect is None:
+            return None
+        surface.fill((0, 0, 0), self.rect)
+        self.hud.draw(surface)
+        return self.rect
@@ -0,0 +1,256 @@
+"""Playing flyinginspace from code, many games at once, for automated play testing.
+
+GameEnv is one game with its own world (see flyinginspace.WorldState), so any number of them can live in the same
+process. VectorRunner steps many GameEnvs in lockstep, spread over worker processes. The controls for every game go
+in as one array, and the observations, rewards and done flags of every game come back as arrays. All of these arrays
+are in shared memory, so nothing but a short "step" message goes through the pipes to the workers each step.
+
+Actions are one row of (thrust, left, right, fire) per game, like flyinginspace.Controls. Observations are one row of
+OBSERVATION_FIELDS per game:
+    x, y, angle, vx, vy - the player's position, angle and velocity
+    fuel, health, ammo, score, time_remaining
+    planetN_dx, planetN_dy, planetN_vx, planetN_vy, planetN_radius - position and velocity of the NEARBY_PLANETS
+        closest planets within NEARBY_RADIUS, relative to the player and closest first. Missing planets are all 0
+
+Usage:
+    with VectorRunner(64, seed=1) as runner:
+        observations = runner.reset()
+        while ...:
+            observations, rewards, dones = runner.step(actions)
+"""
+import os
+from multiprocessing import get_context
+
+import numpy as np
+
+import flyinginspace
+from flyinginspace import Controls, PLAY
+
+NEARBY_PLANETS = 8
+NEARBY_RADIUS = 800
+PLAYER_FIELDS = ['x', 'y', 'angle', 'vx', 'vy', 'fuel', 'health', 'ammo', 'score', 'time_remaining']
+PLANET_FIELDS = ['dx', 'dy', 'vx', 'vy', 'radius']
+OBSERVATION_FIELDS = PLAYER_FIELDS + ['planet' + str(i) + '_' + field
+                                      for i in range(NEARBY_PLANETS) for field in PLANET_FIELDS]
+OBSERVATION_SIZE = len(OBSERVATION_FIELDS)
+ACTION_SIZE = len(Controls._fields)
+
+
+class GameEnv:
+    """Class that holds one game of flyinginspace and plays it one tick at a time. The settings are the same as Game's,
+    and every episode is a brand new game (see reset)"""
+    def __init__(self, num_planets=100, num_stars=flyinginspace.NUM_STARS, game_length=None, sector_size=None):
+        self.num_planets = num_planets
+        self.num_stars = num_stars
+        self.game_length = game_length
+        self.sector_size = sector_size
+        self.world = None
+        self.game = None
+        self.score = 0
+        if flyinginspace.SOUNDS is None:
+            # There is no mixer, so this sound bank won't load or play anything
+            flyinginspace.SOUNDS = flyinginspace.SoundBank(preload=False)
+
+    @property
+    def done(self):
+        return self.game is None or self.game.game_mode != PLAY
+
+    def reset(self, seed=None):
+        """Starts a new game, built from seed"""
+        self.world = flyinginspace.WorldState(seed)
+        with self.world.active():
+            self.game = flyinginspace.Game(self.num_planets, self.num_stars, self.game_length, self.sector_size)
+            self.game.start()
+        self.score = 0
+
+    def step(self, action, out=None):
+        """Plays one tick with action (thrust, left, right, fire). Returns (reward, done), where the reward is how
+        much the score went up. If out is given, the observation after the tick is written into it (see observe)"""
+        thrust, left, right, fire = action
+        # Swapping the world in and out isn't free, so the observation is taken while it is still active
+        with self.world.active():
+            self.game.update(Controls(bool(thrust), bool(left), bool(right), int(fire)))
+            self.game.step()
+            reward = flyinginspace.score - self.score
+            self.score = flyinginspace.score
+            if out is not None:
+                self._observe(out)
+        return reward, self.done
+
+    def observe(self, out=None):
+        """Fills out (an array of OBSERVATION_SIZE, made if it isn't given) with the current observation and returns
+        it"""
+        if out is None:
+            out = np.zeros(OBSERVATION_SIZE)
+        with self.world.active():
+            return self._observe(out)
+
+    def _observe(self, out):
+        game = self.game
+        player = game.player_body
+        x_pos, y_pos = player.position
+        x_velocity, y_velocity = player.velocity
+        out[:len(PLAYER_FIELDS)] = (x_pos, y_pos, player.angle, x_velocity, y_velocity, game.rocket_fuel,
+                                    flyinginspace.player_health, game.ammunition, flyinginspace.score,
+                                    game.time_remaining)
+
+        nearby = flyinginspace.PLANET_GRID.query(x_pos, y_pos, x_pos, y_pos, margin=NEARBY_RADIUS)
+        planet_rows = np.array([(*planet.body.position, *planet.body.velocity, planet.radius) for planet in nearby],
+                               dtype=np.float64).reshape(-1, len(PLANET_FIELDS))
+        planet_rows[:, :4] -= (x_pos, y_pos, x_velocity, y_velocity)
+        distance = np.hypot(planet_rows[:, 0], planet_rows[:, 1])
+        # Ties are broken by position, so the order doesn't depend on the order the grid found them in
+        closest = np.lexsort((planet_rows[:, 1], planet_rows[:, 0], distance))
+        closest = closest[distance[closest] <= NEARBY_RADIUS][:NEARBY_PLANETS]
+
+        planets_out = out[len(PLAYER_FIELDS):].reshape(NEARBY_PLANETS, len(PLANET_FIELDS))
+        planets_out[:] = 0
+        planets_out[:len(closest)] = planet_rows[closest]
+        return out
+
+
+class _GameGroup:
+    """The games that one worker looks after: games first to first + len(games) of the runner, written into the
+    runner's shared arrays. Games that finish are reset straight away with their next seed"""
+    def __init__(self, first, count, seed, settings, actions, observations, rewards, dones):
+        self.first = first
+        self.games = [GameEnv(**settings) for _ in range(count)]
+        self.seed = seed
+        self.num_games = None
+        self.episodes = [0] * count
+        self.actions, self.observations, self.rewards, self.dones = actions, observations, rewards, dones
+
+    def episode_seed(self, index):
+        # Every episode of every game gets its own seed, which doesn't depend on how the games are split up
+        return self.seed + self.first + index + self.num_games * self.episodes[index]
+
+    def reset(self, num_games):
+        self.num_games = num_games
+        self.episodes = [0] * len(self.games)
+        for index, game in enumerate(self.games):
+            game.reset(self.episode_seed(index))
+            game.observe(self.observations[self.first + index])
+        self.rewards[self.first:self.first + len(self.games)] = 0
+        self.dones[self.first:self.first + len(self.games)] = False
+        return []
+
+    def step(self):
+        """Steps every game once. Returns the final scores of the games that finished"""
+        finished = []
+        for index, game in enumerate(self.games):
+            row = self.first + index
+            reward, done = game.step(self.actions[row], self.observations[row])
+            self.rewards[row] = reward
+            self.dones[row] = done
+            if done:
+                finished.append(game.score)
+                self.episodes[index] += 1
+                game.reset(self.episode_seed(index))
+                game.observe(self.observations[row])
+        return finished
+
+
+def _shared_array(context, dtype, shape):
+    """Returns (raw shared memory, numpy array that uses it)"""
+    dtype = np.dtype(dtype)
+    raw = context.RawArray('b', int(np.prod(shape)) * dtype.itemsize)
+    return raw, np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def _worker(pipe, first, count, seed, settings, raw_arrays, num_games):
+    arrays = [np.frombuffer(raw, dtype=dtype).reshape(shape) for raw, dtype, shape in raw_arrays]
+    group = _GameGroup(first, count, seed, settings, *arrays)
+    while True:
+        command = pipe.recv()
+        if command == 'step':
+            pipe.send(group.step())
+        elif command == 'reset':
+            pipe.send(group.reset(num_games))
+        else:
+            break
+    pipe.close()
+
+
+class VectorRunner:
+    """Class that steps num_games games of flyinginspace in lockstep, spread as evenly as possible over num_workers
+    processes (one per CPU by default). num_workers can be 0 to play every game in this process, which is handy for
+    debugging. Any other keyword arguments are the game settings (see GameEnv).
+
+    actions - (num_games, ACTION_SIZE) int8 array. Fill it in (or pass actions to step) before each step
+    observations - (num_games, OBSERVATION_SIZE) float64 array
+    rewards - (num_games,) float64 array of how much each game's score went up in the last step
+    dones - (num_games,) bool array, True for games that finished in the last step. Those games have already been
+            started again with a new seed, and their observation is the first one of the new game
+
+    Episode seeds come from seed, so a run with the same seed and actions gives the same results no matter how many
+    workers there are. episode_scores is every finished episode's final score, in the order they finished"""
+    def __init__(self, num_games, num_workers=None, seed=0, **settings):
+        self.num_games = num_games
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        self.num_workers = min(num_workers, num_games)
+        self.episode_scores = []
+        self.steps = 0
+
+        context = get_context('spawn')
+        shapes = [(np.int8, (num_games, ACTION_SIZE)), (np.float64, (num_games, OBSERVATION_SIZE)),
+                  (np.float64, (num_games,)), (np.bool_, (num_games,))]
+        shared = [_shared_array(context, dtype, shape) for dtype, shape in shapes]
+        self.actions, self.observations, self.rewards, self.dones = [array for _, array in shared]
+
+        # Games first to last + 1 go to each worker
+        splits = np.linspace(0, num_games, max(self.num_workers, 1) + 1).astype(int)
+        self._groups = []
+        self._pipes = []
+        self._processes = []
+        if self.num_workers == 0:
+            self._groups.append(_GameGroup(0, num_games, seed, settings, *(array for _, array in shared)))
+            return
+
+        raw_arrays = [(raw, np.dtype(dtype), shape) for (raw, _), (dtype, shape) in zip(shared, shapes)]
+        os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+        for first, last in zip(splits[:-1].tolist(), splits[1:].tolist()):
+            pipe, worker_pipe = context.Pipe()
+            process = context.Process(target=_worker, daemon=True,
+                                      args=(worker_pipe, first, last - first, seed, settings, raw_arrays, num_games))
+            process.start()
+            worker_pipe.close()
+            self._pipes.append(pipe)
+            self._processes.append(process)
+
+    def _run(self, command):
+        # Games played in this process (when num_workers is 0)
+        for group in self._groups:
+            self.episode_scores.extend(group.step() if command == 'step' else group.reset(self.num_games))
+        for pipe in self._pipes:
+            pipe.send(command)
+        for pipe in self._pipes:
+            self.episode_scores.extend(pipe.recv())
+
+    def reset(self):
+        """Starts every game from the beginning. Returns the observations"""
+        self._run('reset')
+        self.steps = 0
+        return self.observations
+
+    def step(self, actions=None):
+        """Plays one tick of every game. Returns (observations, rewards, dones)"""
+        if actions is not None:
+            self.actions[:] = actions
+        self._run('step')
+        self.steps += 1
+        return self.observations, self.rewards, self.dones
+
+    def close(self):
+        for pipe in self._pipes:
+            pipe.send('close')
+        for process in self._processes:
+            process.join()
+        self._pipes = []
+        self._processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
@@ -0,0 +1,236 @@
+"""Fixed timestep game loop used by flyinginspace, bouncinginspace and pymunkarrows.
+
+The physics always steps by the same amount of time (1 / rate), no matter how fast frames are being drawn. Each frame,
+the real time that has passed is added to an "accumulator", and as many physics steps are run as fit in it. Whatever
+is left over (less than one step) is used to draw the bodies partway between the last two physics steps, so motion
+stays smooth when the screen is drawn faster than the physics runs.
+
+Usage:
+    physics = FixedTimestep(space)
+    while running:
+        for dt in physics.steps():
+            ... game logic ...
+            space.step(dt)
+        with physics.interpolated():
+            ... draw ...
+
+PhysicsThread runs the same kind of fixed timestep loop on its own thread instead, so the physics and the drawing
+can happen at the same time:
+    physics_thread = PhysicsThread(step, bodies)
+    physics_thread.start()
+    while running:
+        physics_thread.call(...)   anything that changes the space is run on the physics thread, between steps
+        state = physics_thread.snapshot()
+        ... draw from state ...
+    physics_thread.stop()
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class FixedTimestep:
+    """Class that decides how many physics steps to run each frame, and how to draw the frame in between steps.
+
+    rate - physics steps per second
+    max_substeps - most physics steps to run in one frame. If the computer can't keep up, the extra time is dropped
+                   instead of running more and more steps every frame (the "spiral of death")
+    snap_distance - bodies that moved further than this in one step (like a planet being respawned) are drawn where
+                    they are instead of being interpolated
+    """
+    def __init__(self, space, rate=60, max_substeps=5, snap_distance=200, clock=time.perf_counter):
+        self.space = space
+        self.dt = 1. / rate
+        self.max_substeps = max_substeps
+        self.snap_distance = snap_distance
+        self.clock = clock
+
+        self.accumulator = 0.
+        self.dropped_steps = 0
+        self._last_time = None
+        # body -> (position, angle) just before the most recent step
+        self._previous_state = {}
+
+    @property
+    def alpha(self):
+        """How far (0 to 1) the current frame is between the previous physics step and the latest one"""
+        return self.accumulator / self.dt
+
+    def reset(self):
+        """Forget about any time that has passed, for example when the game leaves a menu"""
+        self.accumulator = 0.
+        self._last_time = None
+        self._previous_state = {}
+
+    def steps(self, frame_time=None):
+        """Generator that yields dt once for every physics step that should run this frame. The caller runs the game
+        logic and steps the space each time. frame_time is how much time passed since the last frame, measured with
+        clock if it isn't given"""
+        now = self.clock()
+        if frame_time is None:
+            frame_time = 0. if self._last_time is None else now - self._last_time
+        self._last_time = now
+        self.accumulator += frame_time
+
+        substeps = 0
+        while self.accumulator >= self.dt:
+            if substeps == self.max_substeps:
+                # Too far behind, so drop the extra time rather than trying to catch up
+                self.dropped_steps += int(self.accumulator // self.dt)
+                self.accumulator %= self.dt
+                break
+            self.save_state()
+            self.accumulator -= self.dt
+            substeps += 1
+            yield self.dt
+
+    def save_state(self):
+        """Remember where every body is before a physics step"""
+        self._previous_state = {body: (body.position, body.angle) for body in self.space.bodies}
+
+    @contextmanager
+    def interpolated(self):
+        """Inside this block, every body is moved to where it would be at the current point between the last two
+        physics steps. Everything is put back afterwards, so the simulation itself isn't changed"""
+        alpha = self.alpha
+        moved = []
+        for body in self.space.bodies:
+            if body not in self._previous_state:
+                continue
+            previous_position, previous_angle = self._previous_state[body]
+            position, angle = body.position, body.angle
+            if (position - previous_position).get_length() > self.snap_distance:
+                continue
+            moved.append((body, position, angle))
+            body.position = previous_position + (position - previous_position) * alpha
+            body.angle = previous_angle + (angle - previous_angle) * alpha
+            for shape in body.shapes:
+                shape.cache_bb()
+        try:
+            yield alpha
+        finally:
+            for body, position, angle in moved:
+                body.position = position
+                body.angle = angle
+                for shape in body.shapes:
+                    shape.cache_bb()
+
+
+class PhysicsThread:
+    """Class that runs the physics on its own thread, at a fixed rate, while the main thread draws.
+
+    step - function that runs one physics step. It is called with dt on the physics thread, and should do the game
+           logic and step the space
+    bodies - the bodies whose positions and angles are published after every step
+
+    After every step, the x, y and angle of each body are copied into one of two buffers, and the two are swapped, so
+    there is always a finished snapshot of the latest step and the one before it. snapshot() gives the main thread a
+    copy of these, blended the same way FixedTimestep.interpolated does, without ever waiting for a step to finish.
+
+    pymunk (and numpy) let go of Python's global interpreter lock while they do their heavy work, so the physics really
+    does run alongside the drawing. Nothing but the physics thread may touch the space once it is started: anything
+    else that needs to change it (like applying an impulse when the mouse is clicked) is passed to call"""
+    def __init__(self, step, bodies, rate=60, max_substeps=5, snap_distance=200, clock=time.perf_counter):
+        self.step_function = step
+        self.bodies = list(bodies)
+        self.dt = 1. / rate
+        self.max_substeps = max_substeps
+        self.snap_distance = snap_distance
+        self.clock = clock
+
+        self.steps_run = 0
+        self.dropped_steps = 0
+        # Set if the physics thread crashed, and raised again on the main thread by snapshot
+        self.error = None
+
+        # Snapshots of the step before the latest one, and of the latest one. Each row is x, y, angle of one body
+        self._previous = self.read_state()
+        self._latest = self._previous.copy()
+        self._latest_time = None
+        self._lock = threading.Lock()
+        # Functions waiting to be run on the physics thread. Appending and popping from a deque is thread safe
+        self._calls = deque()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def read_state(self):
+        """Returns an (n, 3) array of the x, y and angle of every body"""
+        return np.array([(*body.position, body.angle) for body in self.bodies], dtype=np.float64).reshape(-1, 3)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._stopping.clear()
+        self._latest_time = self.clock()
+        self._thread = threading.Thread(target=self._run, name='physics', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops the physics thread, after the step it is on finishes"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def call(self, function, *args):
+        """Runs function(*args) on the physics thread, before the next step"""
+        self._calls.append((function, args))
+
+    def _run(self):
+        next_step = self.clock()
+        try:
+            while not self._stopping.is_set():
+                now = self.clock()
+                if now < next_step:
+                    self._stopping.wait(next_step - now)
+                    continue
+
+                substeps = 0
+                while next_step <= now and substeps < self.max_substeps:
+                    while self._calls:
+                        function, args = self._calls.popleft()
+                        function(*args)
+                    self.step_function(self.dt)
+                    self._publish()
+                    next_step += self.dt
+                    substeps += 1
+                if next_step <= now:
+                    # Too far behind, so drop the extra time rather than trying to catch up
+                    behind = int((now - next_step) // self.dt) + 1
+                    self.dropped_steps += behind
+                    next_step += behind * self.dt
+        except Exception as error:
+            self.error = error
+
+    def _publish(self):
+        state = self.read_state()
+        with self._lock:
+            # The older buffer is overwritten with the new step, and becomes the latest one
+            self._previous, self._latest = self._latest, self._previous
+            self._latest[:] = state
+            self._latest_time = self.clock()
+            self.steps_run += 1
+
+    def snapshot(self):
+        """Returns an (n, 3) array of the x, y and angle of every body, partway between the last two physics steps
+        depending on how long ago the latest one finished"""
+        if self.error is not None:
+            raise RuntimeError('The physics thread stopped because of an error') from self.error
+        with self._lock:
+            previous = self._previous.copy()
+            latest = self._latest.copy()
+            latest_time = self._latest_time
+        if latest_time is None:
+            return latest
+
+        alpha = min(max((self.clock() - latest_time) / self.dt, 0.), 1.)
+        state = previous + (latest - previous) * alpha
+        # Bodies that jumped (like a respawned planet) are drawn where they are instead of being interpolated
+        jumped = np.hypot(latest[:, 0] - previous[:, 0], latest[:, 1] - previous[:, 1]) > self.snap_distance
+        state[jumped] = latest[jumped]
+        return state
@@ -1,8 +1,12 @@
 """Showcase of flying arrows that can stick to objects in a somewhat
 realistic looking way.
 """
+from collections import OrderedDict
+import itertools
 import sys
 
+import numpy as np
+
 import pygame
 from pygame.locals import *
 from pygame.color import *
@@ -11,6 +15,9 @@ import pymunk
 from pymunk.vec2d import Vec2d
 import pymunk.pygame_util
 
+from gameloop import FixedTimestep
+from textcache import Hud, sys_font
+
 
 def create_arrow():
     vs = [(-30, 0), (0, 3), (10, 0), (0, -3)]
@@ -24,45 +31,95 @@ def create_arrow():
     return arrow_body, arrow_shape
 
 
-def stick_arrow_to_target(space, arrow_body, target_body, position, flying_arrows):
-    pivot_joint = pymunk.PivotJoint(arrow_body, target_body, position)
-    phase = target_body.angle - arrow_body.angle
-    gear_joint = pymunk.GearJoint(arrow_body, target_body, phase, 1)
-    space.add(pivot_joint)
-    space.add(gear_joint)
-    try:
-        flying_arrows.remove(arrow_body)
-    except:
-        pass
+# Stuck arrows are frozen into whatever they hit: the arrow's shape is moved onto the target's body (the walls are
+# on space.static_body) and the arrow's own body is taken out of the space. When this is off, each stuck arrow is
+# held in place by a pivot joint and a gear joint instead, so every arrow that has ever stuck adds work for the solver
+freeze_stuck_arrows = True
+# Most stuck arrows to keep. Once there are more than this, the oldest ones are removed. None means no limit
+max_stuck_arrows = 200
+
+
+def stick_arrow_to_target(space, arrow_body, target_body, position, data):
+    stuck_arrows = data["stuck_arrows"]
+    if data["freeze"]:
+        freeze_arrow(space, arrow_body, target_body, data)
+    else:
+        pivot_joint = pymunk.PivotJoint(arrow_body, target_body, position)
+        phase = target_body.angle - arrow_body.angle
+        gear_joint = pymunk.GearJoint(arrow_body, target_body, phase, 1)
+        space.add(pivot_joint)
+        space.add(gear_joint)
+        data["stuck_joints"].update((pivot_joint, gear_joint))
+        add_stuck_arrow(arrow_body, data)
+    data["flying_arrows"].pop(arrow_body, None)
+
+    if data["max_stuck"] is not None:
+        while len(stuck_arrows) > data["max_stuck"]:
+            _, stuck_arrow = stuck_arrows.popitem(last=False)
+            del data["stuck_numbers"][stuck_arrow]
+            remove_stuck_arrow(space, stuck_arrow, data["stuck_joints"])
+
+
+def add_stuck_arrow(stuck_arrow, data):
+    """Adds an arrow to the end (the newest end) of data["stuck_arrows"]"""
+    number = next(data["stuck_count"])
+    data["stuck_arrows"][number] = stuck_arrow
+    data["stuck_numbers"][stuck_arrow] = number
+
+
+def freeze_arrow(space, arrow_body, target_body, data):
+    """Moves every shape on arrow_body onto target_body, without moving it in the world, and takes arrow_body out of
+    the space. Arrows that were frozen into this arrow come along too, and keep their place in data["stuck_arrows"]"""
+    stuck_numbers = data["stuck_numbers"]
+    for shape in list(arrow_body.shapes):
+        vertices = [target_body.world_to_local(arrow_body.local_to_world(vertex)) for vertex in shape.get_vertices()]
+        frozen_shape = pymunk.Poly(target_body, vertices)
+        frozen_shape.friction = shape.friction
+        frozen_shape.collision_type = 0
+        space.remove(shape)
+        space.add(frozen_shape)
+        number = stuck_numbers.pop(shape, None)
+        if number is None:
+            add_stuck_arrow(frozen_shape, data)
+        else:
+            data["stuck_arrows"][number] = frozen_shape
+            stuck_numbers[frozen_shape] = number
+    space.remove(arrow_body)
+
+
+def remove_stuck_arrow(space, stuck_arrow, stuck_joints):
+    """Takes a stuck arrow out of the space. Frozen arrows are just a shape, and arrows held by joints are a body.
+    stuck_joints is the set of joints holding arrows that are still in the space"""
+    if isinstance(stuck_arrow, pymunk.Shape):
+        space.remove(stuck_arrow)
+        return
+    # Other arrows may be stuck to this one, and their joints may already have been removed along with them
+    joints = [joint for joint in stuck_arrow.constraints if joint in stuck_joints]
+    stuck_joints.difference_update(joints)
+    space.remove(*joints)
+    space.remove(*stuck_arrow.shapes)
+    space.remove(stuck_arrow)
 
 
 def post_solve_arrow_hit(arbiter, space, data):
-    if arbiter.total_impulse.length > 300:
-        a, b = arbiter.shapes
+    a, b = arbiter.shapes
+    # Only arrows that have been fired can stick (not the one waiting in the cannon)
+    if arbiter.total_impulse.length > 300 and b.body in data["flying_arrows"]:
         position = arbiter.contact_point_set.points[0].point_a
         b.collision_type = 0
         b.group = 1
         other_body = a.body
         arrow_body = b.body
         space.add_post_step_callback(
-            stick_arrow_to_target, arrow_body, other_body, position, data["flying_arrows"])
+            stick_arrow_to_target, arrow_body, other_body, position, data)
 
 
-width, height = 690, 600
-
-
-def main():
-    ### PyGame init
-    pygame.init()
-    screen = pygame.display.set_mode((width, height))
-    clock = pygame.time.Clock()
-    running = True
-    font = pygame.font.SysFont("Arial", 16)
-
-    ### Physics stuff
+def create_world(freeze=freeze_stuck_arrows, max_stuck=max_stuck_arrows):
+    """Creates the space with the walls, the round target and the cannon. Returns the space, the cannon's body and
+    shape, and the dict that arrows are kept in (as keys, in the order they were fired) while they are flying. freeze
+    and max_stuck are how arrows stick (see freeze_stuck_arrows and max_stuck_arrows)"""
     space = pymunk.Space()
     space.gravity = 0, -1000
-    draw_options = pymunk.pygame_util.DrawOptions(screen)
 
     # walls - the left-top-right walls
     static = [pymunk.Segment(space.static_body, (50, 50), (50, 550), 5)
@@ -88,13 +145,104 @@ def main():
     cannon_body.position = 100, 100
     space.add(cannon_shape)
 
-    arrow_body, arrow_shape = create_arrow()
-    space.add(arrow_shape)
-
-    flying_arrows = []
+    # A dict rather than a list, so a hit can check whether an arrow is flying without searching through all of them
+    flying_arrows = {}
     handler = space.add_collision_handler(0, 1)
     handler.data["flying_arrows"] = flying_arrows
+    # Arrows that have stuck to something, oldest first, by the number they were given when they stuck. stuck_numbers
+    # is the other way around, so a frozen arrow can be found (and replaced when it is frozen again) straight away
+    handler.data["stuck_arrows"] = OrderedDict()
+    handler.data["stuck_numbers"] = {}
+    # Joints holding stuck arrows in place that are in the space (when stuck arrows aren't frozen)
+    handler.data["stuck_joints"] = set()
+    handler.data["stuck_count"] = itertools.count()
+    handler.data["freeze"] = freeze
+    handler.data["max_stuck"] = max_stuck
     handler.post_solve = post_solve_arrow_hit
+    return space, cannon_body, cannon_shape, flying_arrows
+
+
+def fire_arrow(space, arrow_body, power, flying_arrows):
+    """Shoots an arrow (whose shape is already in the space) the way it is pointing"""
+    impulse = power * Vec2d(1, 0)
+    impulse.rotate(arrow_body.angle)
+
+    arrow_body.apply_impulse_at_world_point(impulse, arrow_body.position)
+
+    space.add(arrow_body)
+    flying_arrows[arrow_body] = None
+
+
+# How strongly the air turns flying arrows around
+DRAG_CONSTANT = 0.0002
+
+
+def apply_arrow_drag(flying_arrows):
+    """Turns flying arrows so they point the way they are flying, like the air would.
+
+    Every arrow is done at once: the angles, velocities and masses of all the flying arrows are read into numpy arrays,
+    the drag impulses and the new spin of every arrow are worked out together, and then each arrow's velocity and
+    angular velocity are written back. This is the same as calling apply_impulse_at_world_point on each arrow, without
+    building several Vec2ds per arrow"""
+    if not flying_arrows:
+        return
+    state = np.array([(arrow.angle, arrow.angular_velocity, arrow.mass, arrow.moment, *arrow.velocity, *arrow.position)
+                      for arrow in flying_arrows], dtype=np.float64)
+    angle, angular_velocity, mass, moment, velocity_x, velocity_y, position_x, position_y = state.T
+
+    pointing_x, pointing_y = np.cos(angle), np.sin(angle)
+    flight_speed = np.hypot(velocity_x, velocity_y)
+    # Arrows that aren't moving have no flight direction (and no drag)
+    nonzero_speed = np.where(flight_speed > 0, flight_speed, 1)
+    flight_x, flight_y = velocity_x / nonzero_speed, velocity_y / nonzero_speed
+    dot = flight_x * pointing_x + flight_y * pointing_y
+    # (1-abs(dot)) can be replaced with (1-dot) to make arrows turn
+    # around even when fired straight up. Might not be as accurate, but
+    # maybe look better.
+    drag_force_magnitude = (1 - np.abs(dot)) * flight_speed ** 2 * DRAG_CONSTANT * mass
+    impulse_x, impulse_y = -drag_force_magnitude * flight_x, -drag_force_magnitude * flight_y
+
+    # The impulse is applied at the tail offset as if it were a world point, like the original example does. Its
+    # lever arm is measured from the arrow's position
+    lever_x = -50 * pointing_x - position_x
+    lever_y = -50 * pointing_y - position_y
+    velocity_x += impulse_x / mass
+    velocity_y += impulse_y / mass
+    angular_velocity += (lever_x * impulse_y - lever_y * impulse_x) / moment
+    angular_velocity *= 0.5
+
+    for arrow, new_velocity, new_angular_velocity in zip(flying_arrows, np.column_stack((velocity_x, velocity_y)).tolist(),
+                                                         angular_velocity.tolist()):
+        arrow.velocity = new_velocity
+        arrow.angular_velocity = new_angular_velocity
+
+
+width, height = 690, 600
+
+
+def main():
+    ### PyGame init
+    pygame.init()
+    screen = pygame.display.set_mode((width, height))
+    clock = pygame.time.Clock()
+    running = True
+    font = sys_font("Arial", 16)
+    hud = Hud()
+    hud.add("fps", font, THECOLORS["white"], topleft=(0, 0))
+    hud.add("aim", font, THECOLORS["darkgrey"], "Aim with mouse, hold LMB to powerup, release to fire",
+            topleft=(5, height - 35))
+    hud.add("quit", font, THECOLORS["darkgrey"], "Press ESC or Q to quit", topleft=(5, height - 20))
+
+    ### Physics stuff
+    space, cannon_body, cannon_shape, flying_arrows = create_world()
+    draw_options = pymunk.pygame_util.DrawOptions(screen)
+
+    arrow_body, arrow_shape = create_arrow()
+    space.add(arrow_shape)
+
+    # Physics runs 60 times a second, the screen is drawn as often as it can be (up to max_fps)
+    physics = FixedTimestep(space, 60)
+    max_fps = 144
 
     while running:
         for event in pygame.event.get():
@@ -110,56 +258,40 @@ def main():
 
                 diff = end_time - start_time
                 power = max(min(diff, 1000), 10) * 1.5
-                impulse = power * Vec2d(1, 0)
-                impulse.rotate(arrow_body.angle)
-
-                arrow_body.apply_impulse_at_world_point(impulse, arrow_body.position)
-
-                space.add(arrow_body)
-                flying_arrows.append(arrow_body)
+                fire_arrow(space, arrow_body, power, flying_arrows)
 
                 arrow_body, arrow_shape = create_arrow()
                 space.add(arrow_shape)
 
         keys = pygame.key.get_pressed()
 
-        speed = 2.5
-        if (keys[K_UP]):
-            cannon_body.position += Vec2d(0, 1) * speed
-        if (keys[K_DOWN]):
-            cannon_body.position += Vec2d(0, -1) * speed
-        if (keys[K_LEFT]):
-            cannon_body.position += Vec2d(-1, 0) * speed
-        if (keys[K_RIGHT]):
-            cannon_body.position += Vec2d(1, 0) * speed
-
-        mouse_position = pymunk.pygame_util.from_pygame(Vec2d(pygame.mouse.get_pos()), screen)
-        cannon_body.angle = (mouse_position - cannon_body.position).angle
-        # move the unfired arrow together with the cannon
-        arrow_body.position = cannon_body.position + Vec2d(cannon_shape.radius + 40, 0).rotated(cannon_body.angle)
-        arrow_body.angle = cannon_body.angle
-
-        for flying_arrow in flying_arrows:
-            drag_constant = 0.0002
-
-            pointing_direction = Vec2d(1, 0).rotated(flying_arrow.angle)
-            flight_direction = Vec2d(flying_arrow.velocity)
-            flight_speed = flight_direction.normalize_return_length()
-            dot = flight_direction.dot(pointing_direction)
-            # (1-abs(dot)) can be replaced with (1-dot) to make arrows turn
-            # around even when fired straight up. Might not be as accurate, but
-            # maybe look better.
-            drag_force_magnitude = (1 - abs(dot)) * flight_speed ** 2 * drag_constant * flying_arrow.mass
-            arrow_tail_position = Vec2d(-50, 0).rotated(flying_arrow.angle)
-            flying_arrow.apply_impulse_at_world_point(drag_force_magnitude * -flight_direction, arrow_tail_position)
-
-            flying_arrow.angular_velocity *= 0.5
+        ### Update physics
+        for dt in physics.steps():
+            speed = 2.5
+            if (keys[K_UP]):
+                cannon_body.position += Vec2d(0, 1) * speed
+            if (keys[K_DOWN]):
+                cannon_body.position += Vec2d(0, -1) * speed
+            if (keys[K_LEFT]):
+                cannon_body.position += Vec2d(-1, 0) * speed
+            if (keys[K_RIGHT]):
+                cannon_body.position += Vec2d(1, 0) * speed
+
+            mouse_position = pymunk.pygame_util.from_pygame(Vec2d(pygame.mouse.get_pos()), screen)
+            cannon_body.angle = (mouse_position - cannon_body.position).angle
+            # move the unfired arrow together with the cannon
+            arrow_body.position = cannon_body.position + Vec2d(cannon_shape.radius + 40, 0).rotated(cannon_body.angle)
+            arrow_body.angle = cannon_body.angle
+
+            apply_arrow_drag(flying_arrows)
+            space.step(dt)
 
         ### Clear screen
         screen.fill(pygame.color.THECOLORS["black"])
 
         ### Draw stuff
-        space.debug_draw(draw_options)
+        with physics.interpolated():
+            space.debug_draw(draw_options)
         # draw(screen, space)
 
         # Power meter
@@ -171,19 +303,13 @@ def main():
             pygame.draw.line(screen, pygame.color.THECOLORS["red"], (30, 550), (30, 550 - h), 10)
 
         # Info and flip screen
-        screen.blit(font.render("fps: " + str(clock.get_fps()), 1, THECOLORS["white"]), (0, 0))
-        screen.blit(font.render("Aim with mouse, hold LMB to powerup, release to fire", 1, THECOLORS["darkgrey"]),
-                    (5, height - 35))
-        screen.blit(font.render("Press ESC or Q to quit", 1, THECOLORS["darkgrey"]), (5, height - 20))
+        # The fps is rounded to a whole number so its text only needs rendered again when that changes
+        hud.set("fps", "fps: " + str(round(clock.get_fps())))
+        hud.draw(screen)
 
         pygame.display.flip()
 
-        ### Update physics
-        fps = 60
-        dt = 1. / fps
-        space.step(dt)
-
-        clock.tick(fps)
+        clock.tick(max_fps)
 
 
 if __name__ == '__main__':
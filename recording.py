@@ -0,0 +1,143 @@
+"""Recording and replaying the controls of a game of flyinginspace.
+
+Everything random in flyinginspace comes from the seed it was started with, and the physics runs at a fixed timestep,
+so a game can be played again exactly by starting from the same seed and giving it the same controls on every tick.
+A Recording holds the seed, the size of the world, the controls for every tick and how the game ended (so a replay
+can check that it ended the same way).
+
+Recordings are saved in a small binary format (all numbers little endian):
+    header - "FLYREC", format version, seed, number of planets, number of stars, game length in seconds, number of
+             ticks, number of runs, final score, sector size (0 if the world wasn't split into sectors), length of the
+             game over string, then the game over string itself (UTF-8). Version 1 recordings have no sector size, and
+             versions 1 and 2 store the game length as a double instead of a 4 byte integer
+    runs   - the controls, run length encoded: one byte of controls followed by a 2 byte count of how many ticks in a
+             row had those controls. The controls byte is thrust, left and right in the lowest three bits, and how
+             many times fire was pressed in the other five
+"""
+import math
+import struct
+
+MAGIC = b'FLYREC'
+VERSION = 3
+HEADER = struct.Struct('<6sBIIIIIIdIH')
+# Older recordings can still be played back
+OLD_HEADERS = {1: struct.Struct('<6sBIIIdIIdH'), 2: struct.Struct('<6sBIIIdIIdIH')}
+RUN = struct.Struct('<BH')
+MAX_RUN_LENGTH = 2 ** 16 - 1
+# Fire presses are stored in five bits
+MAX_FIRE = 31
+
+
+def pack_controls(thrust, left, right, fire):
+    """Packs the controls for one tick into a byte"""
+    if not 0 <= fire <= MAX_FIRE:
+        raise ValueError('Can only record up to ' + str(MAX_FIRE) + ' fire presses per tick, not ' + str(fire))
+    return bool(thrust) | bool(left) << 1 | bool(right) << 2 | fire << 3
+
+
+def unpack_controls(packed):
+    """Opposite of pack_controls. Returns (thrust, left, right, fire)"""
+    return bool(packed & 1), bool(packed & 2), bool(packed & 4), packed >> 3
+
+
+class Recording:
+    """Class that holds the controls of one game, one (thrust, left, right, fire) tuple per tick.
+
+    score and game_over_string are how the game ended. They are None and '' until finish is called.
+    sector_size is the size of the world's sectors, or None if it wasn't split into sectors"""
+    def __init__(self, seed, num_planets, num_stars, game_length, controls=None, score=None, game_over_string='',
+                 sector_size=None):
+        self.seed = seed
+        self.num_planets = num_planets
+        self.num_stars = num_stars
+        self.game_length = game_length
+        self.sector_size = sector_size
+        self.controls = [] if controls is None else controls
+        self.score = score
+        self.game_over_string = game_over_string
+
+    def __len__(self):
+        return len(self.controls)
+
+    def record(self, controls):
+        """Adds the controls for the next tick"""
+        # Packing checks that the controls can be saved, so a bad tick is caught now instead of when saving
+        self.controls.append(unpack_controls(pack_controls(*controls)))
+
+    def controls_at(self, tick):
+        """Returns the (thrust, left, right, fire) for a tick, or None if the recording has already ended"""
+        if tick < len(self.controls):
+            return self.controls[tick]
+        return None
+
+    def finish(self, score, game_over_string):
+        """Remember how the game ended, to check replays against"""
+        self.score = score
+        self.game_over_string = game_over_string
+
+    def check(self, score, game_over_string):
+        """Compares how a replay ended to how the recorded game ended. Returns a list of the differences, which is
+        empty if the replay matched"""
+        differences = []
+        if self.score is not None and score != self.score:
+            differences.append('score was ' + str(score) + ' instead of ' + str(self.score))
+        if game_over_string != self.game_over_string:
+            differences.append('game over was ' + repr(game_over_string) + ' instead of ' +
+                               repr(self.game_over_string))
+        return differences
+
+    def to_bytes(self):
+        runs = []
+        for controls in self.controls:
+            packed = pack_controls(*controls)
+            if runs and runs[-1][0] == packed and runs[-1][1] < MAX_RUN_LENGTH:
+                runs[-1][1] += 1
+            else:
+                runs.append([packed, 1])
+
+        game_over_bytes = self.game_over_string.encode('utf-8')
+        score = math.nan if self.score is None else self.score
+        header = HEADER.pack(MAGIC, VERSION, self.seed, self.num_planets, self.num_stars, self.game_length,
+                             len(self.controls), len(runs), score, self.sector_size or 0, len(game_over_bytes))
+        return b''.join([header, game_over_bytes] + [RUN.pack(packed, length) for packed, length in runs])
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version = struct.unpack_from('<6sB', data)
+        if magic != MAGIC:
+            raise ValueError('Not a flyinginspace recording')
+        if version == VERSION or version == 2:
+            header = HEADER if version == VERSION else OLD_HEADERS[version]
+            magic, version, seed, num_planets, num_stars, game_length, num_ticks, num_runs, score, sector_size, \
+                game_over_length = header.unpack_from(data)
+        elif version in OLD_HEADERS:
+            header = OLD_HEADERS[version]
+            magic, version, seed, num_planets, num_stars, game_length, num_ticks, num_runs, score, game_over_length = \
+                header.unpack_from(data)
+            sector_size = 0
+        else:
+            raise ValueError('Recording is format version ' + str(version) + ', only versions up to ' + str(VERSION) +
+                             ' can be read')
+        offset = header.size
+        game_over_string = data[offset:offset + game_over_length].decode('utf-8')
+        offset += game_over_length
+
+        controls = []
+        for packed, length in RUN.iter_unpack(data[offset:offset + num_runs * RUN.size]):
+            controls.extend([unpack_controls(packed)] * length)
+        if len(controls) != num_ticks:
+            raise ValueError('Recording is cut off: expected ' + str(num_ticks) + ' ticks, found ' +
+                             str(len(controls)))
+        # Versions 1 and 2 stored the game length as a double
+        return cls(seed, num_planets, num_stars, int(game_length), controls, None if math.isnan(score) else score,
+                   game_over_string, sector_size or None)
+
+    def save(self, path):
+        with open(path, 'wb') as recording_file:
+            recording_file.write(self.to_bytes())
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as recording_file:
+            return cls.from_bytes(recording_file.read())
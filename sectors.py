@@ -0,0 +1,135 @@
+"""Seed-deterministic sectors for streaming an endless world in flyinginspace.
+
+The world is split into square sectors, sector_size world units on a side. Sector (sector x, sector y) covers x from
+sector_x * sector_size up to (but not including) (sector_x + 1) * sector_size, and the same for y. What starts out in a
+sector is generated from a hash of (world seed, sector x, sector y) alone, so a sector always starts out the same no
+matter what order the player visits sectors in, and nothing needs to be stored for sectors that haven't been visited.
+
+Only the sectors near the camera are loaded into the physics space. When a sector is unloaded, its planets are saved in
+a SectorCache, so flying back shows them where they were left. The cache holds a fixed number of sectors, and once it
+is full the one that was left the longest ago is dropped, and goes back to what its seed generates.
+
+All positions are world coordinates (y increases going up).
+"""
+from collections import OrderedDict, namedtuple
+import hashlib
+import math
+import struct
+
+import numpy as np
+
+# One row per planet. Planets saved when their sector unloads keep their velocity and spin
+PLANET_DTYPE = np.dtype([('x', np.float64), ('y', np.float64), ('vx', np.float64), ('vy', np.float64),
+                         ('angle', np.float64), ('angular_velocity', np.float64), ('radius', np.int32),
+                         ('color', np.uint8, 4)])
+
+# What a sector holds. planets is an array of PLANET_DTYPE rows, star_positions is an (n, 2) array and star_colors is
+# each star's index in the star palette
+SectorContents = namedtuple('SectorContents', ['planets', 'star_positions', 'star_colors'])
+
+
+def sector_seed(world_seed, sector_x, sector_y):
+    """Returns the 64 bit seed for one sector. Python's own hash() isn't used, since it isn't guaranteed to be the same
+    on every computer and version"""
+    key = struct.pack('<Qqq', world_seed % 2 ** 64, sector_x, sector_y)
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def sector_of(x_pos, y_pos, sector_size):
+    """Returns the (sector x, sector y) that a world position is in"""
+    return int(math.floor(x_pos / sector_size)), int(math.floor(y_pos / sector_size))
+
+
+def sector_bounds(sector, sector_size):
+    """Returns the (left, bottom, right, top) edges of a sector"""
+    sector_x, sector_y = sector
+    return (sector_x * sector_size, sector_y * sector_size,
+            (sector_x + 1) * sector_size, (sector_y + 1) * sector_size)
+
+
+def sectors_overlapping(left, bottom, right, top, sector_size):
+    """Returns a set of every sector that overlaps the rectangle"""
+    first_x, first_y = sector_of(left, bottom, sector_size)
+    last_x, last_y = sector_of(right, top, sector_size)
+    return {(sector_x, sector_y) for sector_x in range(first_x, last_x + 1) for sector_y in range(first_y, last_y + 1)}
+
+
+def generate_sector(world_seed, sector, sector_size, planets_per_sector, stars_per_sector, planet_palette,
+                    num_star_colors, radius_range=(30, 60), max_speed=20, keep_clear=None, attempts=16):
+    """Generates what a sector starts out with, from the world seed. Returns SectorContents.
+
+    planets_per_sector and stars_per_sector are the average number of each (the actual numbers vary from sector to
+    sector). Planet colors are picked from planet_palette, a list of RGBA colors, and star colors are indexes up to
+    num_star_colors. Planets never overlap each other or the edge of the sector (so they can't overlap the planets of
+    the sector next door either), or the keep_clear circle (x, y, radius) if it is given. A planet that can't find room
+    in "attempts" tries is left out"""
+    rng = np.random.default_rng(sector_seed(world_seed, *sector))
+    left, bottom, right, top = sector_bounds(sector, sector_size)
+
+    count = rng.poisson(planets_per_sector)
+    radii = rng.integers(radius_range[0], radius_range[1] + 1, count)
+    candidates = rng.random((count, attempts, 2))
+    colors = rng.integers(0, len(planet_palette), count)
+    speeds = rng.integers(0, max_speed + 1, count)
+    directions = rng.random(count) * 6.2
+
+    placed = []
+    # Circles that new planets need to stay away from
+    circles = [keep_clear] if keep_clear is not None else []
+    for i in range(count):
+        radius = radii[i]
+        # Spread the tries over the part of the sector the planet fits in without poking out
+        x_pos = left + radius + candidates[i, :, 0] * (sector_size - 2 * radius)
+        y_pos = bottom + radius + candidates[i, :, 1] * (sector_size - 2 * radius)
+        if circles:
+            others = np.array(circles, dtype=np.float64)
+            room = (np.hypot(x_pos[:, None] - others[:, 0], y_pos[:, None] - others[:, 1]) - others[:, 2] -
+                    radius).min(axis=1)
+            fits = np.flatnonzero(room >= 0)
+            if not len(fits):
+                continue
+            choice = fits[0]
+        else:
+            choice = 0
+        placed.append(i)
+        circles.append((x_pos[choice], y_pos[choice], radius))
+
+    planets = np.zeros(len(placed), dtype=PLANET_DTYPE)
+    first_planet = 1 if keep_clear is not None else 0
+    for row, (i, (x_pos, y_pos, radius)) in enumerate(zip(placed, circles[first_planet:])):
+        planets[row] = (x_pos, y_pos, speeds[i] * math.cos(directions[i]), speeds[i] * math.sin(directions[i]), 0, 0,
+                        radius, tuple(planet_palette[colors[i]]))
+
+    num_stars = rng.poisson(stars_per_sector)
+    star_positions = np.column_stack((rng.uniform(left, right, num_stars), rng.uniform(bottom, top, num_stars)))
+    star_colors = rng.integers(0, num_star_colors, num_stars)
+    return SectorContents(planets, star_positions, star_colors)
+
+
+class SectorCache:
+    """Class that remembers the planets of sectors that have been unloaded, up to max_sectors of them. Sectors that
+    were stored longest ago are dropped first. max_sectors can be 0 to never remember anything"""
+    def __init__(self, max_sectors=256):
+        self.max_sectors = max_sectors
+        # sector -> array of PLANET_DTYPE rows, oldest first
+        self.sectors = OrderedDict()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.sectors)
+
+    def __contains__(self, sector):
+        return sector in self.sectors
+
+    def store(self, sector, planets):
+        self.sectors.pop(sector, None)
+        if self.max_sectors <= 0:
+            return
+        self.sectors[sector] = planets
+        while len(self.sectors) > self.max_sectors:
+            self.sectors.popitem(last=False)
+            self.dropped += 1
+
+    def take(self, sector):
+        """Removes a sector from the cache and returns its planets, or None if it isn't in the cache"""
+        return self.sectors.pop(sector, None)
@@ -0,0 +1,223 @@
+"""Snapshots of a whole flyinginspace world, for rewinding, checkpoints and save games.
+
+A Snapshot holds everything about a game that changes while it is played: the game's counters (tick, score, health,
+fuel, ammunition, game mode and camera position), the player and camera bodies, every planet, flying laser and star,
+the state of both random number generators, and in a world of sectors, which sectors are loaded and what the sector
+cache holds. flyinginspace captures and restores them (see Game.capture and Game.restore). The bodies are kept in
+numpy arrays of the dtypes below, so a snapshot is small, and packing it into bytes is a handful of copies.
+
+Bodies are read through pymunk's properties, one at a time, which takes about 5 microseconds per body: under a
+millisecond for this game's 100 to 200 planets, but around 15 milliseconds for 3000 bodies (pymunk has no way of
+reading many bodies at once). Stars are already numpy arrays and are simply copied. A snapshot can't be spread over
+several ticks, since then its bodies would be from different ticks, so instead SnapshotRing captures less often the
+longer a capture takes, keeping rewinding to CAPTURE_BUDGET seconds per tick on average.
+
+pymunk's contact cache (which remembers how hard things were pushing on each other in the last step, and is where the
+solver starts from in the next one) isn't part of a snapshot. A restored game is not an exact copy of the original:
+bodies that are touching end up somewhere slightly different (by around 1e-6 to 1e-4 after a few hundred ticks), and
+in a chaotic enough game that can grow until the restored game plays out differently.
+
+Snapshots are saved in a small binary format (all numbers little endian):
+    header  - "FLYSNAP", format version, number of planets, number of stars, game length in whole seconds, sector size
+              (0 if the world isn't split into sectors), world seed of the sectors, tick, game mode, boosting, score,
+              player health, rocket fuel, ammunition, camera x, camera y, then how many planets, lasers, stars, loaded
+              sectors and cached sectors there are, and the length of the game over string
+    then    - the game over string (UTF-8), the player and camera as BODY_DTYPE rows, the planets as
+              PLANET_STATE_DTYPE rows, the lasers as LASER_STATE_DTYPE rows, the star positions (x, y doubles) and the
+              index of each star's color (2 byte integers), the random module's state, numpy's random state, the
+              loaded sectors (x, y 8 byte integers) and finally each cached sector: its x, y and number of planets,
+              followed by that many sectors.PLANET_DTYPE rows
+"""
+from collections import OrderedDict, deque, namedtuple
+import math
+import os
+import struct
+import time
+
+import numpy as np
+
+from sectors import PLANET_DTYPE
+
+MAGIC = b'FLYSNAP'
+VERSION = 3
+HEADER = struct.Struct('<7sBIIIIQIBBdddiddIIIIIH')
+# random.getstate(): the Mersenne Twister's 624 words and position, then whether there is a saved gauss value and
+# what it is
+PYTHON_RANDOM = struct.Struct('<625IBd')
+# numpy's RandomState.get_state(): the 624 words, position, whether there is a saved gaussian and what it is
+NUMPY_RANDOM = struct.Struct('<624Iiid')
+SECTOR_ENTRY = struct.Struct('<qqI')
+
+BODY_DTYPE = np.dtype([('x', '<f8'), ('y', '<f8'), ('vx', '<f8'), ('vy', '<f8'), ('angle', '<f8'),
+                       ('angular_velocity', '<f8')])
+PLANET_STATE_DTYPE = np.dtype(BODY_DTYPE.descr + [('mass', '<f8'), ('radius', '<i4'), ('color', 'u1', 4)])
+LASER_STATE_DTYPE = np.dtype(BODY_DTYPE.descr + [('fired_tick', '<i8')])
+# sectors.PLANET_DTYPE is in the computer's own byte order, so cached sectors are converted on the way in and out
+CACHED_PLANET_DTYPE = PLANET_DTYPE.newbyteorder('<')
+STAR_POSITION_DTYPE = np.dtype('<f8')
+STAR_COLOR_DTYPE = np.dtype('<u2')
+# Most seconds per tick that SnapshotRing spends capturing snapshots, on average
+CAPTURE_BUDGET = 0.001
+
+
+def body_states(bodies):
+    """Returns a list of (x, y, vx, vy, angle, angular_velocity) for each pymunk body, like a BODY_DTYPE row"""
+    states = []
+    for body in bodies:
+        position = body.position
+        velocity = body.velocity
+        states.append((position.x, position.y, velocity.x, velocity.y, body.angle, body.angular_velocity))
+    return states
+
+
+class Snapshot(namedtuple('Snapshot', [
+        'num_planets', 'num_stars', 'game_length', 'sector_size', 'world_seed',
+        'ticks', 'game_mode', 'boosting', 'score', 'player_health', 'rocket_fuel', 'ammunition', 'camera_x', 'camera_y',
+        'game_over_string', 'bodies', 'planets', 'lasers', 'star_positions', 'star_colors', 'python_random',
+        'numpy_random', 'loaded_sectors', 'sector_cache'])):
+    """Class that holds the state of a game at one tick. The settings of the game it came from are num_planets,
+    num_stars, game_length and sector_size (None if the world isn't split into sectors), and world_seed is the seed of
+    its sectors (0 without sectors).
+
+    bodies - the player and the camera body, as two BODY_DTYPE rows
+    planets, lasers - arrays of PLANET_STATE_DTYPE and LASER_STATE_DTYPE rows. Lasers are oldest first
+    star_positions, star_colors - (n, 2) array of star positions, and the index of each star's color
+    python_random, numpy_random - random.getstate() and RandomState.get_state()
+    loaded_sectors - list of the (sector x, sector y) that are loaded
+    sector_cache - OrderedDict of sector -> array of sectors.PLANET_DTYPE rows, oldest first (see SectorCache)
+
+    Nothing in a snapshot is ever changed, so the arrays can be shared with other snapshots"""
+    __slots__ = ()
+
+    def to_bytes(self):
+        game_over_bytes = self.game_over_string.encode('utf-8')
+        header = HEADER.pack(MAGIC, VERSION, self.num_planets, self.num_stars, self.game_length, self.sector_size or 0,
+                             self.world_seed, self.ticks, self.game_mode, self.boosting, self.score,
+                             self.player_health, self.rocket_fuel, self.ammunition, self.camera_x, self.camera_y,
+                             len(self.planets), len(self.lasers), len(self.star_positions), len(self.loaded_sectors),
+                             len(self.sector_cache), len(game_over_bytes))
+
+        _, words, gauss_next = self.python_random
+        _, numpy_words, numpy_position, has_gauss, cached_gaussian = self.numpy_random
+        random_states = PYTHON_RANDOM.pack(*words, gauss_next is not None, gauss_next or 0) + \
+            NUMPY_RANDOM.pack(*numpy_words.tolist(), numpy_position, has_gauss, cached_gaussian)
+
+        parts = [header, game_over_bytes,
+                 np.asarray(self.bodies, dtype=BODY_DTYPE).tobytes(),
+                 np.asarray(self.planets, dtype=PLANET_STATE_DTYPE).tobytes(),
+                 np.asarray(self.lasers, dtype=LASER_STATE_DTYPE).tobytes(),
+                 np.asarray(self.star_positions, dtype=STAR_POSITION_DTYPE).tobytes(),
+                 np.asarray(self.star_colors, dtype=STAR_COLOR_DTYPE).tobytes(),
+                 random_states,
+                 np.array(self.loaded_sectors, dtype='<i8').tobytes()]
+        for (sector_x, sector_y), rows in self.sector_cache.items():
+            parts.append(SECTOR_ENTRY.pack(sector_x, sector_y, len(rows)))
+            parts.append(np.asarray(rows, dtype=CACHED_PLANET_DTYPE).tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version = struct.unpack_from('<7sB', data)
+        if magic != MAGIC:
+            raise ValueError('Not a flyinginspace snapshot')
+        if version != VERSION:
+            raise ValueError('Snapshot is format version ' + str(version) + ', only version ' + str(VERSION) +
+                             ' can be read')
+        magic, version, num_planets, num_stars, game_length, sector_size, world_seed, ticks, game_mode, boosting, \
+            score, player_health, rocket_fuel, ammunition, camera_x, camera_y, num_planet_rows, num_lasers, \
+            num_star_rows, num_loaded, num_cached, game_over_length = HEADER.unpack_from(data)
+        offset = HEADER.size
+        game_over_string = bytes(data[offset:offset + game_over_length]).decode('utf-8')
+        offset += game_over_length
+
+        def read_array(dtype, count):
+            nonlocal offset
+            array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            offset += array.nbytes
+            return array
+
+        bodies = read_array(BODY_DTYPE, 2)
+        planets = read_array(PLANET_STATE_DTYPE, num_planet_rows)
+        lasers = read_array(LASER_STATE_DTYPE, num_lasers)
+        star_positions = read_array(STAR_POSITION_DTYPE, num_star_rows * 2).reshape(-1, 2)
+        star_colors = read_array(STAR_COLOR_DTYPE, num_star_rows)
+
+        python_state = PYTHON_RANDOM.unpack_from(data, offset)
+        offset += PYTHON_RANDOM.size
+        python_random = (3, python_state[:625], python_state[626] if python_state[625] else None)
+        numpy_state = NUMPY_RANDOM.unpack_from(data, offset)
+        offset += NUMPY_RANDOM.size
+        numpy_random = ('MT19937', np.array(numpy_state[:624], dtype=np.uint32), *numpy_state[624:])
+
+        loaded_sectors = [tuple(sector) for sector in read_array('<i8', num_loaded * 2).reshape(-1, 2).tolist()]
+        sector_cache = OrderedDict()
+        for _ in range(num_cached):
+            sector_x, sector_y, count = SECTOR_ENTRY.unpack_from(data, offset)
+            offset += SECTOR_ENTRY.size
+            sector_cache[(sector_x, sector_y)] = read_array(CACHED_PLANET_DTYPE, count).astype(PLANET_DTYPE)
+        if offset != len(data):
+            raise ValueError('Snapshot is ' + str(len(data)) + ' bytes, expected ' + str(offset))
+
+        return cls(num_planets, num_stars, game_length, sector_size or None, world_seed, ticks, game_mode,
+                   bool(boosting), score, player_health, rocket_fuel, ammunition, camera_x, camera_y,
+                   game_over_string, bodies, planets, lasers, star_positions, star_colors, python_random,
+                   numpy_random, loaded_sectors, sector_cache)
+
+    def save(self, path):
+        """Saves the snapshot to path. It is written to a temporary file that then replaces path, so a save that fails
+        part way through never leaves a broken file (or wipes out the last save)"""
+        data = self.to_bytes()
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as snapshot_file:
+            snapshot_file.write(data)
+        os.replace(temporary_path, path)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as snapshot_file:
+            return cls.from_bytes(snapshot_file.read())
+
+
+class SnapshotRing:
+    """Class that keeps the snapshots from the last "ticks" ticks, oldest first, for rewinding.
+
+    update captures a snapshot every interval ticks. interval starts at 1, and after each capture it is set to how long
+    that capture took divided by budget (rounded up), so capturing costs at most budget seconds per tick on average
+    however big the world is. Bigger worlds just have fewer snapshots to rewind through"""
+    def __init__(self, ticks, budget=CAPTURE_BUDGET, clock=time.perf_counter):
+        self.ticks = ticks
+        self.budget = budget
+        self.clock = clock
+        self.interval = 1
+        self.snapshots = deque()
+
+    def __len__(self):
+        return len(self.snapshots)
+
+    def update(self, tick, capture):
+        """Captures a snapshot with capture (a function that returns a Snapshot) if one is due at this tick. Returns
+        True if it did"""
+        if self.snapshots and tick - self.snapshots[-1].ticks < self.interval:
+            return False
+        start = self.clock()
+        snapshot = capture()
+        self.interval = max(1, math.ceil((self.clock() - start) / self.budget))
+        self.push(snapshot)
+        return True
+
+    def push(self, snapshot):
+        """Adds a snapshot as the newest, and drops the ones that are now more than "ticks" ticks older than it"""
+        self.snapshots.append(snapshot)
+        while snapshot.ticks - self.snapshots[0].ticks > self.ticks:
+            self.snapshots.popleft()
+
+    def rewind(self, tick):
+        """Drops the snapshots from after tick, and returns the newest one that is left (from tick, or the closest
+        tick before it that has one). The returned snapshot is kept. Returns None if there aren't any left"""
+        while self.snapshots and self.snapshots[-1].ticks > tick:
+            self.snapshots.pop()
+        return self.snapshots[-1] if self.snapshots else None
+
+    def clear(self):
+        self.snapshots.clear()
@@ -0,0 +1,89 @@
+"""Uniform grid spatial index for flyinginspace.
+
+The world is split into square cells, and every object is filed under the cell that its position is in. To find the
+objects in some area (like the camera's view), only the cells that overlap that area need to be looked at, instead of every
+object in the game.
+
+All positions are world coordinates (y increases going up).
+"""
+from collections import defaultdict
+import math
+
+
+class SpatialGrid:
+    """Class that keeps track of which cell each object is in. Objects are moved with move(), which only touches the
+    cell sets when the object actually crosses into a different cell"""
+    def __init__(self, cell_size=256):
+        self.cell_size = cell_size
+        # (cell x, cell y) -> set of objects in that cell
+        self.cells = defaultdict(set)
+        # object -> (cell x, cell y)
+        self.object_cells = {}
+
+    def __len__(self):
+        return len(self.object_cells)
+
+    def __contains__(self, item):
+        return item in self.object_cells
+
+    def cell_for(self, x_pos, y_pos):
+        return int(math.floor(x_pos / self.cell_size)), int(math.floor(y_pos / self.cell_size))
+
+    def move(self, item, x_pos, y_pos):
+        """Files item under the cell at (x_pos, y_pos), adding it to the grid if it isn't there yet"""
+        cell = self.cell_for(x_pos, y_pos)
+        old_cell = self.object_cells.get(item)
+        if old_cell == cell:
+            return
+        if old_cell is not None:
+            self._remove_from_cell(item, old_cell)
+        self.cells[cell].add(item)
+        self.object_cells[item] = cell
+
+    # Adding an object is the same as moving it from nowhere
+    insert = move
+
+    def remove(self, item):
+        cell = self.object_cells.pop(item, None)
+        if cell is not None:
+            self._remove_from_cell(item, cell)
+
+    def _remove_from_cell(self, item, cell):
+        cell_items = self.cells[cell]
+        cell_items.discard(item)
+        if not cell_items:
+            del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+        self.object_cells.clear()
+
+    def query(self, left, bottom, right, top, margin=0):
+        """Returns a list of the objects in every cell that overlaps the rectangle (plus margin on every side). Some
+        of the objects may be a little outside of the rectangle, but none inside of it are missed"""
+        first_x, first_y = self.cell_for(left - margin, bottom - margin)
+        last_x, last_y = self.cell_for(right + margin, top + margin)
+        found = []
+        # Loop over whichever is smaller, the cells in the rectangle or the cells that have something in them
+        if (last_x - first_x + 1) * (last_y - first_y + 1) <= len(self.cells):
+            for cell_x in range(first_x, last_x + 1):
+                for cell_y in range(first_y, last_y + 1):
+                    cell_items = self.cells.get((cell_x, cell_y))
+                    if cell_items:
+                        found.extend(cell_items)
+        else:
+            for (cell_x, cell_y), cell_items in self.cells.items():
+                if first_x <= cell_x <= last_x and first_y <= cell_y <= last_y:
+                    found.extend(cell_items)
+        return found
+
+    def outside(self, left, bottom, right, top):
+        """Returns a list of the objects in every cell that is not entirely inside of the rectangle. Objects that
+        aren't returned are definitely inside of the rectangle"""
+        found = []
+        size = self.cell_size
+        for (cell_x, cell_y), cell_items in self.cells.items():
+            if not (cell_x * size >= left and (cell_x + 1) * size <= right and
+                    cell_y * size >= bottom and (cell_y + 1) * size <= top):
+                found.extend(cell_items)
+        return found
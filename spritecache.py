@@ -0,0 +1,77 @@
+"""Pre-rendered circle sprites for flyinginspace.
+
+Filling a circle with pygame.draw.circle every frame is slow for big circles. CircleSpriteCache draws each
+(radius, color) combination once onto its own surface, and after that circles are drawn by blitting those surfaces,
+all at once with Surface.blits.
+"""
+import pygame
+
+try:
+    from pygame import gfxdraw
+except ImportError:
+    gfxdraw = None
+
+
+class CircleSpriteCache:
+    """Class that keeps a sprite for every (radius, color) circle that is being drawn.
+
+    Sprites that haven't been used for max_idle_frames frames are thrown away (see end_frame), so radii and colors
+    that are no longer on screen don't stay in memory. If antialias is True and pygame.gfxdraw is available, the
+    edges of the circles are antialiased"""
+    def __init__(self, antialias=True, max_idle_frames=120):
+        self.antialias = antialias and gfxdraw is not None
+        self.max_idle_frames = max_idle_frames
+        self.frame = 0
+        self._sprites = {}
+        self._last_used = {}
+
+    def __len__(self):
+        return len(self._sprites)
+
+    def get(self, radius, color):
+        """Returns the sprite for a circle. The circle's center is at (radius, radius) on the sprite"""
+        radius = int(radius)
+        key = (radius, tuple(color))
+        self._last_used[key] = self.frame
+        sprite = self._sprites.get(key)
+        if sprite is None:
+            sprite = self._sprites[key] = self._render(radius, color)
+        return sprite
+
+    def _render(self, radius, color):
+        size = radius * 2 + 1
+        sprite = pygame.Surface((size, size), pygame.SRCALPHA)
+        if self.antialias:
+            gfxdraw.filled_circle(sprite, radius, radius, radius, color)
+            gfxdraw.aacircle(sprite, radius, radius, radius, color)
+        else:
+            pygame.draw.circle(sprite, color, (radius, radius), radius)
+        # Match the display's pixel format, which makes blitting much faster
+        if pygame.display.get_surface() is not None:
+            sprite = sprite.convert_alpha()
+        # Run length encoding lets the transparent corners of the sprite be skipped over when it is blitted
+        sprite.set_alpha(255, pygame.RLEACCEL)
+        return sprite
+
+    def blit_sequence(self, circles):
+        """Turns (radius, color, (x, y) center) for each circle into the (sprite, position) pairs that Surface.blits
+        takes"""
+        sequence = []
+        for radius, color, (x_pos, y_pos) in circles:
+            radius = int(radius)
+            sequence.append((self.get(radius, color), (x_pos - radius, y_pos - radius)))
+        return sequence
+
+    def draw(self, surface: pygame.Surface, circles):
+        """Draws every circle in circles (see blit_sequence) onto surface in one batch"""
+        surface.blits(self.blit_sequence(circles), doreturn=False)
+
+    def end_frame(self):
+        """Call once per frame. Throws away sprites that haven't been used in a while"""
+        self.frame += 1
+        if self.frame % self.max_idle_frames:
+            return
+        oldest_frame = self.frame - self.max_idle_frames
+        for key in [key for key, last_used in self._last_used.items() if last_used < oldest_frame]:
+            del self._sprites[key]
+            del self._last_used[key]
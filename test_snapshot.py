@@ -0,0 +1,118 @@
+"""Tests for snapshot.py: capturing a game, packing it into bytes, reading it back and restoring it.
+
+Run with: python -m pytest test_snapshot.py
+"""
+import os
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import pytest
+
+import flyinginspace
+from snapshot import Snapshot, SnapshotRing
+
+
+def play_until_planet_hit(sector_size):
+    """Plays a headless game until a laser has destroyed at least one planet, so the score is no longer a whole number
+    of points from the start. Returns the Game"""
+    game = flyinginspace.run_headless(40, seed=3, sector_size=sector_size)
+    while flyinginspace.score == 0 and game.game_mode == flyinginspace.PLAY and game.ticks < 1000:
+        game.update(flyinginspace.autopilot(game.ticks))
+        game.step()
+    assert flyinginspace.score > 0, 'no planet was hit'
+    return game
+
+
+@pytest.mark.parametrize('sector_size', [None, 512])
+def test_round_trip(sector_size):
+    game = play_until_planet_hit(sector_size)
+    data = game.capture().to_bytes()
+    snapshot = Snapshot.from_bytes(data)
+    assert snapshot.score == flyinginspace.score
+
+    # Play on, so restoring has something to undo
+    for _ in range(60):
+        game.update(flyinginspace.autopilot(game.ticks))
+        game.step()
+    game.restore(snapshot)
+    assert game.capture().to_bytes() == data
+
+
+def test_game_length_stays_a_whole_number():
+    game = play_until_planet_hit(None)
+    snapshot = Snapshot.from_bytes(game.capture().to_bytes())
+    assert type(snapshot.game_length) is int
+    restored = flyinginspace.game_from_snapshot(snapshot)
+    assert type(restored.game_length) is int
+    assert type(restored.time_remaining) is int
+
+
+def test_save_and_load(tmp_path):
+    game = play_until_planet_hit(None)
+    snapshot = game.capture()
+    path = str(tmp_path / 'savegame.snap')
+    assert snapshot.save(path) == path
+    assert os.listdir(str(tmp_path)) == ['savegame.snap']
+    assert Snapshot.load(path).to_bytes() == snapshot.to_bytes()
+
+
+def test_failed_save_keeps_the_old_file(tmp_path):
+    game = play_until_planet_hit(None)
+    path = str(tmp_path / 'savegame.snap')
+    game.capture().save(path)
+    with open(path, 'rb') as snapshot_file:
+        saved = snapshot_file.read()
+
+    broken = game.capture()._replace(game_over_string=None)
+    with pytest.raises(AttributeError):
+        broken.save(path)
+    with open(path, 'rb') as snapshot_file:
+        assert snapshot_file.read() == saved
+
+
+def test_not_a_snapshot():
+    with pytest.raises(ValueError):
+        Snapshot.from_bytes(b'NOTSNAP' + bytes(200))
+
+
+class FakeClock:
+    """Clock for SnapshotRing where every capture takes "seconds" seconds (the clock moves on by that much every time
+    it is read)"""
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += self.seconds
+        return self.now
+
+
+def fake_snapshot(tick):
+    return Snapshot(*[None] * 5, tick, *[None] * 18)
+
+
+def test_ring_captures_less_often_when_capturing_is_slow():
+    ring = SnapshotRing(100, budget=0.001, clock=FakeClock(0.0035))
+    captured = [tick for tick in range(20) if ring.update(tick, lambda: fake_snapshot(tick))]
+    assert ring.interval == 4
+    assert captured == [0, 4, 8, 12, 16]
+
+
+def test_ring_keeps_only_the_last_ticks():
+    ring = SnapshotRing(10, budget=1, clock=FakeClock(0))
+    for tick in range(30):
+        ring.update(tick, lambda: fake_snapshot(tick))
+    assert [snapshot.ticks for snapshot in ring.snapshots] == list(range(19, 30))
+
+
+def test_ring_rewind():
+    ring = SnapshotRing(100, budget=0.001, clock=FakeClock(0.0025))
+    for tick in range(10):
+        ring.update(tick, lambda: fake_snapshot(tick))
+    assert [snapshot.ticks for snapshot in ring.snapshots] == [0, 3, 6, 9]
+    assert ring.rewind(8).ticks == 6
+    assert ring.rewind(6).ticks == 6
+    assert [snapshot.ticks for snapshot in ring.snapshots] == [0, 3, 6]
+    assert ring.rewind(-1) is None
+    assert len(ring) == 0
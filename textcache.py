@@ -0,0 +1,117 @@
+"""Cached text rendering shared by flyinginspace, bouncinginspace and pymunkarrows.
+
+Rendering text with Font.render is slow, and most of the text in these games is the same from one frame to the
+next. TextCache keeps surfaces that were already rendered, and HudText only asks for a new surface when the value it
+shows has changed.
+"""
+from collections import OrderedDict
+
+import pygame
+
+_fonts = {}
+
+
+def load_font(path, size):
+    """Returns a pygame Font for the font file at path (or a file object to read it from), only loading each
+    (path, size) once"""
+    key = ('file', path, size)
+    if key not in _fonts:
+        _fonts[key] = pygame.font.Font(path, size)
+    return _fonts[key]
+
+
+def sys_font(name, size):
+    """Same as pygame.font.SysFont, but the font is only looked up once for each (name, size)"""
+    key = ('system', name, size)
+    if key not in _fonts:
+        _fonts[key] = pygame.font.SysFont(name, size)
+    return _fonts[key]
+
+
+class TextCache:
+    """Class that keeps rendered text surfaces, keyed by (font, string, color). When more than max_size surfaces are
+    cached, the one that was used least recently is thrown away"""
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._surfaces = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._surfaces)
+
+    def render(self, font: pygame.font.Font, text, color, antialias=True):
+        """Returns the same surface as font.render(text, antialias, color), rendering it only if it isn't cached"""
+        key = (font, str(text), tuple(color), antialias)
+        surface = self._surfaces.get(key)
+        if surface is not None:
+            self._surfaces.move_to_end(key)
+            self.hits += 1
+            return surface
+
+        self.misses += 1
+        surface = font.render(str(text), antialias, color)
+        self._surfaces[key] = surface
+        if len(self._surfaces) > self.max_size:
+            self._surfaces.popitem(last=False)
+        return surface
+
+    def clear(self):
+        self._surfaces.clear()
+
+
+# Cache shared by everything that doesn't make its own
+TEXT_CACHE = TextCache()
+
+
+class HudText:
+    """One piece of text on the screen, like a timer or a score. The text surface is only looked up again when the
+    value changes (see set).
+
+    The position is given the same way as for a Rect: center=(x, y), topleft=(x, y), etc."""
+    def __init__(self, font, color, value='', cache=None, **position):
+        self.font = font
+        self.color = color
+        self.cache = cache if cache is not None else TEXT_CACHE
+        self.position = position
+        self.value = None
+        self.surface = None
+        self.rect = None
+        self.set(value)
+
+    def set(self, value, color=None):
+        """Change the value (and optionally color) of the text. Returns True if it actually changed"""
+        if value == self.value and (color is None or tuple(color) == tuple(self.color)):
+            return False
+        self.value = value
+        if color is not None:
+            self.color = color
+        self.surface = self.cache.render(self.font, value, self.color)
+        self.rect = self.surface.get_rect(**self.position)
+        return True
+
+    def draw(self, surface: pygame.Surface):
+        """Blit the text onto surface. Returns the area that was drawn on"""
+        return surface.blit(self.surface, self.rect)
+
+
+class Hud:
+    """A group of HudText items that are drawn together, looked up by name"""
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else TEXT_CACHE
+        self.items = OrderedDict()
+
+    def __getitem__(self, name):
+        return self.items[name]
+
+    def add(self, name, font, color, value='', **position):
+        self.items[name] = HudText(font, color, value, self.cache, **position)
+        return self.items[name]
+
+    def set(self, name, value, color=None):
+        """Change the value of one item. Returns True if it changed"""
+        return self.items[name].set(value, color)
+
+    def draw(self, surface: pygame.Surface):
+        """Draws every item. Returns a list of the areas that were drawn on"""
+        return [item.draw(surface) for item in self.items.values()]